@@ -0,0 +1,223 @@
+'''
+Keyframe animation and sequence rendering.
+
+Scene files animate the camera, the lights and the shapes with `key` lines, values are
+linearly interpolated between keys. Every frame only updates the animated properties of the
+parsed scene: meshes, textures and the object space BVHs of the models are shared by all the
+frames, and the scene BVH is refit around the shapes that moved.
+'''
+
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from figures import Obj
+from framebuffer import Framebuffer
+from lights import DirectionalLight, PointLight
+from parallel import worker_count
+
+# Animated properties of each target and their number of values
+PROPERTIES = {
+    'camera': {'position': 3, 'look_at': 3},
+    'light': {'position': 3, 'direction': 3, 'intensity': 1},
+    'shape': {'position': 3, 'rotation': 3, 'scale': 3},
+}
+
+
+class Track(object):
+    '''
+    Track class
+
+    Keyframed values of one property.
+
+    Attributes:
+        keys (list[tuple[float, tuple[float, ...]]]): Frame and value of every key, sorted by frame.
+    '''
+
+    def __init__(self) -> None:
+        self.keys: list[tuple[float, tuple[float, ...]]] = []
+
+    def add(self, frame: float, value: tuple[float, ...]) -> None:
+        self.keys = [key for key in self.keys if key[0] != frame]
+        self.keys.append((frame, value))
+        self.keys.sort(key=lambda key: key[0])
+
+    def value_at(self, frame: float) -> tuple[float, ...]:
+        '''
+        Value at a frame, linearly interpolated between the surrounding keys and held before
+        the first key and after the last one.
+        '''
+        keys = self.keys
+        if frame <= keys[0][0]:
+            return keys[0][1]
+        for (start, a), (end, b) in zip(keys, keys[1:]):
+            if frame <= end:
+                t = (frame - start) / (end - start)
+                return tuple(x + (y - x) * t for x, y in zip(a, b))
+        return keys[-1][1]
+
+
+class Animation(object):
+    '''
+    Animation class
+
+    Keyframes of a scene, read from lines like
+
+        frames 120
+        key 0 camera position 0 0 0
+        key 0 shape 3 rotation 0 0 0
+        key 120 shape 3 rotation 0 6.283185 0
+
+    Lights and shapes are referenced by their index (from 0) in the order of the scene file.
+
+    Attributes:
+        frames (int): Frames of the sequence.
+        tracks (dict[tuple[str, int, str], Track]): Track of each target, index (0 for the
+            camera) and property.
+    '''
+
+    def __init__(self, frames: int = 1) -> None:
+        self.frames = frames
+        self.tracks: dict[tuple[str, int, str], Track] = {}
+
+    def add_key(self, params: list[str]) -> None:
+        '''
+        Add a key from the parameters of a `key` line, frame target [index] property values.
+        '''
+        frame = float(params[0])
+        target = params[1]
+        if target not in PROPERTIES:
+            print(f"Unknown animation target {target}, ignored")
+            return
+        index = 0 if target == 'camera' else int(params[2])
+        params = params[2:] if target == 'camera' else params[3:]
+        name = params[0]
+        size = PROPERTIES[target].get(name)
+        if size is None or len(params) - 1 != size:
+            print(f"Unknown {target} property {' '.join(params)}, ignored")
+            return
+        value = tuple(map(float, params[1:]))
+        self.tracks.setdefault((target, index, name), Track()).add(frame, value)
+
+    def check(self, raytracer) -> None:
+        '''
+        Drop the tracks of lights and shapes the scene does not have, or of properties they
+        do not support.
+        '''
+        for key in list(self.tracks):
+            target, index, name = key
+            if target == 'light':
+                lights = raytracer.lights
+                valid = index < len(lights) and (
+                    name == 'intensity' or
+                    name == 'position' and isinstance(lights[index], PointLight) or
+                    name == 'direction' and isinstance(lights[index], DirectionalLight))
+            elif target == 'shape':
+                valid = index < len(raytracer.scene) and (
+                    name == 'position' or isinstance(raytracer.scene[index], Obj))
+            else:
+                valid = True
+            if not valid:
+                print(f"Can not animate {target} {index} {name}, ignored")
+                del self.tracks[key]
+
+    def apply(self, raytracer, frame: int) -> bool:
+        '''
+        Set every animated property to its value at the frame and refit the scene BVH if
+        shapes moved. Returns whether shapes moved.
+        '''
+        moved = False
+        transforms = {}
+        for (target, index, name), track in self.tracks.items():
+            value = track.value_at(frame)
+            if target == 'camera' and name == 'look_at':
+                raytracer.set_camera(target=value)
+            elif target == 'camera':
+                raytracer.set_camera(position=value)
+            elif target == 'light':
+                light = raytracer.lights[index]
+                if name == 'intensity':
+                    light.set_intensity(value[0])
+                elif name == 'direction':
+                    light.set_direction(value)
+                else:
+                    light.point = value
+            elif name == 'position' and not isinstance(raytracer.scene[index], Obj):
+                raytracer.scene[index].move(value)
+                moved = True
+            else:
+                # Models take their position, rotation and scale in a single transform
+                transforms.setdefault(index, {})[name] = value
+
+        for index, values in transforms.items():
+            shape = raytracer.scene[index]
+            shape.transform(values.get('position', shape.position),
+                            values.get('rotation', shape.rotation),
+                            values.get('scale', shape.scale))
+            moved = True
+
+        if moved:
+            raytracer.refit()
+        return moved
+
+
+# Raytracer and animation of the current worker process, set once by init_worker
+worker_raytracer = None
+worker_animation = None
+
+
+def init_worker(raytracer, animation: Animation) -> None:
+    global worker_raytracer, worker_animation
+    worker_raytracer = raytracer
+    worker_animation = animation
+    raytracer.framebuffer = Framebuffer(raytracer.width, raytracer.height)
+    raytracer.render_using = 'normal'
+    raytracer.display_interval = 0
+
+
+def render_frame(frame: int) -> tuple[int, bytes]:
+    '''
+    Render a whole frame in a worker, returns the frame and its PNG file.
+    '''
+    worker_animation.apply(worker_raytracer, frame)
+    worker_raytracer.clear()
+    worker_raytracer.render()
+    return frame, worker_raytracer.framebuffer.to_png()
+
+
+def render_sequence(raytracer, animation: Animation, output_pattern: str, frames: list[int] = None) -> None:
+    '''
+    Render frames of the animation (all of them by default) as PNG files named by
+    `output_pattern.format(frame)`.
+
+    With render_using 'processes' whole frames are rendered in parallel, one per worker
+    process, each worker receiving the scene once. Any other mode renders the frames one
+    after another, parallelizing the tiles of each frame as that mode does.
+    '''
+    frames = list(range(animation.frames)) if frames is None else frames
+    animation.check(raytracer)
+    if raytracer.bvh is None:
+        raytracer.build()
+
+    def save(frame: int, png: bytes) -> None:
+        path = output_pattern.format(frame)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(png)
+        print(f"Saved frame {frame} to {path}")
+
+    if raytracer.render_using == 'processes' and len(frames) > 1:
+        workers = min(worker_count(raytracer.workers), len(frames))
+        print(f"Rendering {len(frames)} frames with {workers} processes...")
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=init_worker,
+                                 initargs=(raytracer, animation)) as executor:
+            futures = [executor.submit(render_frame, frame) for frame in frames]
+            for future in as_completed(futures):
+                save(*future.result())
+        return
+
+    for frame in frames:
+        animation.apply(raytracer, frame)
+        raytracer.clear()
+        raytracer.render()
+        save(frame, raytracer.framebuffer.to_png())
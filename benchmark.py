@@ -0,0 +1,254 @@
+'''
+Benchmark suite.
+
+Renders the bundled scenes at several resolutions in every render mode and runs
+microbenchmarks of the shape intersections, the vector math and the OBJ loader. Results are
+printed and written as JSON so runs from different commits can be compared.
+
+    python benchmark.py --out results.json
+    python benchmark.py --quick --compare results.json
+'''
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import time
+import timeit
+
+import numpy as np
+
+import pmath as pm
+import pmath_batch as pmb
+from figures import Sphere, Plane, Disk, AABB, Triangle, Obj, Intercept
+from lights import AmbientLight, DirectionalLight, PointLight
+from materials import Material
+from raytracer import parse_scene, parse_size
+from rt import Raytracer
+
+SCENES = ['./scenes/triangles.txt',
+          './scenes/unicorn.txt', './scenes/final.txt']
+MODES = ['normal', 'threads', 'processes', 'vectorized', 'progressive']
+SIZES = [(108, 72), (216, 144), (432, 288)]
+QUICK_SIZES = [(54, 36)]
+
+MODEL_PATH = './assets/models/unicorn.obj'
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_render(scene: str, width: int, height: int, mode: str) -> dict:
+    '''
+    Render a scene headless and return its timings.
+    '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        raytracer = Raytracer(None, width, height)
+        start = time.perf_counter()
+        parse_scene(raytracer, scene)
+        raytracer.render_using = mode
+        raytracer.build()
+        setup = time.perf_counter() - start
+
+        raytracer.clear()
+        start = time.perf_counter()
+        raytracer.render()
+        seconds = time.perf_counter() - start
+
+    pixels = width * height
+    return {
+        'name': f'render/{scene.rsplit("/", 1)[-1]}/{width}x{height}/{mode}',
+        'kind': 'render',
+        'seconds': seconds,
+        'setup_seconds': setup,
+        'primary_rays': pixels,
+        'rays_per_second': pixels / seconds,
+    }
+
+
+def bench_call(name: str, function, repeat: int = 5, number: int = 2000) -> dict:
+    '''
+    Time a call with timeit, keeping the best of `repeat` runs.
+    '''
+    best = min(timeit.repeat(function, repeat=repeat, number=number))
+    return {
+        'name': name,
+        'kind': 'micro',
+        'seconds': best / number,
+        'calls_per_second': number / best,
+    }
+
+
+def micro_benchmarks(quick: bool = False) -> list[dict]:
+    number = 500 if quick else 5000
+    material = Material()
+    origin = (0, 0, 0)
+    direction = pm.norm((0.1, 0.05, -1))
+    miss = pm.norm((1, 1, 1))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = Obj(position=(0, 0, -10), filepath=MODEL_PATH, material=material,
+                    rotate=(-0.25, 0.25, 0.15), scale=(1.3, 1.3, 1.3))
+
+    shapes = {
+        'Sphere': Sphere((0, 0, -10), 2, material),
+        'Plane': Plane((0, -5, 0), (0, 1, 0), material),
+        'Disk': Disk((0, -5, -10), (0, 1, 0.2), 3, material),
+        'AABB': AABB((0, 0, -10), (2, 2, 2), material),
+        'Triangle': Triangle(((-1, -1, -10), (1, -1, -10), (0, 1, -10)), material),
+        'Obj': model,
+    }
+
+    results = []
+    for name, shape in shapes.items():
+        results.append(bench_call(f'ray_intersect/{name}/hit',
+                                  lambda: shape.ray_intersect(origin, direction), number=number))
+        results.append(bench_call(f'ray_intersect/{name}/miss',
+                                  lambda: shape.ray_intersect(origin, miss), number=number))
+
+    a = (0.3, -0.5, 0.8)
+    b = (-0.2, 0.9, 0.4)
+    n = pm.norm((0, 1, 0.2))
+    d = pm.norm((0.3, -0.8, 0.1))
+    math_calls = {
+        'subtract': lambda: pm.subtract(a, b),
+        'add': lambda: pm.add(a, b),
+        'dot': lambda: pm.dot(a, b),
+        'cross': lambda: pm.cross(a, b),
+        'norm': lambda: pm.norm(a),
+        'norm_mag': lambda: pm.norm_mag(a),
+        'multiply': lambda: pm.multiply(2.5, a),
+        'reflect_vector': lambda: pm.reflect_vector(d, n),
+        'refract_vector': lambda: pm.refract_vector(d, n, 1.0, 1.5),
+        'fresnel': lambda: pm.fresnel(d, n, 1.0, 1.5),
+        # 3-component fast paths, compare with the generic functions above
+        'sub3': lambda: pm.sub3(a, b),
+        'add3': lambda: pm.add3(a, b),
+        'dot3': lambda: pm.dot3(a, b),
+        'norm3': lambda: pm.norm3(a),
+        'length3': lambda: pm.length3(a),
+        'scale3': lambda: pm.scale3(2.5, a),
+        'add_scaled': lambda: pm.add_scaled(a, 2.5, b),
+        'add_multiply': lambda: pm.add(a, pm.multiply(2.5, b)),
+        'reflect': lambda: pm.reflect(d, n),
+        'direction_to': lambda: pm.direction_to(a, b),
+    }
+    for name, call in math_calls.items():
+        results.append(bench_call(f'pmath/{name}', call, number=number * 4))
+
+    # Diffuse and specular of one light at a hit
+    shiny = Material(specular=32, ks=0.2)
+    intercept = Intercept(distance=4, point=(0, 0, -4), normal=(0, 0, 1),
+                          obj=Sphere((0, 0, -5), 1, shiny), texture_coords=None)
+    view = pm.norm3(pm.sub3(origin, intercept.point))
+    lights = {
+        'AmbientLight': AmbientLight(0.2),
+        'DirectionalLight': DirectionalLight(direction=(0.2, -1, -1)),
+        'PointLight': PointLight((1, 2, 0), 1.5),
+    }
+    for name, light in lights.items():
+        results.append(bench_call(f'shade/{name}',
+                                  lambda: light.shade(intercept, view), number=number * 4))
+
+    # Batch functions, timed per vector to compare with the scalar calls
+    rows = 4096
+    generator = np.random.default_rng(0)
+    va = generator.standard_normal((rows, 3))
+    vb = generator.standard_normal((rows, 3))
+    vn = pmb.normalize(vb)
+    scalars = generator.standard_normal(rows)
+    batch_calls = {
+        'dot': lambda: pmb.dot(va, vb),
+        'normalize': lambda: pmb.normalize(va),
+        'add_scaled': lambda: pmb.add_scaled(va, scalars, vb),
+        'reflect': lambda: pmb.reflect(va, vn),
+        'direction_to': lambda: pmb.direction_to(va, vb),
+    }
+    for name, call in batch_calls.items():
+        result = bench_call(f'pmath_batch/{name}/{rows}', call, number=max(number // 50, 10))
+        result['seconds'] /= rows
+        result['calls_per_second'] *= rows
+        results.append(result)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        results.append(bench_call('Obj.load/unicorn.obj',
+                                  lambda: Obj.load(MODEL_PATH), repeat=3, number=5))
+
+    return results
+
+
+def compare(results: list[dict], previous_path: str) -> None:
+    '''
+    Print the change of every benchmark against a previous results file.
+    '''
+    with open(previous_path) as f:
+        previous = {r['name']: r for r in json.load(f)['results']}
+
+    print(f'\nCompared to {previous_path}:')
+    for result in results:
+        before = previous.get(result['name'])
+        if before is None:
+            continue
+        ratio = before['seconds'] / result['seconds']
+        flag = '  REGRESSION' if ratio < 0.9 else ''
+        print(f"  {result['name']:<55} {ratio:6.2f}x{flag}")
+
+
+def main(argv: list[str] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog='benchmark', description='Ray tracer benchmark suite.')
+    parser.add_argument('--scenes', nargs='+', default=SCENES)
+    parser.add_argument('--modes', nargs='+', default=MODES, choices=MODES)
+    parser.add_argument('--sizes', nargs='+', type=parse_size,
+                        help='render sizes as WIDTHxHEIGHT')
+    parser.add_argument('--quick', action='store_true',
+                        help='one small size and fewer microbenchmark iterations')
+    parser.add_argument('--no-render', action='store_true',
+                        help='only run the microbenchmarks')
+    parser.add_argument('--no-micro', action='store_true',
+                        help='only run the scene renders')
+    parser.add_argument('--out', default='benchmark.json',
+                        help='JSON results path')
+    parser.add_argument('--compare', help='previous JSON results to compare with')
+    args = parser.parse_args(argv)
+
+    sizes = args.sizes or (QUICK_SIZES if args.quick else SIZES)
+    results = []
+
+    if not args.no_micro:
+        for result in micro_benchmarks(args.quick):
+            results.append(result)
+            print(f"{result['name']:<55} {result['seconds'] * 1e6:10.2f} us")
+
+    if not args.no_render:
+        for scene in args.scenes:
+            for width, height in sizes:
+                for mode in args.modes:
+                    result = bench_render(scene, width, height, mode)
+                    results.append(result)
+                    print(f"{result['name']:<55} {result['seconds']:10.3f} s "
+                          f"{result['rays_per_second']:10.0f} rays/s")
+
+    with open(args.out, 'w') as f:
+        json.dump({
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'timestamp': time.time(),
+            'results': results,
+        }, f, indent=2)
+    print(f'Saved {args.out}')
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
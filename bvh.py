@@ -0,0 +1,357 @@
+'''
+Bounding volume hierarchy.
+'''
+
+import math
+
+# Binned SAH build parameters
+SAH_BINS = 12
+MAX_LEAF_SIZE = 4
+TRAVERSAL_COST = 1.0
+INTERSECTION_COST = 1.0
+
+
+def inverse_direction(direction: tuple[float, float, float]) -> tuple[float, float, float]:
+    '''
+    Inverse of a ray direction, used by the slab test.
+
+    Zero components are replaced by a large value so the slab test never divides by zero.
+    '''
+    return tuple(1 / d if d != 0 else math.copysign(1e30, d) for d in direction)
+
+
+def surface_area(min_bounds: tuple[float, float, float], max_bounds: tuple[float, float, float]) -> float:
+    '''
+    Surface area of an axis-aligned box.
+    '''
+    dx = max_bounds[0] - min_bounds[0]
+    dy = max_bounds[1] - min_bounds[1]
+    dz = max_bounds[2] - min_bounds[2]
+    return 2 * (dx * dy + dy * dz + dz * dx)
+
+
+def union(a: tuple[tuple[float, float, float], tuple[float, float, float]], b: tuple[tuple[float, float, float], tuple[float, float, float]]) -> tuple[tuple[float, float, float], tuple[float, float, float]]:
+    '''
+    Union of two (min_bounds, max_bounds) boxes.
+    '''
+    return ((min(a[0][0], b[0][0]), min(a[0][1], b[0][1]), min(a[0][2], b[0][2])),
+            (max(a[1][0], b[1][0]), max(a[1][1], b[1][1]), max(a[1][2], b[1][2])))
+
+
+def slab(min_bounds: tuple[float, float, float], max_bounds: tuple[float, float, float], origin: tuple[float, float, float], inv_direction: tuple[float, float, float], t_max: float = float('inf')) -> float | None:
+    '''
+    Slab test, returns the entry distance of the ray into the box or None if it misses.
+    '''
+    tx1 = (min_bounds[0] - origin[0]) * inv_direction[0]
+    tx2 = (max_bounds[0] - origin[0]) * inv_direction[0]
+    t_near = min(tx1, tx2)
+    t_far = max(tx1, tx2)
+
+    ty1 = (min_bounds[1] - origin[1]) * inv_direction[1]
+    ty2 = (max_bounds[1] - origin[1]) * inv_direction[1]
+    t_near = max(t_near, min(ty1, ty2))
+    t_far = min(t_far, max(ty1, ty2))
+
+    tz1 = (min_bounds[2] - origin[2]) * inv_direction[2]
+    tz2 = (max_bounds[2] - origin[2]) * inv_direction[2]
+    t_near = max(t_near, min(tz1, tz2))
+    t_far = min(t_far, max(tz1, tz2))
+
+    if t_far < t_near or t_far < 0 or t_near > t_max:
+        return None
+    return t_near
+
+
+class BVH(object):
+    '''
+    BVH class
+
+    Bounding volume hierarchy built with the surface area heuristic (SAH) over a list of
+    primitive bounds. Primitives are referenced by their index, so the same structure is
+    used for the scene shapes and for the triangles of an OBJ model.
+
+    Nodes are stored flattened in parallel lists. Leaves have a primitive count greater
+    than zero, inner nodes store the index of their two children.
+
+    Attributes:
+        indices (list[int]): Primitive indices ordered so each leaf covers a contiguous range.
+        node_min (list[tuple[float, float, float]]): Minimum bounds of each node.
+        node_max (list[tuple[float, float, float]]): Maximum bounds of each node.
+        node_left (list[int]): Left child (inner nodes) or first index in `indices` (leaves).
+        node_right (list[int]): Right child of each inner node.
+        node_count (list[int]): Primitive count of each leaf, 0 for inner nodes.
+    '''
+
+    def __init__(self, bounds: list[tuple[tuple[float, float, float], tuple[float, float, float]]]) -> None:
+        self.indices = list(range(len(bounds)))
+        self.node_min = []
+        self.node_max = []
+        self.node_left = []
+        self.node_right = []
+        self.node_count = []
+
+        if bounds:
+            # Bounds and centroids split by component, so the build can run min/max over
+            # index lists without creating intermediate tuples
+            mins = [[b[0][k] for b in bounds] for k in range(3)]
+            maxs = [[b[1][k] for b in bounds] for k in range(3)]
+            centroids = [[(lo + hi) / 2 for lo, hi in zip(mins[k], maxs[k])]
+                         for k in range(3)]
+            self._build(mins, maxs, centroids, 0, len(bounds))
+
+    @property
+    def bounds(self) -> tuple[tuple[float, float, float], tuple[float, float, float]] | None:
+        '''
+        World bounds of the whole hierarchy, None when it is empty.
+        '''
+        if not self.node_count:
+            return None
+        return self.node_min[0], self.node_max[0]
+
+    def _add_node(self, min_bounds, max_bounds) -> int:
+        self.node_min.append(min_bounds)
+        self.node_max.append(max_bounds)
+        self.node_left.append(0)
+        self.node_right.append(0)
+        self.node_count.append(0)
+        return len(self.node_count) - 1
+
+    @staticmethod
+    def _range_bounds(mins, maxs, items: list[int]) -> tuple[tuple[float, float, float], tuple[float, float, float]]:
+        '''
+        Bounds of the given primitives.
+        '''
+        return (tuple(min(map(mins[k].__getitem__, items)) for k in range(3)),
+                tuple(max(map(maxs[k].__getitem__, items)) for k in range(3)))
+
+    def _build(self, mins, maxs, centroids, start: int, end: int) -> int:
+        '''
+        Recursively build the node covering indices[start:end] and return its index.
+        '''
+        indices = self.indices
+        items = indices[start:end]
+        node_bounds = self._range_bounds(mins, maxs, items)
+        node = self._add_node(*node_bounds)
+
+        count = end - start
+        split = self._find_split(mins, maxs, centroids, items, node_bounds) \
+            if count > MAX_LEAF_SIZE else None
+
+        if split is None:
+            self.node_left[node] = start
+            self.node_count[node] = count
+            return node
+
+        axis, position = split
+        centroid = centroids[axis]
+        left = [i for i in items if centroid[i] < position]
+        right = [i for i in items if centroid[i] >= position]
+        indices[start:end] = left + right
+        middle = start + len(left)
+
+        self.node_left[node] = self._build(
+            mins, maxs, centroids, start, middle)
+        self.node_right[node] = self._build(
+            mins, maxs, centroids, middle, end)
+        return node
+
+    def _find_split(self, mins, maxs, centroids, items: list[int], node_bounds) -> tuple[int, float] | None:
+        '''
+        Binned SAH split search. Returns (axis, position) or None when a leaf is cheaper.
+        '''
+        count = len(items)
+        leaf_cost = INTERSECTION_COST * count
+        parent_area = surface_area(*node_bounds)
+
+        best_cost = leaf_cost
+        best_split = None
+        last_bin = SAH_BINS - 1
+
+        for axis in range(3):
+            centroid = list(map(centroids[axis].__getitem__, items))
+            c_min = min(centroid)
+            c_max = max(centroid)
+            if c_max - c_min <= 1e-12:
+                continue
+
+            scale = SAH_BINS / (c_max - c_min)
+            bins = [[] for _ in range(SAH_BINS)]
+            for i, c in zip(items, centroid):
+                b = int((c - c_min) * scale)
+                bins[b if b < last_bin else last_bin].append(i)
+
+            bin_bounds = [self._range_bounds(mins, maxs, bucket) if bucket else None
+                          for bucket in bins]
+            bin_counts = [len(bucket) for bucket in bins]
+
+            # Sweep from the right to collect suffix areas
+            right_areas = [0.0] * SAH_BINS
+            right_counts = [0] * SAH_BINS
+            acc_bounds = None
+            acc_count = 0
+            for b in range(SAH_BINS - 1, 0, -1):
+                if bin_bounds[b] is not None:
+                    acc_bounds = bin_bounds[b] if acc_bounds is None else union(
+                        acc_bounds, bin_bounds[b])
+                acc_count += bin_counts[b]
+                right_counts[b] = acc_count
+                right_areas[b] = surface_area(*acc_bounds) if acc_bounds else 0.0
+
+            acc_bounds = None
+            acc_count = 0
+            for b in range(SAH_BINS - 1):
+                if bin_bounds[b] is not None:
+                    acc_bounds = bin_bounds[b] if acc_bounds is None else union(
+                        acc_bounds, bin_bounds[b])
+                acc_count += bin_counts[b]
+                if acc_count == 0 or right_counts[b + 1] == 0:
+                    continue
+
+                left_area = surface_area(*acc_bounds)
+                cost = TRAVERSAL_COST + INTERSECTION_COST * (
+                    left_area * acc_count + right_areas[b + 1] * right_counts[b + 1]) / max(parent_area, 1e-12)
+
+                if cost < best_cost:
+                    best_cost = cost
+                    best_split = (axis, c_min + (b + 1) / scale)
+
+        return best_split
+
+    def refit(self, bounds: list[tuple[tuple[float, float, float], tuple[float, float, float]]]) -> None:
+        '''
+        Update the node bounds after primitives moved, keeping the tree.
+
+        Much cheaper than a new build, but the tree gets worse as primitives move away from
+        where it was built, see sah_cost.
+        '''
+        node_min = self.node_min
+        node_max = self.node_max
+        node_left = self.node_left
+        node_right = self.node_right
+        node_count = self.node_count
+        indices = self.indices
+
+        # Children are always stored after their parent
+        for node in range(len(node_count) - 1, -1, -1):
+            count = node_count[node]
+            if count:
+                first = node_left[node]
+                boxes = [bounds[i] for i in indices[first:first + count]]
+                node_min[node] = tuple(min(b[0][k] for b in boxes) for k in range(3))
+                node_max[node] = tuple(max(b[1][k] for b in boxes) for k in range(3))
+            else:
+                left = node_left[node]
+                right = node_right[node]
+                node_min[node], node_max[node] = union(
+                    (node_min[left], node_max[left]), (node_min[right], node_max[right]))
+
+    def sah_cost(self) -> float:
+        '''
+        Expected cost of a ray traversing the tree under the surface area heuristic.
+        '''
+        if not self.node_count:
+            return 0.0
+        root_area = max(surface_area(self.node_min[0], self.node_max[0]), 1e-12)
+        cost = 0.0
+        for node, count in enumerate(self.node_count):
+            area = surface_area(self.node_min[node], self.node_max[node])
+            cost += area * (INTERSECTION_COST * count if count else TRAVERSAL_COST)
+        return cost / root_area
+
+    def intersect(self, origin: tuple[float, float, float], direction: tuple[float, float, float], hit_fn, t_max: float = float('inf')):
+        '''
+        Closest hit traversal.
+
+        `hit_fn(index, origin, direction)` is called for every primitive in a visited leaf
+        and must return an object with a `distance` attribute or None.
+        '''
+        if not self.node_count:
+            return None
+
+        inv_direction = inverse_direction(direction)
+        node_min = self.node_min
+        node_max = self.node_max
+        node_left = self.node_left
+        node_right = self.node_right
+        node_count = self.node_count
+        indices = self.indices
+
+        closest = None
+        depth = t_max
+
+        if slab(node_min[0], node_max[0], origin, inv_direction, depth) is None:
+            return None
+
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            count = node_count[node]
+
+            if count:
+                start = node_left[node]
+                for i in indices[start:start + count]:
+                    hit = hit_fn(i, origin, direction)
+                    if hit is not None and hit.distance < depth:
+                        closest = hit
+                        depth = hit.distance
+                continue
+
+            left = node_left[node]
+            right = node_right[node]
+            t_left = slab(node_min[left], node_max[left],
+                          origin, inv_direction, depth)
+            t_right = slab(node_min[right], node_max[right],
+                           origin, inv_direction, depth)
+
+            # Visit the nearest child first
+            if t_left is not None and t_right is not None:
+                if t_left <= t_right:
+                    stack.append(right)
+                    stack.append(left)
+                else:
+                    stack.append(left)
+                    stack.append(right)
+            elif t_left is not None:
+                stack.append(left)
+            elif t_right is not None:
+                stack.append(right)
+
+        return closest
+
+    def occluded(self, origin: tuple[float, float, float], direction: tuple[float, float, float], hit_fn, t_max: float = float('inf')) -> bool:
+        '''
+        Any hit traversal for shadow rays.
+
+        `hit_fn(index, origin, direction)` must return True when the primitive is hit before
+        `t_max`. The traversal stops at the first such primitive, so children are visited
+        without sorting them.
+        '''
+        if not self.node_count:
+            return False
+
+        inv_direction = inverse_direction(direction)
+        node_min = self.node_min
+        node_max = self.node_max
+        node_left = self.node_left
+        node_right = self.node_right
+        node_count = self.node_count
+        indices = self.indices
+
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if slab(node_min[node], node_max[node], origin, inv_direction, t_max) is None:
+                continue
+
+            count = node_count[node]
+            if count:
+                start = node_left[node]
+                for i in indices[start:start + count]:
+                    if hit_fn(i, origin, direction):
+                        return True
+                continue
+
+            stack.append(node_right[node])
+            stack.append(node_left[node])
+
+        return False
@@ -0,0 +1,297 @@
+'''
+Distributed tile renderer.
+
+A coordinator splits frames in tiles and serves them over TCP to workers on any number of
+machines. The raytracer (shapes, materials, lights and camera) is sent once per frame to
+every worker, workers then pull tiles and send back their pixels as compressed blocks.
+Tiles held by a worker that disconnects or stops answering are handed to another worker.
+
+The scene is sent with pickle, so only run workers against coordinators you trust.
+'''
+
+import collections
+import multiprocessing
+import pickle
+import queue
+import socket
+import struct
+import threading
+import time
+import zlib
+
+PROTOCOL_VERSION = 2
+DEFAULT_PORT = 7421
+
+# Tiles sent ahead to each worker, so it starts the next tile while the last one travels
+PREFETCH = 2
+# Seconds a worker may take to answer a tile before its tiles are given to other workers
+TIMEOUT = 300
+# Seconds between the connection attempts of a worker started before its coordinator,
+# doubled after every refused attempt up to the maximum
+RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 10
+
+# Message kinds
+SCENE = b'S'
+TILE = b'T'
+PIXELS = b'P'
+QUIT = b'Q'
+
+HEADER = struct.Struct('>cI')
+TILE_HEADER = struct.Struct('>4I')
+PIXELS_HEADER = struct.Struct('>4Id')
+
+
+def parse_address(value: str) -> tuple[str, int]:
+    '''
+    (host, port) of a HOST:PORT, HOST or :PORT string.
+    '''
+    host, _, port = value.rpartition(':') if ':' in value else (value, '', '')
+    return host or '127.0.0.1', int(port) if port else DEFAULT_PORT
+
+
+def send(connection: socket.socket, kind: bytes, payload: bytes = b'') -> None:
+    connection.sendall(HEADER.pack(kind, len(payload)) + payload)
+
+
+def receive_exactly(connection: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = connection.recv(min(size - len(data), 1 << 20))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        data += chunk
+    return bytes(data)
+
+
+def receive(connection: socket.socket) -> tuple[bytes, bytes]:
+    kind, size = HEADER.unpack(receive_exactly(connection, HEADER.size))
+    return kind, receive_exactly(connection, size)
+
+
+def encode_block(colors: list, shapes: list[int] = None) -> bytes:
+    '''
+    Compressed block of the colors of a tile (column order), a hit flag per pixel followed
+    by the 8 bit colors and the shape ids (0 when not given). Pixels without color (None)
+    are not drawn, like in tile_composite.
+    '''
+    hits = bytearray(len(colors))
+    pixels = bytearray(3 * len(colors))
+    for i, color in enumerate(colors):
+        if color:
+            hits[i] = 1
+            pixels[3 * i:3 * i + 3] = bytes(
+                (int(color[0] * 255), int(color[1] * 255), int(color[2] * 255)))
+    ids = struct.pack(f'>{len(colors)}I', *(shapes or [0] * len(colors)))
+    return zlib.compress(bytes(hits + pixels) + ids, 6)
+
+
+def decode_block(block: bytes, count: int) -> tuple[bytes, bytes, tuple[int, ...]]:
+    '''
+    Hit flags, 8 bit colors and shape ids of a block of `count` pixels.
+    '''
+    data = zlib.decompress(block)
+    return data[:count], data[count:4 * count], struct.unpack(f'>{count}I', data[4 * count:])
+
+
+class RenderJob(object):
+    '''
+    RenderJob class
+
+    A frame being rendered by the workers of a Coordinator.
+
+    Attributes:
+        scene (bytes): The compressed raytracer sent to the workers.
+        pending (deque): Tiles not yet sent to a worker, in schedule order.
+        results (Queue): Finished tiles as (tile, seconds, hits, pixels, shapes).
+    '''
+
+    def __init__(self, scene: bytes, tiles: list[tuple[int, int, int, int]]) -> None:
+        self.scene = scene
+        self.pending = collections.deque(tiles)
+        self.results = queue.Queue()
+
+
+class Coordinator(object):
+    '''
+    Coordinator class
+
+    Accepts worker connections in the background and renders frames with every connected
+    worker. Workers may join or leave at any time, also in the middle of a frame.
+
+    Attributes:
+        address (tuple[str, int]): The listening host and port.
+        timeout (float): Seconds a worker may take to answer a tile.
+        workers (int): Connected workers.
+        job (RenderJob): The frame being rendered, None between frames.
+    '''
+
+    def __init__(self, host: str = '127.0.0.1', port: int = DEFAULT_PORT, timeout: float = TIMEOUT) -> None:
+        self.server = socket.create_server((host, port))
+        self.address = self.server.getsockname()[:2]
+        self.timeout = timeout
+        self.workers = 0
+        self.job: RenderJob = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.threads: list[threading.Thread] = []
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self) -> None:
+        while True:
+            try:
+                connection, peer = self.server.accept()
+            except OSError:
+                # Closed
+                return
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.condition:
+                self.workers += 1
+            print(f"Worker {peer[0]}:{peer[1]} connected ({self.workers} workers)")
+            thread = threading.Thread(target=self.serve, args=(connection, peer), daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+    def serve(self, connection: socket.socket, peer: tuple) -> None:
+        '''
+        Feed tiles to one worker until the coordinator is closed or the worker is lost.
+        '''
+        sent_job = None
+        job = None
+        in_flight = []
+        try:
+            while True:
+                with self.condition:
+                    while not self.closed and not in_flight and (self.job is None or not self.job.pending):
+                        self.condition.wait()
+                    if self.closed and not in_flight:
+                        break
+                    # In flight tiles belong to `job`, which may have been dropped or
+                    # replaced if its render was stopped early. Their pixels are still
+                    # read, but no tiles are taken until they are back
+                    if not in_flight:
+                        job = self.job
+                    tiles = []
+                    if job is self.job:
+                        while len(in_flight) + len(tiles) < PREFETCH and job.pending:
+                            tiles.append(job.pending.popleft())
+                        in_flight.extend(tiles)
+
+                if job is not sent_job:
+                    send(connection, SCENE, job.scene)
+                    sent_job = job
+                for tile in tiles:
+                    send(connection, TILE, TILE_HEADER.pack(*tile))
+
+                connection.settimeout(self.timeout)
+                kind, payload = receive(connection)
+                connection.settimeout(None)
+                if kind != PIXELS:
+                    raise ValueError(f'unexpected message {kind!r}')
+                *tile, seconds = PIXELS_HEADER.unpack_from(payload)
+                tile = tuple(tile)
+                in_flight.remove(tile)
+                count = (tile[1] - tile[0]) * (tile[3] - tile[2])
+                hits, pixels, shapes = decode_block(payload[PIXELS_HEADER.size:], count)
+                job.results.put((tile, seconds, hits, pixels, shapes))
+
+            send(connection, QUIT)
+        except (OSError, ValueError, struct.error, zlib.error) as e:
+            print(f"Worker {peer[0]}:{peer[1]} lost ({e}), {len(in_flight)} tiles rescheduled")
+        finally:
+            with self.condition:
+                self.workers -= 1
+                # Tiles of a finished or stopped job are not rendered again
+                if in_flight and job is self.job:
+                    job.pending.extendleft(reversed(in_flight))
+                    self.condition.notify_all()
+            connection.close()
+
+    def render(self, raytracer, tiles: list[tuple[int, int, int, int]]):
+        '''
+        Render the tiles with the connected workers, yielding (tile, seconds, hits, pixels,
+        shapes) as tiles finish, see decode_block.
+        '''
+        job = RenderJob(zlib.compress(pickle.dumps(
+            (PROTOCOL_VERSION, raytracer), pickle.HIGHEST_PROTOCOL)), tiles)
+        with self.condition:
+            if not self.workers:
+                print("Waiting for workers on {}:{}...".format(*self.address))
+            self.job = job
+            self.condition.notify_all()
+        try:
+            for _ in range(len(tiles)):
+                yield job.results.get()
+        finally:
+            with self.condition:
+                self.job = None
+
+    def close(self) -> None:
+        '''
+        Stop accepting workers and tell the connected ones to exit.
+        '''
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.server.close()
+        for thread in self.threads:
+            thread.join(1)
+
+
+def run_worker(host: str, port: int = DEFAULT_PORT) -> None:
+    '''
+    Render tiles for a coordinator until it closes the connection. Workers started before
+    the coordinator keep trying to connect.
+    '''
+    delay = RETRY_DELAY
+    while True:
+        try:
+            connection = socket.create_connection((host, port))
+            break
+        except ConnectionRefusedError:
+            print(f"Coordinator {host}:{port} not listening, retrying in {delay:g} s")
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    raytracer = None
+    tiles = 0
+    try:
+        while True:
+            kind, payload = receive(connection)
+            if kind == SCENE:
+                version, raytracer = pickle.loads(zlib.decompress(payload))
+                if version != PROTOCOL_VERSION:
+                    print(f"Coordinator speaks protocol {version}, expected {PROTOCOL_VERSION}")
+                    break
+                raytracer.profiler = None
+                if raytracer.bvh is None:
+                    raytracer.build()
+            elif kind == TILE:
+                tile = TILE_HEADER.unpack(payload)
+                start = time.perf_counter()
+                block = encode_block(*raytracer.tile_samples(tile))
+                send(connection, PIXELS, PIXELS_HEADER.pack(
+                    *tile, time.perf_counter() - start) + block)
+                tiles += 1
+            elif kind == QUIT:
+                break
+    except ConnectionError:
+        print("Coordinator closed the connection")
+    finally:
+        connection.close()
+    print(f"Worker done, rendered {tiles} tiles")
+
+
+def spawn_workers(host: str, port: int = DEFAULT_PORT, count: int = 1) -> None:
+    '''
+    Run `count` workers in separate processes, one per core usually.
+    '''
+    if count == 1:
+        run_worker(host, port)
+        return
+    processes = [multiprocessing.Process(target=run_worker, args=(host, port))
+                 for _ in range(count)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
@@ -1,6 +1,11 @@
 import pmath as pm
 import math
+from array import array
+from typing import NamedTuple
 from materials import Material
+from bvh import BVH, slab
+from scene_cache import MeshCache
+from obj_loader import MeshData, load_obj
 
 
 class Shape(object):
@@ -14,6 +19,10 @@ class Shape(object):
         Material (Material): The material of the shape.
     '''
 
+    # Whether rays test the bounds of the shape before intersecting it, worth it when the
+    # intersection costs much more than a slab test
+    cull = False
+
     def __init__(self, position: tuple[float, float, float], material: Material) -> None:
         self.position = position
         self.material = material
@@ -21,6 +30,61 @@ class Shape(object):
     def ray_intersect(self, origin: tuple[float, float, float], direction: tuple[float, float, float]) -> bool:
         return False
 
+    @property
+    def bounds(self) -> tuple[tuple[float, float, float], tuple[float, float, float]] | None:
+        '''
+        World space bounds of get_bounds, computed once. Call update_bounds after moving the
+        shape.
+        '''
+        try:
+            return self._bounds
+        except AttributeError:
+            self._bounds = self.get_bounds()
+            return self._bounds
+
+    def update_bounds(self) -> None:
+        self._bounds = self.get_bounds()
+
+    def move(self, position: tuple[float, float, float]) -> None:
+        '''
+        Place the shape at a new position. The scene BVH must be refit afterwards.
+        '''
+        self.position = position
+        self.update_bounds()
+
+    def may_hit(self, origin: tuple[float, float, float], inv_direction: tuple[float, float, float], max_distance: float = float('inf')) -> bool:
+        '''
+        Slab test of the ray against the bounds, False only when the ray misses the shape.
+        '''
+        bounds = self.bounds
+        return bounds is None or \
+            slab(bounds[0], bounds[1], origin, inv_direction, max_distance) is not None
+
+    def occludes(self, origin: tuple[float, float, float], direction: tuple[float, float, float], max_distance: float = float('inf')) -> bool:
+        '''
+        Occlusion test used by shadow rays, True if the ray hits the shape before max_distance.
+
+        Shapes can override it when they can answer without building the intercept.
+        '''
+        intercept = self.ray_intersect(origin, direction)
+        return intercept is not None and intercept.distance < max_distance
+
+    def texture_density(self) -> float:
+        '''
+        Texture coordinate units per world unit across the surface, roughly, used to pick
+        the mip level of texture lookups. 0 reads the full texture.
+        '''
+        return 0.0
+
+    def get_bounds(self) -> tuple[tuple[float, float, float], tuple[float, float, float]] | None:
+        '''
+        World space bounds of the shape as (min_bounds, max_bounds), None if it is unbounded.
+        '''
+        return None
+
+    def set_material(self, material: Material) -> None:
+        self.material = material
+
 
 class Sphere(Shape):
     '''
@@ -37,16 +101,25 @@ class Sphere(Shape):
         super().__init__(position, material)
         self.radius = radius
 
+    def get_bounds(self) -> tuple[tuple[float, float, float], tuple[float, float, float]]:
+        return (tuple(p - self.radius for p in self.position),
+                tuple(p + self.radius for p in self.position))
+
+    def texture_density(self) -> float:
+        # v runs over half a great circle
+        return 1 / (math.pi * self.radius) if self.radius > 0 else 0.0
+
     def ray_intersect(self, origin: tuple[float, float, float], direction: tuple[float, float, float]):
-        L = pm.subtract(self.position, origin)
-        L_len = pm.norm_mag(L)
-        tca = pm.dot(L, direction)
-        d = (L_len**2 - tca**2) ** 0.5
+        L = pm.sub3(self.position, origin)
+        tca = pm.dot3(L, direction)
+        # Squared distance from the center to the ray
+        d2 = pm.dot3(L, L) - tca * tca
+        radius2 = self.radius * self.radius
 
-        if d > self.radius:
+        if d2 > radius2:
             return None
 
-        thc = (self.radius**2 - d**2) ** 0.5
+        thc = math.sqrt(radius2 - d2)
         t0 = tca - thc
         t1 = tca + thc
 
@@ -56,9 +129,8 @@ class Sphere(Shape):
             return None
 
         # point = origin + t0 * direction
-        point = pm.add(origin, pm.multiply(t0, direction))
-        normal = pm.subtract(point, self.position)
-        normal = pm.norm(normal)
+        point = pm.add_scaled(origin, t0, direction)
+        normal = pm.norm3(pm.sub3(point, self.position))
 
         u = math.atan2(normal[2], normal[0]) / (2 * math.pi) + 0.5
         v = math.acos(normal[1]) / math.pi
@@ -81,12 +153,12 @@ class Plane(Shape):
 
         Described as: distance = (position - origin) . normal / (direction . normal)
         '''
-        denom = pm.dot(direction, self.normal)
+        denom = pm.dot3(direction, self.normal)
         if abs(denom) <= 0.0001:
             # The ray is parallel to the plane
             return None
 
-        num = pm.dot(pm.subtract(self.position, origin), self.normal)
+        num = pm.dot3(pm.sub3(self.position, origin), self.normal)
         t = num / denom
 
         if t < 0:
@@ -94,7 +166,7 @@ class Plane(Shape):
             return None
 
         # point = origin + t0 * direction
-        point = pm.add(origin, pm.multiply(t, direction))
+        point = pm.add_scaled(origin, t, direction)
 
         return Intercept(distance=t,
                          point=point,
@@ -108,14 +180,21 @@ class Disk(Plane):
         super().__init__(position, normal, material)
         self.radius = radius
 
+    def get_bounds(self) -> tuple[tuple[float, float, float], tuple[float, float, float]]:
+        # Extent of a disk along each axis is radius * sin(angle between axis and normal)
+        extent = tuple(self.radius * math.sqrt(max(0, 1 - n ** 2))
+                       for n in self.normal)
+        return (pm.subtract(self.position, extent),
+                pm.add(self.position, extent))
+
     def ray_intersect(self, origin: tuple[float, float, float], direction: tuple[float, float, float]) -> bool:
         plane_intersect = super().ray_intersect(origin, direction)
 
         if plane_intersect is None:
             return None
 
-        contact_distance = pm.subtract(plane_intersect.point, self.position)
-        contact_distance = pm.norm_mag(contact_distance)
+        contact_distance = pm.length3(
+            pm.sub3(plane_intersect.point, self.position))
 
         if contact_distance > self.radius:
             return None
@@ -130,28 +209,23 @@ class Disk(Plane):
 class AABB(Shape):
     '''
     Axis-Aligned Bounding Box class
+
+    Intersected with a single slab test, the face normal is the axis where the ray enters
+    the box (or leaves it, for rays starting inside).
     '''
 
     def __init__(self, position: tuple[float, float, float], size: tuple[float, float, float], material: Material) -> None:
         super().__init__(position, material)
-        self.planes = []
         self.size = size
+        self.move(position)
+
+    def move(self, position: tuple[float, float, float]) -> None:
+        self.position = position
+        size = self.size
 
-        right_plane = Plane(
-            pm.add(position, (size[0] / 2,  0,  0)), (1,  0,  0), material)
-        left_plane = Plane(
-            pm.add(position, (-size[0] / 2,  0,  0)), (-1,  0,  0), material)
-        top_plane = Plane(
-            pm.add(position, (0,  size[1] / 2,  0)), (0,  1,  0), material)
-        bottom_plane = Plane(
-            pm.add(position, (0,  -size[1] / 2,  0)), (0,  -1,  0), material)
-        front_plane = Plane(
-            pm.add(position, (0,  0,  size[2] / 2)), (0,  0,  1), material)
-        back_plane = Plane(
-            pm.add(position, (0,  0,  -size[2] / 2)), (0,  0,  -1), material)
-
-        self.planes = [right_plane, left_plane, top_plane,
-                       bottom_plane, front_plane, back_plane]
+        # Faces of the box
+        self.face_min = tuple(p - s / 2 for p, s in zip(position, size))
+        self.face_max = tuple(p + s / 2 for p, s in zip(position, size))
 
         # Bounds
         self.min_bounds = [0, 0, 0]
@@ -163,63 +237,125 @@ class AABB(Shape):
             self.min_bounds[i] = pos - size / 2 - bias
             self.max_bounds[i] = pos + size / 2 + bias
 
+        self.update_bounds()
+
+    def get_bounds(self) -> tuple[tuple[float, float, float], tuple[float, float, float]]:
+        return tuple(self.min_bounds), tuple(self.max_bounds)
+
+    def texture_density(self) -> float:
+        # Every face spans the whole texture, averaged over the three face sizes
+        volume = 1
+        for size in self.size:
+            volume *= size + 0.002
+        return 1 / volume ** (1 / 3) if volume > 0 else 0.0
+
     def ray_intersect(self, origin: tuple[float, float, float], direction: tuple[float, float, float]) -> bool:
         '''
-        Ray intersect method, returns the intercept of the ray with the plane.
-
-        Described as: distance = (position - origin) . normal / (direction . normal)
+        Ray intersect method, returns the intercept of the ray with the closest face in front
+        of the ray.
         '''
-        intersect: Intercept = None
-        t = float('inf')
-        u, v = 0, 0
-
-        for plane in self.planes:
-            plane_intersect = plane.ray_intersect(origin, direction)
-
-            if plane_intersect is not None:
-                plane_point = plane_intersect.point
-
-                if self.min_bounds[0] <= plane_point[0] <= self.max_bounds[0] and \
-                        self.min_bounds[1] <= plane_point[1] <= self.max_bounds[1] and \
-                        self.min_bounds[2] <= plane_point[2] <= self.max_bounds[2]:
-
-                    if plane_intersect.distance < t:
-                        t = plane_intersect.distance
-                        intersect = plane_intersect
-
-                        # Calculate texture coordinates
-                        if abs(plane.normal[0]) > 0:
-                            # Right or left plane
-                            # Using the y and z coordinates
-                            u = (plane_point[1] -
-                                 self.min_bounds[1]) / (self.size[1] + 0.002)
-                            v = (plane_point[2] -
-                                 self.min_bounds[2]) / (self.size[2] + 0.002)
-                        elif abs(plane.normal[1]) > 0:
-                            # Top or bottom plane
-                            # Using the x and z coordinates
-                            u = (plane_point[0] -
-                                 self.min_bounds[0]) / (self.size[0] + 0.002)
-                            v = (plane_point[2] -
-                                 self.min_bounds[2]) / (self.size[2] + 0.002)
-                        elif abs(plane.normal[2]) > 0:
-                            # Front or back plane
-                            # Using the x and y coordinates
-                            u = (plane_point[0] -
-                                 self.min_bounds[0]) / (self.size[0] + 0.002)
-                            v = (plane_point[1] -
-                                 self.min_bounds[1]) / (self.size[1] + 0.002)
-
-        if intersect is None:
+        t_near = -float('inf')
+        t_far = float('inf')
+        near_axis = far_axis = 0
+
+        for axis in range(3):
+            d = direction[axis]
+            o = origin[axis]
+            if abs(d) <= 0.0001:
+                # Parallel to the faces of this axis
+                if o < self.min_bounds[axis] or o > self.max_bounds[axis]:
+                    return None
+                continue
+            t1 = (self.face_min[axis] - o) / d
+            t2 = (self.face_max[axis] - o) / d
+            if t1 > t2:
+                t1, t2 = t2, t1
+            if t1 > t_near:
+                t_near = t1
+                near_axis = axis
+            if t2 < t_far:
+                t_far = t2
+                far_axis = axis
+
+        if t_far < t_near or t_far < 0:
             return None
 
-        return Intercept(distance=intersect.distance,
-                         point=intersect.point,
-                         normal=intersect.normal,
+        if t_near >= 0:
+            t = t_near
+            axis = near_axis
+            # Entering the box: the face looks against the ray
+            sign = -1 if direction[axis] > 0 else 1
+        else:
+            t = t_far
+            axis = far_axis
+            sign = 1 if direction[axis] > 0 else -1
+
+        point = pm.add_scaled(origin, t, direction)
+        normal = [0.0, 0.0, 0.0]
+        normal[axis] = float(sign)
+
+        # Texture coordinates from the two axes of the face
+        first, second = ((1, 2), (0, 2), (0, 1))[axis]
+        u = (point[first] - self.min_bounds[first]) / (self.size[first] + 0.002)
+        v = (point[second] - self.min_bounds[second]) / \
+            (self.size[second] + 0.002)
+
+        return Intercept(distance=t,
+                         point=point,
+                         normal=tuple(normal),
                          obj=self,
                          texture_coords=(u, v))
 
 
+def triangle_intersect(ox: float, oy: float, oz: float, dx: float, dy: float, dz: float, face, parallel: float) -> tuple[float, float, float] | None:
+    '''
+    Möller-Trumbore intersection of a ray with a triangle, returns (t, u, v) when the
+    triangle is hit in front of the origin, None otherwise.
+
+    face holds vertex 0, the two edges from it and the unit normal, 12 floats as in the
+    face data of Mesh. Rays with |direction . normal| below parallel are taken as parallel
+    to the triangle.
+    '''
+    v0x, v0y, v0z, e1x, e1y, e1z, e2x, e2y, e2z, nx, ny, nz = face
+
+    # Ray (almost) parallel to the triangle
+    if -parallel < dx * nx + dy * ny + dz * nz < parallel:
+        return None
+
+    # h = direction x edge2
+    hx = dy * e2z - dz * e2y
+    hy = dz * e2x - dx * e2z
+    hz = dx * e2y - dy * e2x
+    a = e1x * hx + e1y * hy + e1z * hz
+    if a == 0.0:
+        # Degenerate triangle
+        return None
+
+    f = 1.0 / a
+    sx = ox - v0x
+    sy = oy - v0y
+    sz = oz - v0z
+    u = f * (sx * hx + sy * hy + sz * hz)
+
+    if u < 0.0 or u > 1.0:
+        return None
+
+    # q = s x edge1
+    qx = sy * e1z - sz * e1y
+    qy = sz * e1x - sx * e1z
+    qz = sx * e1y - sy * e1x
+    v = f * (dx * qx + dy * qy + dz * qz)
+
+    if v < 0.0 or u + v > 1.0:
+        return None
+
+    t = f * (e2x * qx + e2y * qy + e2z * qz)
+
+    if t > 0.0001:
+        return t, u, v
+    return None
+
+
 class Triangle(Shape):
     '''
     Triangle class
@@ -234,6 +370,13 @@ class Triangle(Shape):
         super().__init__(self.calculate_triangle_center(vertices), material)
         self.vertices = vertices
 
+        # Invariants of the intersection test
+        self.edge1 = pm.subtract(vertices[1], vertices[0])
+        self.edge2 = pm.subtract(vertices[2], vertices[0])
+        self.normal = pm.norm(pm.cross(self.edge1, self.edge2))
+        self.face = tuple(vertices[0]) + self.edge1 + self.edge2 + self.normal
+        self.area = pm.length3(pm.cross(self.edge1, self.edge2)) / 2
+
     @staticmethod
     def calculate_triangle_center(vertices: tuple[tuple[float, float, float], tuple[float, float, float], tuple[float, float, float]]) -> tuple[float, float, float]:
         x = (vertices[0][0] + vertices[1][0] + vertices[2][0]) / 3
@@ -241,46 +384,189 @@ class Triangle(Shape):
         z = (vertices[0][2] + vertices[1][2] + vertices[2][2]) / 3
         return x, y, z
 
+    def get_bounds(self) -> tuple[tuple[float, float, float], tuple[float, float, float]]:
+        return (tuple(min(v[i] for v in self.vertices) for i in range(3)),
+                tuple(max(v[i] for v in self.vertices) for i in range(3)))
+
+    def move(self, position: tuple[float, float, float]) -> None:
+        '''
+        Translate the vertices so the center lands on position, the edges and the normal
+        do not change.
+        '''
+        offset = pm.sub3(position, self.position)
+        self.vertices = tuple(pm.add3(v, offset) for v in self.vertices)
+        self.face = self.vertices[0] + self.edge1 + self.edge2 + self.normal
+        self.position = position
+        self.update_bounds()
+
+    def texture_density(self) -> float:
+        # The texture coordinates are barycentric, half the texture over the triangle
+        return math.sqrt(0.5 / self.area) if self.area > 0 else 0.0
+
     def ray_intersect(self, origin: tuple[float, float, float], direction: tuple[float, float, float]) -> bool:
         '''
         Ray intersect method, returns the intercept of the ray with the triangle.
 
         Implementation of Möller-Trumbore intersection algorithm.
         '''
-        epsilon = 0.0001
+        hit = triangle_intersect(*origin, *direction, self.face, 0.0001)
+        if hit is None:
+            return None
 
-        vertex0, vertex1, vertex2 = self.vertices
-        edge1 = pm.subtract(vertex1, vertex0)
-        edge2 = pm.subtract(vertex2, vertex0)
-        h = pm.cross(direction, edge2)
-        a = pm.dot(edge1, h)
+        t, u, v = hit
+        point = pm.add_scaled(origin, t, direction)
+        u = 1 - u
+        v = 1 - v
+        return Intercept(distance=t, point=point, normal=self.normal, obj=self, texture_coords=(u, v))
 
-        if a > -epsilon and a < epsilon:
-            return None
 
-        f = 1.0 / a
-        s = pm.subtract(origin, vertex0)
-        u = f * pm.dot(s, h)
+class Mesh(object):
+    '''
+    Mesh class
 
-        if u < 0.0 or u > 1.0:
-            return None
+    Triangle mesh of an OBJ file in object space, shared by every Obj placing that file.
 
-        q = pm.cross(s, edge1)
-        v = f * pm.dot(direction, q)
+    The geometry is stored in flat arrays instead of one Triangle per face, together with
+    the invariants of the intersection test, so large models stay compact and rays do not
+    recompute them.
 
-        if v < 0.0 or u + v > 1.0:
-            return None
+    Attributes:
+        vertices (array): Vertex positions, 3 floats per vertex.
+        normals (array): Unit vertex normals, empty when the file has none.
+        uvs (array): Texture coordinates, 2 floats per vertex, empty when the file has none.
+        indices (array): Vertex indices, 3 per triangle.
+        face_data (array): Vertex 0, edge 1, edge 2 and unit normal, 12 floats per triangle.
+        texture_density (float): Texture coordinate units per object space unit, see
+            Shape.texture_density.
+        bvh (BVH): Acceleration structure over the triangles.
+    '''
 
-        t = f * pm.dot(edge2, q)
+    # Floats per triangle in face_data
+    FACE_STRIDE = 12
+
+    def __init__(self, data: MeshData) -> None:
+        self.vertices = data.positions
+        self.normals = array('d')
+        for i in range(0, len(data.normals), 3):
+            self.normals.extend(pm.norm(data.normals[i:i + 3]))
+        self.uvs = data.uvs
+        self.indices = data.indices
+
+        self.face_data = self.compute_face_data(self.vertices, self.indices)
+        self.texture_density = self.compute_texture_density(
+            self.face_data, self.uvs, self.indices)
+        self.bvh = BVH([self.triangle_bounds(i)
+                       for i in range(self.triangle_count)])
+
+    @classmethod
+    def load(cls, filepath: str, cache: MeshCache = None) -> 'Mesh':
+        '''
+        Mesh of an OBJ file. With a cache every file is only loaded and built once.
+        '''
+        key = cache.key(filepath) if cache else None
+        mesh = cache.load(key) if cache else None
 
-        if t > epsilon:
-            point = pm.add(origin, pm.multiply(t, direction))
-            normal = pm.norm(pm.cross(edge1, edge2))
-            u = 1 - u
-            v = 1 - v
-            return Intercept(distance=t, point=point, normal=normal, obj=self, texture_coords=(u, v))
+        if mesh is None:
+            mesh = cls(Obj.load(filepath))
+            if cache:
+                cache.store(key, mesh)
+        return mesh
 
-        return None
+    @property
+    def triangle_count(self) -> int:
+        return len(self.indices) // 3
+
+    @staticmethod
+    def compute_face_data(vertices: array, indices: array) -> array:
+        '''
+        Vertex 0, edges and unit normal of every triangle.
+        '''
+        face_data = array('d')
+        for i in range(0, len(indices), 3):
+            a, b, c = indices[i] * 3, indices[i + 1] * 3, indices[i + 2] * 3
+            v0 = (vertices[a], vertices[a + 1], vertices[a + 2])
+            edge1 = (vertices[b] - v0[0], vertices[b + 1] -
+                     v0[1], vertices[b + 2] - v0[2])
+            edge2 = (vertices[c] - v0[0], vertices[c + 1] -
+                     v0[1], vertices[c + 2] - v0[2])
+            face_data.extend(v0)
+            face_data.extend(edge1)
+            face_data.extend(edge2)
+            face_data.extend(pm.norm(pm.cross(edge1, edge2)))
+        return face_data
+
+    @staticmethod
+    def compute_texture_density(face_data: array, uvs: array, indices: array) -> float:
+        '''
+        Square root of the texture area over the surface area of the triangles. Without
+        texture coordinates every triangle covers half of the texture, see Obj.surface.
+        '''
+        area = 0.0
+        uv_area = 0.0
+        for i in range(0, len(indices), 3):
+            k = i // 3 * Mesh.FACE_STRIDE
+            area += pm.length3(pm.cross(face_data[k + 3:k + 6], face_data[k + 6:k + 9])) / 2
+            if uvs:
+                a, b, c = indices[i] * 2, indices[i + 1] * 2, indices[i + 2] * 2
+                uv_area += abs((uvs[b] - uvs[a]) * (uvs[c + 1] - uvs[a + 1]) -
+                               (uvs[c] - uvs[a]) * (uvs[b + 1] - uvs[a + 1])) / 2
+            else:
+                uv_area += 0.5
+        return math.sqrt(uv_area / area) if area > 0 else 0.0
+
+    def triangle_vertices(self, i: int) -> tuple[tuple[float, float, float], tuple[float, float, float], tuple[float, float, float]]:
+        vertices = self.vertices
+        return tuple(tuple(vertices[j * 3:j * 3 + 3]) for j in self.indices[i * 3:i * 3 + 3])
+
+    def triangle_bounds(self, i: int) -> tuple[tuple[float, float, float], tuple[float, float, float]]:
+        triangle = self.triangle_vertices(i)
+        return (tuple(min(v[k] for v in triangle) for k in range(3)),
+                tuple(max(v[k] for v in triangle) for k in range(3)))
+
+    def intersect(self, origin: tuple[float, float, float], direction: tuple[float, float, float]) -> 'TriangleHit | None':
+        '''
+        Closest triangle hit by the ray.
+
+        Traverses the BVH and runs Möller-Trumbore on the precomputed face data of the
+        triangles in the visited leaves.
+
+        Rays come in object space with unnormalized directions, so the parallel test uses
+        the angle between the ray and the face normal instead of the determinant, which
+        scales with the size of the model.
+        '''
+        face_data = self.face_data
+        stride = self.FACE_STRIDE
+        ox, oy, oz = origin
+        dx, dy, dz = direction
+        parallel = 0.0001 * pm.length3(direction)
+
+        def hit_fn(i, origin, direction):
+            k = i * stride
+            hit = triangle_intersect(
+                ox, oy, oz, dx, dy, dz, face_data[k:k + 12], parallel)
+            if hit is None:
+                return None
+            return TriangleHit(hit[0], i, hit[1], hit[2])
+
+        return self.bvh.intersect(origin, direction, hit_fn)
+
+    def occluded(self, origin: tuple[float, float, float], direction: tuple[float, float, float], max_distance: float = float('inf')) -> bool:
+        '''
+        Any-hit version of intersect, stops at the first triangle closer than max_distance.
+        '''
+        face_data = self.face_data
+        stride = self.FACE_STRIDE
+        ox, oy, oz = origin
+        dx, dy, dz = direction
+        parallel = 0.0001 * pm.length3(direction)
+
+        def hit_fn(i, origin, direction):
+            k = i * stride
+            hit = triangle_intersect(
+                ox, oy, oz, dx, dy, dz, face_data[k:k + 12], parallel)
+            return hit is not None and hit[0] < max_distance
+
+        return self.bvh.occluded(origin, direction, hit_fn, max_distance)
 
 
 class Obj(Shape):
@@ -289,44 +575,72 @@ class Obj(Shape):
 
     This class represents an OBJ (.obj) model.
 
+    Every placement of a model is an instance of the shared object space Mesh of its file.
+    Rays are transformed into object space with the inverse model matrix instead of
+    transforming the geometry, so memory and load time grow with the unique files only.
+
     Attributes:
         filepath (str): The path to the OBJ file.
         translation (tuple[float, float, float]): The translation of the model.
         rotation (tuple[float, float, float]): The rotation of the model.
         scale (tuple[float, float, float]): The scale of the model.
+        mesh (Mesh): The object space geometry.
+        model_matrix (list[list[float]]): Object to world transform.
+        inverse_matrix (list[list[float]]): World to object transform.
+        normal_matrix (list[list[float]]): Object to world transform of the normals.
     '''
 
+    # Meshes are expensive to intersect, test their bounds first
+    cull = True
+
     def __init__(self, position: tuple[float, float, float],
                  filepath: str,
                  material: Material,
                  rotate: tuple[float, float, float] = (0, 0, 0),
                  scale: tuple[float, float, float] = (1, 1, 1),
+                 cache: MeshCache = None,
                  ) -> None:
         super().__init__(position, material)
-        translate = position
-        self.model_matrix = pm.model_matrix(translate, rotate, scale)
-        self.vertices, self.faces = self.load(filepath)
-        self.triangles = []
-
-        # Create triangles applying transformations
-        for face in self.faces:
-            vertex_count = len(face)
-
-            v0 = self.vertex_shader(
-                self.vertices[face[0] - 1], self.model_matrix)
-            v1 = self.vertex_shader(
-                self.vertices[face[1] - 1], self.model_matrix)
-            v2 = self.vertex_shader(
-                self.vertices[face[2] - 1], self.model_matrix)
-
-            if vertex_count == 3:
-                self.triangles.append(Triangle((v0, v1, v2), self.material))
-
-            elif vertex_count == 4:
-                v3 = self.vertex_shader(
-                    self.vertices[face[3] - 1], self.model_matrix)
-                self.triangles.append(Triangle((v0, v1, v2), self.material))
-                self.triangles.append(Triangle((v0, v2, v3), self.material))
+        self.filepath = filepath
+        self.mesh = Mesh.load(filepath, cache)
+        self.transform(position, rotate, scale)
+
+    def transform(self, position: tuple[float, float, float], rotate: tuple[float, float, float], scale: tuple[float, float, float]) -> None:
+        '''
+        Place the model with a new transform. Only the matrices change, the mesh and its
+        BVH are shared by every transform.
+        '''
+        self.position = position
+        self.translation = position
+        self.rotation = rotate
+        self.scale = scale
+
+        self.model_matrix = pm.model_matrix(position, rotate, scale)
+        self.inverse_matrix = pm.inverse_affine(self.model_matrix)
+        self.normal_matrix = pm.normal_matrix(self.model_matrix)
+        self.update_bounds()
+
+    def move(self, position: tuple[float, float, float]) -> None:
+        self.transform(position, self.rotation, self.scale)
+
+    def texture_density(self) -> float:
+        # Scaling changes the surface area, averaged over the three axes
+        scale = abs(self.scale[0] * self.scale[1] * self.scale[2]) ** (1 / 3)
+        return self.mesh.texture_density / scale if scale > 0 else 0.0
+
+    def get_bounds(self) -> tuple[tuple[float, float, float], tuple[float, float, float]] | None:
+        bounds = self.mesh.bvh.bounds
+        if bounds is None:
+            return None
+
+        # World bounds of the transformed object space box
+        min_bounds, max_bounds = bounds
+        corners = [self.vertex_shader((x, y, z), self.model_matrix)
+                   for x in (min_bounds[0], max_bounds[0])
+                   for y in (min_bounds[1], max_bounds[1])
+                   for z in (min_bounds[2], max_bounds[2])]
+        return (tuple(min(c[k] for c in corners) for k in range(3)),
+                tuple(max(c[k] for c in corners) for k in range(3)))
 
     @staticmethod
     def vertex_shader(vertex: tuple[float, float, float], model_matrix: list[list[float]]):
@@ -344,76 +658,91 @@ class Obj(Shape):
         return vertex
 
     @staticmethod
-    def load(path: str) -> object:
+    def load(path: str) -> MeshData:
         '''
         Load object from path
 
-        This function is used to load object from path. Read an OBJ file and return the vertex and face data.
+        This function is used to load object from path. Read an OBJ file and return its
+        triangles, vertex normals and texture coordinates, see obj_loader.load_obj.
 
         Attributes:
             path (str): The path to the OBJ file.
         '''
-        import re
-
         print('Loading 3D model from: ' + path)
+        return load_obj(path)
 
-        # Initialize lists
-        vertices = []
-        faces = []
-
-        # Open file
-        with open(file=path, mode='r') as file:
-            lines = file.read().splitlines()
-
-        # Read file
-        for line in lines:
-            # Split line
-            try:
-                prefix, data = re.split(r'\s+', line, 1)
-                prefix, data = prefix.strip(), data.strip()
-            except:
-                continue
-
-            # Read vertex
-            if prefix == 'v':
-                vertex = tuple(map(float, data.split(' ')))
-                vertices.append(vertex)
-            # Read face
-            elif prefix == 'f':
-                face = tuple(int(vertex.split('/')[0])
-                             for vertex in data.split(' '))
-                faces.append(face)
-
-        # Return data
-        return vertices, faces
+    def object_ray(self, origin: tuple[float, float, float], direction: tuple[float, float, float]):
+        '''
+        Ray in object space. The direction is not normalized, so distances along the ray
+        are the same in both spaces.
+        '''
+        m = self.inverse_matrix
+        ox, oy, oz = origin
+        dx, dy, dz = direction
+        return ((m[0][0] * ox + m[0][1] * oy + m[0][2] * oz + m[0][3],
+                 m[1][0] * ox + m[1][1] * oy + m[1][2] * oz + m[1][3],
+                 m[2][0] * ox + m[2][1] * oy + m[2][2] * oz + m[2][3]),
+                (m[0][0] * dx + m[0][1] * dy + m[0][2] * dz,
+                 m[1][0] * dx + m[1][1] * dy + m[1][2] * dz,
+                 m[2][0] * dx + m[2][1] * dy + m[2][2] * dz))
 
     def ray_intersect(self, origin: tuple[float, float, float], direction: tuple[float, float, float]) -> bool:
         '''
-        Ray intersect method, returns the intercept of the ray with the triangle.
-
-        Implementation of Möller-Trumbore intersection algorithm.
+        Ray intersect method, returns the closest intercept of the ray with the model.
         '''
-        intersect: Intercept = None
-        t = float('inf')
-        u, v = 0, 0
-
-        for triangle in self.triangles:
-            triangle_intersect = triangle.ray_intersect(origin, direction)
+        hit = self.mesh.intersect(*self.object_ray(origin, direction))
+        if hit is None:
+            return None
+        return self.surface(hit, origin, direction)
 
-            if triangle_intersect is not None:
-                if triangle_intersect.distance < t:
-                    t = triangle_intersect.distance
-                    intersect = triangle_intersect
-                    u, v = triangle_intersect.texture_coords
+    def occludes(self, origin: tuple[float, float, float], direction: tuple[float, float, float], max_distance: float = float('inf')) -> bool:
+        return self.mesh.occluded(*self.object_ray(origin, direction), max_distance)
 
-        if intersect is None:
-            return None
+    def surface(self, hit: 'TriangleHit', origin: tuple[float, float, float], direction: tuple[float, float, float]) -> 'Intercept':
+        '''
+        Intercept of the closest triangle hit, with interpolated vertex normals and texture
+        coordinates when the model has them.
+        '''
+        mesh = self.mesh
+        t, i, u, v = hit
+        w = 1 - u - v
+        a, b, c = mesh.indices[i * 3:i * 3 + 3]
+
+        normals = mesh.normals
+        if normals:
+            normal = tuple(w * normals[a * 3 + k] + u * normals[b * 3 + k] + v * normals[c * 3 + k]
+                           for k in range(3))
+        else:
+            k = i * mesh.FACE_STRIDE
+            normal = tuple(mesh.face_data[k + 9:k + 12])
+        normal = pm.norm3(pm.rotate(normal, self.normal_matrix))
+
+        uvs = mesh.uvs
+        if uvs:
+            s = w * uvs[a * 2] + u * uvs[b * 2] + v * uvs[c * 2]
+            r = w * uvs[a * 2 + 1] + u * uvs[b * 2 + 1] + v * uvs[c * 2 + 1]
+            # OBJ texture coordinates start at the bottom of the image and repeat
+            texture_coords = (s % 1.0, (1 - r) % 1.0)
+        else:
+            texture_coords = (1 - u, 1 - v)
 
-        return Intercept(distance=intersect.distance,
-                         point=intersect.point,
-                         normal=intersect.normal,
+        return Intercept(distance=t,
+                         point=(origin[0] + t * direction[0],
+                                origin[1] + t * direction[1],
+                                origin[2] + t * direction[2]),
+                         normal=normal,
                          obj=self,
-                         texture_coords=(u, v))
+                         texture_coords=texture_coords)
+
+
+class TriangleHit(NamedTuple):
+    '''
+    Closest triangle candidate found while traversing the BVH of an Obj.
+    '''
+    distance: float
+    index: int
+    u: float
+    v: float
 
 
 class Intercept(object):
@@ -0,0 +1,84 @@
+'''
+In-memory framebuffer.
+'''
+
+import struct
+import zlib
+from array import array
+
+
+class Framebuffer(object):
+    '''
+    Framebuffer class
+
+    RGB framebuffer stored as a contiguous uint8 buffer, rows top to bottom. It does not
+    depend on a display, so frames can be rendered and saved on machines without a window.
+
+    Attributes:
+        width (int): The width of the framebuffer.
+        height (int): The height of the framebuffer.
+        pixels (bytearray): The pixel data, 3 bytes per pixel.
+        shapes (array): Shape seen by the primary ray of each pixel, see Raytracer.shape_id.
+    '''
+
+    def __init__(self, width: int, height: int, clear_color: tuple[int, int, int] = (0, 0, 0)) -> None:
+        self.width = width
+        self.height = height
+        self.pixels = bytearray(width * height * 3)
+        self.shapes = array('I', bytes(4 * width * height))
+        self.clear(clear_color)
+
+    def clear(self, color: tuple[int, int, int]) -> None:
+        self.pixels[:] = bytes(color) * (self.width * self.height)
+        self.shapes[:] = array('I', bytes(4 * self.width * self.height))
+
+    def set_at(self, x: int, y: int, color: tuple[int, int, int]) -> None:
+        i = (y * self.width + x) * 3
+        self.pixels[i:i + 3] = bytes(color)
+
+    def get_at(self, x: int, y: int) -> tuple[int, int, int]:
+        i = (y * self.width + x) * 3
+        return tuple(self.pixels[i:i + 3])
+
+    def set_shape(self, x: int, y: int, shape: int) -> None:
+        self.shapes[y * self.width + x] = shape
+
+    def get_shape(self, x: int, y: int) -> int:
+        return self.shapes[y * self.width + x]
+
+    def fill_rect(self, x: int, y: int, width: int, height: int, color: tuple[int, int, int]) -> None:
+        '''
+        Fill a rectangle, clipped to the framebuffer.
+        '''
+        x_end = min(x + width, self.width)
+        y_end = min(y + height, self.height)
+        x = max(x, 0)
+        y = max(y, 0)
+        if x >= x_end:
+            return
+        row = bytes(color) * (x_end - x)
+        for j in range(y, y_end):
+            i = (j * self.width + x) * 3
+            self.pixels[i:i + len(row)] = row
+
+    def to_png(self) -> bytes:
+        '''
+        Encode the framebuffer as a PNG file.
+        '''
+        def chunk(tag: bytes, data: bytes) -> bytes:
+            return struct.pack('>I', len(data)) + tag + data + \
+                struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+        stride = self.width * 3
+        # Each scanline is prefixed with filter type 0 (None)
+        raw = b''.join(b'\x00' + bytes(self.pixels[y * stride:(y + 1) * stride])
+                       for y in range(self.height))
+
+        header = struct.pack('>IIBBBBB', self.width,
+                             self.height, 8, 2, 0, 0, 0)
+        return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + \
+            chunk(b'IDAT', zlib.compress(raw, 6)) + chunk(b'IEND', b'')
+
+    def save(self, path: str) -> None:
+        with open(path, 'wb') as f:
+            f.write(self.to_png())
@@ -1,13 +1,8 @@
+import numpy as np
+
 from figures import Intercept
 import pmath as pm
-
-
-def calculate_reflect_vector(vector: tuple[float, float, float], normal: tuple[float, float, float]) -> tuple[float, float, float]:
-    reflect = 2 * pm.dot(vector, normal)
-    reflect = pm.multiply(reflect, normal)
-    reflect = pm.subtract(reflect, vector)
-    reflect = pm.norm(reflect)
-    return reflect
+import pmath_batch as pb
 
 
 class Light:
@@ -16,25 +11,66 @@ class Light:
 
     This class represents a light.
 
+    Invariants of the shading are computed once when the light is created.
+
     Attributes:
         intensity (float): The intensity of the light.
         color (tuple[float, float, float]): The color of the light.
+        radiance (tuple[float, float, float]): The color scaled by the intensity.
     '''
 
+    # Whether shade needs a shadow ray, see shadow_ray
+    casts_shadows = False
+
     def __init__(self, intensity: float = 1,  color: tuple[float, float, float] = (1, 1, 1), light_type: str = None) -> None:
-        self.intensity = intensity
         self.color = color
         self.light_type = light_type
+        self.set_intensity(intensity)
+
+    def set_intensity(self, intensity: float) -> None:
+        self.intensity = intensity
+        self.radiance = tuple([intensity * c for c in self.color])
 
     def get_light_color(self) -> tuple[float, float, float]:
-        return tuple([self.intensity * c for c in self.color])
+        return self.radiance
 
-    def get_diffuse_color(self, intercept: Intercept) -> tuple[float, float, float]:
+    def shadow_ray(self, point: tuple[float, float, float]) -> tuple[tuple[float, float, float], float] | None:
+        '''
+        Direction from the point to the light and the distance to it, None for lights that
+        can not be blocked.
+        '''
         return None
 
-    def get_specular_color(self, intercept: Intercept, view_position) -> tuple[float, float, float]:
+    def shade(self, intercept: Intercept, view_direction: tuple[float, float, float], shadow_ray: tuple[tuple[float, float, float], float] = None) -> tuple[tuple[float, float, float], tuple[float, float, float]]:
+        '''
+        Diffuse and specular color of the light at the intercept.
+
+        view_direction is the normalized direction from the intercept to the viewer, and
+        shadow_ray the result of shadow_ray for the intercept point when already computed.
+        '''
+        return (0, 0, 0), (0, 0, 0)
+
+    def shadow_rays(self, points: np.ndarray) -> tuple[np.ndarray, np.ndarray] | None:
+        '''
+        Batched shadow_ray for an (N, 3) array of points.
+        '''
         return None
 
+    def shade_batch(self, normals: np.ndarray, view_directions: np.ndarray, material, shadow_rays: tuple[np.ndarray, np.ndarray] = None) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Batched shade for (N, 3) arrays of normals and view directions of points sharing a
+        material, returns (N, 3) arrays of the diffuse and specular colors.
+        '''
+        zero = np.zeros((len(normals), 3))
+        return zero, zero
+
+    def get_diffuse_color(self, intercept: Intercept) -> tuple[float, float, float]:
+        return self.shade(intercept, None)[0]
+
+    def get_specular_color(self, intercept: Intercept, view_position) -> tuple[float, float, float]:
+        view_direction = pm.norm3(pm.sub3(view_position, intercept.point))
+        return self.shade(intercept, view_direction)[1]
+
 
 class AmbientLight(Light):
     '''
@@ -50,6 +86,13 @@ class AmbientLight(Light):
     def __init__(self, intensity: float = 1, color: tuple[float, float, float] = (1, 1, 1)) -> None:
         super().__init__(intensity, color, "ambient")
 
+    def shade(self, intercept: Intercept, view_direction: tuple[float, float, float], shadow_ray: tuple[tuple[float, float, float], float] = None) -> tuple[tuple[float, float, float], tuple[float, float, float]]:
+        return self.radiance, (0, 0, 0)
+
+    def shade_batch(self, normals: np.ndarray, view_directions: np.ndarray, material, shadow_rays: tuple[np.ndarray, np.ndarray] = None) -> tuple[np.ndarray, np.ndarray]:
+        count = len(normals)
+        return np.tile(np.asarray(self.radiance, dtype=float), (count, 1)), np.zeros((count, 3))
+
 
 class DirectionalLight(Light):
     '''
@@ -61,40 +104,64 @@ class DirectionalLight(Light):
         intensity (float): The intensity of the light.
         color (tuple[float, float, float]): The color of the light.
         direction (tuple[float, float, float]): The direction of the light.
+        to_light (tuple[float, float, float]): The opposite of the direction.
     '''
 
+    casts_shadows = True
+
     def __init__(self, intensity: float = 1, color: tuple[float, float, float] = (1, 1, 1), direction: tuple[float, float, float] = (0, -1, 0)) -> None:
         super().__init__(intensity, color, "directional")
-        self.direction = pm.norm(direction)
+        self.set_direction(direction)
 
-    def get_diffuse_color(self, intercept: Intercept) -> tuple[float, float, float]:
-        direction = [i*-1 for i in self.direction]
+    def set_direction(self, direction: tuple[float, float, float]) -> None:
+        self.direction = pm.norm3(direction)
+        self.to_light = pm.scale3(-1, self.direction)
+
+    def shadow_ray(self, point: tuple[float, float, float]) -> tuple[tuple[float, float, float], float]:
+        return self.to_light, float('inf')
 
-        intensity = pm.dot(intercept.normal, direction) * self.intensity
+    def shade(self, intercept: Intercept, view_direction: tuple[float, float, float], shadow_ray: tuple[tuple[float, float, float], float] = None) -> tuple[tuple[float, float, float], tuple[float, float, float]]:
+        material = intercept.obj.material
+        normal = intercept.normal
+        to_light = self.to_light
+        r, g, b = self.color
+
+        intensity = pm.dot3(normal, to_light) * self.intensity
         intensity = max(0, min(1, intensity))
-        intensity *= 1 - intercept.obj.material.ks
+        intensity *= material.diffuse_factor
+        diffuse_color = (intensity * r, intensity * g, intensity * b)
 
-        diffuse_color = tuple([intensity * c for c in self.color])
+        if view_direction is None or material.ks == 0:
+            return diffuse_color, (0, 0, 0)
 
-        return diffuse_color
+        reflect_vector = pm.reflect_vector(to_light, normal)
+        specular_intensity = max(
+            0, pm.dot3(view_direction, reflect_vector)) ** material.specular
+        specular_intensity *= material.ks
 
-    def get_specular_color(self, intercept: Intercept, view_position: tuple[float, float, float]) -> tuple[float, float, float]:
-        direction = [i*-1 for i in self.direction]
+        r, g, b = self.radiance
+        return diffuse_color, (specular_intensity * r, specular_intensity * g, specular_intensity * b)
 
-        reflect_vector = calculate_reflect_vector(direction, intercept.normal)
+    def shadow_rays(self, points: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        count = len(points)
+        return np.tile(np.asarray(self.to_light, dtype=float), (count, 1)), np.full(count, np.inf)
 
-        view_direction = pm.subtract(view_position, intercept.point)
-        view_direction = pm.norm(view_direction)
+    def shade_batch(self, normals: np.ndarray, view_directions: np.ndarray, material, shadow_rays: tuple[np.ndarray, np.ndarray] = None) -> tuple[np.ndarray, np.ndarray]:
+        to_light = np.asarray(self.to_light, dtype=float)
 
-        specular_intensity = max(
-            0, pm.dot(view_direction, reflect_vector)) ** intercept.obj.material.specular
+        intensity = np.clip(pb.dot(normals, to_light) * self.intensity, 0, 1)
+        intensity *= material.diffuse_factor
+        diffuse_color = intensity[:, None] * np.asarray(self.color, dtype=float)
 
-        specular_intensity *= intercept.obj.material.ks
-        specular_intensity *= self.intensity
+        if view_directions is None or material.ks == 0:
+            return diffuse_color, np.zeros_like(diffuse_color)
 
-        specular_color = tuple([specular_intensity * c for c in self.color])
+        reflect_vectors = pb.reflect(-to_light, normals)
+        specular_intensity = np.maximum(
+            0, pb.dot(view_directions, reflect_vectors)) ** material.specular
+        specular_intensity *= material.ks
 
-        return specular_color
+        return diffuse_color, specular_intensity[:, None] * np.asarray(self.radiance, dtype=float)
 
 
 class PointLight(Light):
@@ -109,51 +176,64 @@ class PointLight(Light):
         color (tuple[float, float, float]): The color of the light.
     '''
 
+    casts_shadows = True
+
     def __init__(self, point: tuple[float, float, float] = (0, 0, 0), intensity: float = 1, color: tuple[float, float, float] = (1, 1, 1)) -> None:
         super().__init__(intensity, color, "point")
         self.point = point
 
-    def get_diffuse_color(self, intercept: Intercept) -> tuple[float, float, float]:
-        direction = pm.subtract(self.point, intercept.point)
-        R = pm.norm_mag(direction)
-        direction = tuple([i/R for i in direction])
+    def shadow_ray(self, point: tuple[float, float, float]) -> tuple[tuple[float, float, float], float]:
+        return pm.direction_to(point, self.point)
 
-        intensity = pm.dot(intercept.normal, direction) * self.intensity
-        intensity *= 1 - intercept.obj.material.ks
+    def shade(self, intercept: Intercept, view_direction: tuple[float, float, float], shadow_ray: tuple[tuple[float, float, float], float] = None) -> tuple[tuple[float, float, float], tuple[float, float, float]]:
+        material = intercept.obj.material
+        normal = intercept.normal
+        direction, R = shadow_ray or pm.direction_to(
+            intercept.point, self.point)
+        r, g, b = self.color
 
         # inverse squares law
-        if R != 0:
-            intensity /= R**2
-        intensity = max(0, min(1, intensity))
+        attenuation = self.intensity / (R * R) if R != 0 else self.intensity
 
-        diffuse_color = tuple([intensity * c for c in self.color])
+        intensity = pm.dot3(normal, direction) * material.diffuse_factor
+        intensity = max(0, min(1, intensity * attenuation))
+        diffuse_color = (intensity * r, intensity * g, intensity * b)
 
-        return diffuse_color
+        if view_direction is None or material.ks == 0:
+            return diffuse_color, (0, 0, 0)
 
-    def get_specular_color(self, intercept: Intercept, view_position: tuple[float, float, float]) -> tuple[float, float, float]:
-        direction = pm.subtract(self.point, intercept.point)
-        R = pm.norm_mag(direction)
-        direction = tuple([i/R for i in direction])
-
-        reflect_vector = calculate_reflect_vector(direction, intercept.normal)
+        reflect_vector = pm.reflect_vector(direction, normal)
+        specular_intensity = max(
+            0, pm.dot3(view_direction, reflect_vector)) ** material.specular
+        specular_intensity = max(
+            0, min(1, specular_intensity * material.ks * attenuation))
 
-        view_direction = pm.subtract(view_position, intercept.point)
-        view_direction = tuple(
-            [i/pm.norm_mag(view_direction) for i in view_direction])
+        return diffuse_color, (specular_intensity * r, specular_intensity * g, specular_intensity * b)
 
-        specular_intensity = max(
-            0, pm.dot(view_direction, reflect_vector)) ** intercept.obj.material.specular
+    def shadow_rays(self, points: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        return pb.direction_to(points, np.asarray(self.point, dtype=float))
 
-        specular_intensity *= intercept.obj.material.ks
-        specular_intensity *= self.intensity
+    def shade_batch(self, normals: np.ndarray, view_directions: np.ndarray, material, shadow_rays: tuple[np.ndarray, np.ndarray] = None) -> tuple[np.ndarray, np.ndarray]:
+        directions, R = shadow_rays
+        color = np.asarray(self.color, dtype=float)
 
         # inverse squares law
-        if R != 0:
-            specular_intensity /= R**2
-        specular_intensity = max(0, min(1, specular_intensity))
+        with np.errstate(divide='ignore'):
+            attenuation = np.where(R != 0, self.intensity / (R * R), self.intensity)
+
+        intensity = pb.dot(normals, directions) * material.diffuse_factor
+        intensity = np.clip(intensity * attenuation, 0, 1)
+        diffuse_color = intensity[:, None] * color
+
+        if view_directions is None or material.ks == 0:
+            return diffuse_color, np.zeros_like(diffuse_color)
 
-        specular_color = tuple([specular_intensity * c for c in self.color])
+        reflect_vectors = pb.reflect(-directions, normals)
+        specular_intensity = np.maximum(
+            0, pb.dot(view_directions, reflect_vectors)) ** material.specular
+        specular_intensity = np.clip(
+            specular_intensity * material.ks * attenuation, 0, 1)
 
-        return specular_color
+        return diffuse_color, specular_intensity[:, None] * color
 
 # TODO: Add SpotLight class
@@ -19,6 +19,7 @@ class Material:
         diffuse (tuple[float, float, float]): The diffuse color of the material.
         albedo (tuple[float, float, float]): The albedo of the material.
         specular_exponent (float): The specular exponent of the material.
+        diffuse_factor (float): 1 - ks, share of the light left for the diffuse term.
     '''
 
     def __init__(self, diffuse: tuple[float, float, float] = (1, 1, 1), specular: float = 1.0, ks: float = 0.0, material_type: int = material_types['OPAQUE'], texture=None, ior: float = 1.0) -> None:
@@ -28,3 +29,6 @@ class Material:
         self.material_type = material_type
         self.texture = texture
         self.ior = ior
+
+        # Share of the light left for the diffuse term
+        self.diffuse_factor = 1 - ks
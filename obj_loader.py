@@ -0,0 +1,145 @@
+'''
+Streaming OBJ loader.
+
+Reads the file line by line into packed arrays. Positions, texture coordinates and normals
+are collected as tokens and converted in one pass, faces are fan triangulated and every
+distinct (position, texture coordinate, normal) corner becomes a single output vertex.
+'''
+
+from array import array
+
+
+class MeshData(object):
+    '''
+    MeshData class
+
+    Triangle mesh read from an OBJ file, in object space.
+
+    Attributes:
+        positions (array): Vertex positions, 3 floats per vertex.
+        normals (array): Vertex normals, 3 floats per vertex. Empty unless every vertex has one.
+        uvs (array): Texture coordinates, 2 floats per vertex. Empty unless every vertex has one.
+        indices (array): Vertex indices, 3 per triangle.
+    '''
+
+    def __init__(self, positions: array, normals: array, uvs: array, indices: array) -> None:
+        self.positions = positions
+        self.normals = normals
+        self.uvs = uvs
+        self.indices = indices
+
+    @property
+    def vertex_count(self) -> int:
+        return len(self.positions) // 3
+
+    @property
+    def triangle_count(self) -> int:
+        return len(self.indices) // 3
+
+
+def resolve(token: str, counts: tuple[int, int, int]) -> tuple[int, int, int]:
+    '''
+    Zero based (position, texture coordinate, normal) indices of a face corner such as
+    "3", "3/1", "3//2" or "-1/-1/-1". Missing indices are -1, indices outside of the lists
+    read so far raise ValueError.
+    '''
+    resolved = []
+    for k, part in enumerate(token.split('/')[:3]):
+        if not part:
+            resolved.append(-1)
+            continue
+        index = int(part)
+        # Negative indices are relative to the end of the current list
+        resolved_index = index - 1 if index > 0 else counts[k] + index
+        if not 0 <= resolved_index < counts[k]:
+            raise ValueError(f"index {part} out of range, {counts[k]} defined")
+        resolved.append(resolved_index)
+    while len(resolved) < 3:
+        resolved.append(-1)
+    return tuple(resolved)
+
+
+def load_obj(path: str) -> MeshData:
+    '''
+    Read the triangles of an OBJ file. Malformed vertices and faces raise ValueError with
+    the line number.
+    '''
+    positions = []
+    uvs = []
+    normals = []
+
+    # Face corner token and resolved indices -> output vertex
+    corner_index: dict[str, int] = {}
+    vertex_index: dict[tuple[int, int, int], int] = {}
+    vertices: list[tuple[int, int, int]] = []
+    indices = array('l')
+
+    def corner(token: str) -> int:
+        key = resolve(token, (len(positions) // 3,
+                              len(uvs) // 2, len(normals) // 3))
+        index = vertex_index.get(key)
+        if index is None:
+            index = len(vertices)
+            vertex_index[key] = index
+            vertices.append(key)
+        # Relative tokens point to different vertices on every line
+        if '-' not in token:
+            corner_index[token] = index
+        return index
+
+    with open(path, 'r') as file:
+        for number, line in enumerate(file, 1):
+            tokens = line.split()
+            if not tokens:
+                continue
+            prefix = tokens[0]
+
+            if prefix == 'v':
+                if len(tokens) < 4:
+                    raise ValueError(
+                        f"{path}:{number}: vertex with fewer than 3 coordinates")
+                positions.extend(tokens[1:4])
+            elif prefix == 'f':
+                corners = [corner_index.get(token) for token in tokens[1:]]
+                if None in corners:
+                    try:
+                        corners = [corner(token) if index is None else index
+                                   for token, index in zip(tokens[1:], corners)]
+                    except ValueError as e:
+                        raise ValueError(f"{path}:{number}: bad face, {e}") from None
+
+                if len(corners) == 3:
+                    indices.extend(corners)
+                else:
+                    # Fan triangulation, exact for convex polygons
+                    first = corners[0]
+                    for k in range(1, len(corners) - 1):
+                        indices.extend((first, corners[k], corners[k + 1]))
+            elif prefix == 'vt':
+                uv = tokens[1:3]
+                uvs.extend(uv if len(uv) == 2 else (uv[0], '0'))
+            elif prefix == 'vn':
+                if len(tokens) < 4:
+                    raise ValueError(
+                        f"{path}:{number}: normal with fewer than 3 coordinates")
+                normals.extend(tokens[1:4])
+
+    positions = array('d', map(float, positions))
+    uvs = array('d', map(float, uvs))
+    normals = array('d', map(float, normals))
+
+    mesh_positions = array('d')
+    for v, _, _ in vertices:
+        mesh_positions.extend(positions[v * 3:v * 3 + 3])
+
+    mesh_uvs = array('d')
+    if uvs and all(vt >= 0 for _, vt, _ in vertices):
+        for _, vt, _ in vertices:
+            mesh_uvs.extend(uvs[vt * 2:vt * 2 + 2])
+
+    mesh_normals = array('d')
+    if normals and all(vn >= 0 for _, _, vn in vertices):
+        for _, _, vn in vertices:
+            mesh_normals.extend(normals[vn * 3:vn * 3 + 3])
+
+    return MeshData(mesh_positions, mesh_normals, mesh_uvs, indices)
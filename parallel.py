@@ -0,0 +1,52 @@
+'''
+Process pool tile renderer.
+
+The raytracer (shapes, materials, lights and camera) is shipped once to every worker of the
+pool, tiles are then pulled by idle workers and their pixel colors returned to the parent.
+'''
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Raytracer of the current worker process, set once by init_worker
+worker_raytracer = None
+
+
+def init_worker(raytracer) -> None:
+    global worker_raytracer
+    worker_raytracer = raytracer
+    if raytracer.profiler is not None:
+        raytracer.profiler.reset()
+
+
+def render_tile(tile: tuple[int, int, int, int]):
+    '''
+    Render a tile in a worker, returns the tile, its colors and shape ids in column order
+    (see Raytracer.tile_samples), its profile data when profiling and the seconds it took.
+    '''
+    start = time.perf_counter()
+    colors, shapes = worker_raytracer.tile_samples(tile)
+    profiler = worker_raytracer.profiler
+    seconds = time.perf_counter() - start
+    return tile, colors, shapes, profiler.take(tile) if profiler is not None else None, seconds
+
+
+def worker_count(workers: int | None = None) -> int:
+    return workers if workers else os.cpu_count() or 1
+
+
+def render_processes(raytracer, tiles: list[tuple[int, int, int, int]], workers: int | None = None):
+    '''
+    Render the tiles in a process pool, yielding (tile, colors, shapes, profile, seconds)
+    as tiles finish.
+
+    Tiles are submitted individually and in order so idle workers pick up the next pending
+    tile, which balances expensive tiles (meshes, glass) against cheap background ones.
+    '''
+    with ProcessPoolExecutor(max_workers=worker_count(workers),
+                             initializer=init_worker,
+                             initargs=(raytracer,)) as executor:
+        futures = [executor.submit(render_tile, tile) for tile in tiles]
+        for future in as_completed(futures):
+            yield future.result()
@@ -59,6 +59,71 @@ def cross(v1: tuple[float, float, float], v2: tuple[float, float, float]) -> tup
             v1[0] * v2[1] - v1[1] * v2[0])
 
 
+# 3-component fast paths. The functions above accept vectors of any length, these unroll
+# the arithmetic for 3-vectors and are used by the intersection and shading hot paths.
+# They evaluate the same operations in the same order, squares aside (x * x is rounded once
+# where x ** 2 goes through pow), so results match to the last bit or so.
+
+def add3(v1: tuple[float, float, float], v2: tuple[float, float, float]) -> tuple[float, float, float]:
+    return (v1[0] + v2[0], v1[1] + v2[1], v1[2] + v2[2])
+
+
+def sub3(v1: tuple[float, float, float], v2: tuple[float, float, float]) -> tuple[float, float, float]:
+    return (v1[0] - v2[0], v1[1] - v2[1], v1[2] - v2[2])
+
+
+def dot3(v1: tuple[float, float, float], v2: tuple[float, float, float]) -> float:
+    return v1[0] * v2[0] + v1[1] * v2[1] + v1[2] * v2[2]
+
+
+def scale3(scalar: float, v: tuple[float, float, float]) -> tuple[float, float, float]:
+    return (scalar * v[0], scalar * v[1], scalar * v[2])
+
+
+def length3(v: tuple[float, float, float]) -> float:
+    return math.sqrt(v[0] * v[0] + v[1] * v[1] + v[2] * v[2])
+
+
+def norm3(v: tuple[float, float, float]) -> tuple[float, float, float]:
+    x, y, z = v
+    magnitude = math.sqrt(x * x + y * y + z * z)
+    if magnitude == 0:
+        return v
+    return (x / magnitude, y / magnitude, z / magnitude)
+
+
+def add_scaled(v1: tuple[float, float, float], scalar: float, v2: tuple[float, float, float]) -> tuple[float, float, float]:
+    '''
+    v1 + scalar * v2, e.g. the point at distance t along a ray.
+    '''
+    return (v1[0] + scalar * v2[0], v1[1] + scalar * v2[1], v1[2] + scalar * v2[2])
+
+
+def reflect(direction: tuple[float, float, float], normal: tuple[float, float, float]) -> tuple[float, float, float]:
+    '''
+    Normalized reflection of a ray direction (pointing to the surface) about the normal,
+    same as reflect_vector of the opposite direction.
+    '''
+    k = 2 * (direction[0] * normal[0] + direction[1]
+             * normal[1] + direction[2] * normal[2])
+    return norm3((direction[0] - k * normal[0],
+                  direction[1] - k * normal[1],
+                  direction[2] - k * normal[2]))
+
+
+def direction_to(origin: tuple[float, float, float], target: tuple[float, float, float]) -> tuple[tuple[float, float, float], float]:
+    '''
+    Normalized direction from origin to target and the distance between them.
+    '''
+    x = target[0] - origin[0]
+    y = target[1] - origin[1]
+    z = target[2] - origin[2]
+    distance = math.sqrt(x * x + y * y + z * z)
+    if distance == 0:
+        return (x, y, z), distance
+    return (x / distance, y / distance, z / distance), distance
+
+
 def reflect_vector(vector: tuple[float, float, float], normal: tuple[float, float, float]) -> tuple[float, float, float]:
     '''
     Calculate the reflected vector.
@@ -67,11 +132,10 @@ def reflect_vector(vector: tuple[float, float, float], normal: tuple[float, floa
         vector (tuple[float, float, float]): The incident vector.
         normal (tuple[float, float, float]): The normal vector.
     '''
-    reflect = 2 * dot(vector, normal)
-    reflect = multiply(reflect, normal)
-    reflect = subtract(reflect, vector)
-    reflect = norm(reflect)
-    return reflect
+    k = 2 * dot3(vector, normal)
+    return norm3((k * normal[0] - vector[0],
+                  k * normal[1] - vector[1],
+                  k * normal[2] - vector[2]))
 
 
 def refract_vector(vector: tuple[float, float, float], normal: tuple[float, float, float], n1: float, n2: float) -> tuple[float, float, float]:
@@ -84,24 +148,21 @@ def refract_vector(vector: tuple[float, float, float], normal: tuple[float, floa
         n1 (float): The index of refraction of the external medium.
         n2 (float): The index of refraction of the internal medium.
     '''
-    c1 = dot(normal, vector)
+    c1 = dot3(normal, vector)
 
     if c1 < 0:
         c1 = -c1
     else:
-        normal = multiply(-1, normal)
+        normal = (-normal[0], -normal[1], -normal[2])
         n1, n2 = n2, n1
 
     n = n1 / n2
+    k = math.sqrt(1 - n * n * (1 - c1 * c1))
 
-    part1 = multiply(n, add(vector, multiply(c1, normal)))
-    part2 = multiply(math.sqrt(1 - math.pow(n, 2) *
-                     (1 - math.pow(c1, 2))), normal)
-
-    T = subtract(part1, part2)
-    T = norm(T)
-
-    return T
+    # n * (vector + c1 * normal) - k * normal
+    return norm3((n * (vector[0] + c1 * normal[0]) - k * normal[0],
+                  n * (vector[1] + c1 * normal[1]) - k * normal[1],
+                  n * (vector[2] + c1 * normal[2]) - k * normal[2]))
 
 
 def total_internal_reflection(vector: tuple[float, float, float], normal: tuple[float, float, float], n1: float, n2: float) -> tuple[float, float, float]:
@@ -114,12 +175,11 @@ def total_internal_reflection(vector: tuple[float, float, float], normal: tuple[
         n1 (float): The index of refraction of the external medium.
         n2 (float): The index of refraction of the internal medium.
     '''
-    c1 = dot(normal, vector)
+    c1 = dot3(normal, vector)
 
     if c1 < 0:
         c1 = -c1
     else:
-        normal = multiply(-1, normal)
         n1, n2 = n2, n1
 
     if n1 < n2:
@@ -139,22 +199,21 @@ def fresnel(vector: tuple[float, float, float], normal: tuple[float, float, floa
         n1 (float): The index of refraction of the external medium.
         n2 (float): The index of refraction of the internal medium.
     '''
-    c1 = dot(normal, vector)
+    c1 = dot3(normal, vector)
 
     if c1 < 0:
         c1 = -c1
     else:
-        normal = multiply(-1, normal)
         n1, n2 = n2, n1
 
-    s2 = (n1 * math.sqrt(1 - math.pow(c1, 2))) / n2
-    c2 = math.sqrt(1 - math.pow(s2, 2))
+    s2 = (n1 * math.sqrt(1 - c1 * c1)) / n2
+    c2 = math.sqrt(1 - s2 * s2)
 
     F1 = (n2*c1 - n1*c2) / (n2*c1 + n1*c2)
-    F1 = math.pow(F1, 2)
+    F1 = F1 * F1
 
     F2 = (n1*c2 - n2*c1) / (n1*c2 + n2*c1)
-    F2 = math.pow(F2, 2)
+    F2 = F2 * F2
 
     Kr = (F1 + F2) / 2
     Kt = 1 - Kr
@@ -246,6 +305,52 @@ def scale_matrix(scale: tuple[float, float, float]) -> list[list[float]]:
     ]
 
 
+def cofactor_matrix(matrix: list[list[float]]) -> tuple[list[list[float]], float]:
+    '''
+    Cofactor matrix and determinant of the upper 3x3 part of a matrix.
+    '''
+    (a, b, c), (d, e, f), (g, h, i) = (row[:3] for row in matrix[:3])
+
+    cofactors = [
+        [e*i - f*h, f*g - d*i, d*h - e*g],
+        [c*h - b*i, a*i - c*g, b*g - a*h],
+        [b*f - c*e, c*d - a*f, a*e - b*d]
+    ]
+    determinant = a * cofactors[0][0] + b * cofactors[0][1] + c * cofactors[0][2]
+
+    return cofactors, determinant
+
+
+def normal_matrix(matrix: list[list[float]]) -> list[list[float]]:
+    '''
+    Normal matrix of a model matrix
+
+    Inverse transpose of the upper 3x3 part, up to a positive scale since transformed normals
+    are normalized. Keeps normals perpendicular to their surface under non-uniform scaling.
+    '''
+    cofactors, determinant = cofactor_matrix(matrix)
+
+    # The sign of the determinant keeps the normals facing outwards for mirroring scales
+    sign = -1 if determinant < 0 else 1
+
+    return [[sign * x for x in row] for row in cofactors]
+
+
+def inverse_affine(matrix: list[list[float]]) -> list[list[float]]:
+    '''
+    Inverse of an affine 4x4 matrix such as a model matrix.
+    '''
+    cofactors, determinant = cofactor_matrix(matrix)
+
+    # Inverse of the linear part := transpose(cofactors) / determinant
+    linear = [[cofactors[j][i] / determinant for j in range(3)]
+              for i in range(3)]
+    translation = [matrix[i][3] for i in range(3)]
+
+    return [row + [-sum(row[j] * translation[j] for j in range(3))] for row in linear] + \
+        [[0, 0, 0, 1]]
+
+
 def multiply_mm(matrix1: list[list[float]], matrix2: list[list[float]]) -> list[list[float]]:
     '''
     Multiply two matrices
@@ -0,0 +1,100 @@
+'''
+Batch vector math on NumPy arrays.
+
+Row-wise versions of the 3-component functions of pmath, every vector argument is an (N, 3)
+array or a single 3-vector broadcast against the others.
+'''
+
+import numpy as np
+
+
+def dot(v1: np.ndarray, v2: np.ndarray) -> np.ndarray:
+    '''
+    Row-wise dot product.
+    '''
+    return np.einsum('...j,...j->...', v1, v2)
+
+
+def length(v: np.ndarray) -> np.ndarray:
+    return np.sqrt(dot(v, v))
+
+
+def normalize(v: np.ndarray) -> np.ndarray:
+    '''
+    Normalize an (N, 3) array of vectors or a single 3-vector, zero vectors are returned
+    unchanged.
+    '''
+    magnitude = length(v)[..., None]
+    return v / np.where(magnitude == 0, 1, magnitude)
+
+
+def add_scaled(v1: np.ndarray, scalars: np.ndarray, v2: np.ndarray) -> np.ndarray:
+    '''
+    v1 + scalars * v2 for every row, e.g. the points at distances t along rays.
+    '''
+    return v1 + np.asarray(scalars)[..., None] * v2
+
+
+def reflect(directions: np.ndarray, normals: np.ndarray) -> np.ndarray:
+    '''
+    Normalized reflections of ray directions (pointing to the surface) about the normals.
+    '''
+    return normalize(directions - 2 * dot(directions, normals)[..., None] * normals)
+
+
+def direction_to(origins: np.ndarray, targets: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Normalized directions from origins to targets and the distances between them.
+    '''
+    difference = targets - origins
+    distance = length(difference)
+    safe = np.where(distance == 0, 1, distance)
+    return difference / safe[..., None], distance
+
+
+def incidence(vectors: np.ndarray, normals: np.ndarray, n1: float, n2: float) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Cosine of the incidence angle of every row and the normals and indices of refraction
+    seen from the side the vector comes from, like the scalar refraction functions of pmath.
+    '''
+    c1 = dot(normals, vectors)
+    inside = c1 >= 0
+    sign = np.where(inside, -1.0, 1.0)
+    return np.abs(c1), normals * sign[..., None], np.where(inside, n2, n1), np.where(inside, n1, n2)
+
+
+def refract_vector(vectors: np.ndarray, normals: np.ndarray, n1: float, n2: float) -> np.ndarray:
+    '''
+    Row-wise refracted vectors using Snell's law, rows with total internal reflection are
+    nan.
+    '''
+    c1, normals, n1, n2 = incidence(vectors, normals, n1, n2)
+    n = n1 / n2
+    with np.errstate(invalid='ignore'):
+        k = np.sqrt(1 - n * n * (1 - c1 * c1))
+    return normalize(n[..., None] * (vectors + c1[..., None] * normals) - k[..., None] * normals)
+
+
+def total_internal_reflection(vectors: np.ndarray, normals: np.ndarray, n1: float, n2: float) -> np.ndarray:
+    '''
+    Row-wise mask of the vectors reflected entirely.
+    '''
+    c1, _, n1, n2 = incidence(vectors, normals, n1, n2)
+    with np.errstate(invalid='ignore'):
+        critical = np.arcsin(np.minimum(n2 / n1, 1))
+    return (n1 >= n2) & (np.arccos(np.minimum(c1, 1)) >= critical)
+
+
+def fresnel(vectors: np.ndarray, normals: np.ndarray, n1: float, n2: float) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Row-wise Fresnel coefficients (Kr, Kt).
+    '''
+    c1, _, n1, n2 = incidence(vectors, normals, n1, n2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        s2 = (n1 * np.sqrt(np.maximum(1 - c1 * c1, 0))) / n2
+        c2 = np.sqrt(1 - s2 * s2)
+
+        F1 = (n2 * c1 - n1 * c2) / (n2 * c1 + n1 * c2)
+        F2 = (n1 * c2 - n2 * c1) / (n1 * c2 + n2 * c1)
+    Kr = (F1 * F1 + F2 * F2) / 2
+    return Kr, 1 - Kr
@@ -0,0 +1,213 @@
+'''
+Render profiler.
+
+Records where the render time goes: rays and intersection tests per pixel, and totals per
+shape type and material type. Costs can be saved as a heatmap image.
+'''
+
+import threading
+import time
+from array import array
+
+import matplotlib
+
+from framebuffer import Framebuffer
+from materials import material_types
+
+RAY_KINDS = ('primary', 'shadow', 'reflect', 'refract')
+METRICS = ('time', 'tests', 'rays') + RAY_KINDS
+
+material_names = {value: name for name, value in material_types.items()}
+
+
+class Profiler(object):
+    '''
+    Profiler class
+
+    Enabled by setting `Raytracer.profiler`. Every traced pixel records its wall time, the
+    rays cast by kind and the shape intersection tests run by `cast_ray`. Vectorized tiles
+    only record their time, spread evenly over the tile pixels.
+
+    Shading time per material type only covers the local shading of each hit: the light and
+    shadow rays, and spawning the reflection and refraction rays. The secondary rays are traced
+    and shaded on their own, and counted under the materials they hit.
+
+    Attributes:
+        width (int): The width of the profiled image.
+        height (int): The height of the profiled image.
+        rays (dict[str, array]): Rays cast per pixel, by kind.
+        tests (array): Shape intersection tests per pixel.
+        times (array): Wall time per pixel, in seconds.
+        shapes (dict[str, list]): Tests, hits and seconds per shape type.
+        materials (dict[str, list]): Shading calls and seconds per material type.
+    '''
+
+    def __init__(self, width: int, height: int) -> None:
+        self.width = width
+        self.height = height
+        # Pixel being traced by each render thread
+        self.local = threading.local()
+        self.reset()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state['local']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    def reset(self) -> None:
+        size = self.width * self.height
+        self.rays = {kind: array('l', [0]) * size for kind in RAY_KINDS}
+        self.tests = array('l', [0]) * size
+        self.times = array('d', [0.0]) * size
+        self.shapes: dict[str, list] = {}
+        self.materials: dict[str, list] = {}
+
+    def pixel(self) -> int:
+        '''
+        Index of the pixel traced by the current thread, -1 outside of a pixel.
+        '''
+        return getattr(self.local, 'pixel', -1)
+
+    def begin(self, x: int, y: int) -> None:
+        self.local.pixel = y * self.width + x \
+            if 0 <= x < self.width and 0 <= y < self.height else -1
+        self.local.start = time.perf_counter()
+
+    def end(self) -> None:
+        pixel = self.pixel()
+        if pixel >= 0:
+            self.times[pixel] += time.perf_counter() - self.local.start
+        self.local.pixel = -1
+
+    def ray(self, kind: str) -> None:
+        pixel = self.pixel()
+        if pixel >= 0:
+            self.rays[kind][pixel] += 1
+
+    def test(self, obj, hit, seconds: float) -> None:
+        pixel = self.pixel()
+        if pixel >= 0:
+            self.tests[pixel] += 1
+
+        entry = self.shapes.setdefault(type(obj).__name__, [0, 0, 0.0])
+        entry[0] += 1
+        entry[1] += bool(hit)
+        entry[2] += seconds
+
+    def shade(self, material, seconds: float) -> None:
+        name = material_names.get(
+            material.material_type, str(material.material_type))
+        entry = self.materials.setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+    def spread(self, tile: tuple[int, int, int, int], seconds: float) -> None:
+        '''
+        Record the time of a tile rendered as a whole, split evenly over its pixels.
+        '''
+        x_start, x_end, y_start, y_end = tile
+        count = (x_end - x_start) * (y_end - y_start)
+        for y in range(y_start, y_end):
+            for x in range(x_start, x_end):
+                self.times[y * self.width + x] += seconds / count
+
+    def take(self, tile: tuple[int, int, int, int]) -> dict:
+        '''
+        Pixel data of a tile and the totals recorded since the last call, sent by worker
+        processes to the parent.
+        '''
+        x_start, x_end, y_start, y_end = tile
+        pixels = [y * self.width + x for y in range(y_start, y_end)
+                  for x in range(x_start, x_end)]
+        data = {
+            'rays': {kind: [self.rays[kind][i] for i in pixels] for kind in RAY_KINDS},
+            'tests': [self.tests[i] for i in pixels],
+            'times': [self.times[i] for i in pixels],
+            'shapes': self.shapes,
+            'materials': self.materials,
+        }
+        self.shapes = {}
+        self.materials = {}
+        return data
+
+    def merge(self, tile: tuple[int, int, int, int], data: dict) -> None:
+        x_start, x_end, y_start, y_end = tile
+        pixels = [y * self.width + x for y in range(y_start, y_end)
+                  for x in range(x_start, x_end)]
+
+        for kind in RAY_KINDS:
+            rays = self.rays[kind]
+            for i, count in zip(pixels, data['rays'][kind]):
+                rays[i] += count
+        for i, count, seconds in zip(pixels, data['tests'], data['times']):
+            self.tests[i] += count
+            self.times[i] += seconds
+
+        for totals, other in ((self.shapes, data['shapes']), (self.materials, data['materials'])):
+            for name, values in other.items():
+                entry = totals.setdefault(name, [0] * len(values))
+                for k, value in enumerate(values):
+                    entry[k] += value
+
+    def values(self, metric: str = 'time') -> list[float]:
+        if metric == 'time':
+            return list(self.times)
+        if metric == 'tests':
+            return list(self.tests)
+        if metric == 'rays':
+            return [sum(counts) for counts in zip(*self.rays.values())]
+        return list(self.rays[metric])
+
+    def heatmap(self, metric: str = 'time') -> Framebuffer:
+        '''
+        Heatmap of a metric, pixels are placed like Raytracer.point places them.
+        '''
+        values = self.values(metric)
+        peak = max(values) or 1
+        colormap = matplotlib.colormaps['inferno']
+
+        framebuffer = Framebuffer(self.width, self.height)
+        for y in range(self.height):
+            row = self.height - y
+            if not 0 <= row < self.height:
+                continue
+            for x in range(self.width):
+                color = colormap(values[y * self.width + x] / peak)
+                framebuffer.set_at(
+                    x, row, tuple(int(c * 255) for c in color[:3]))
+        return framebuffer
+
+    def save_heatmap(self, path: str, metric: str = 'time') -> None:
+        self.heatmap(metric).save(path)
+
+    def report(self) -> str:
+        '''
+        Aggregate report by ray kind, shape type and material type.
+        '''
+        traced = sum(1 for t in self.times if t > 0) or 1
+        total_time = sum(self.times)
+        lines = [f"Profile: {total_time:.3f} s over {traced} pixels"]
+
+        lines.append("  rays:")
+        for kind in RAY_KINDS:
+            count = sum(self.rays[kind])
+            lines.append(
+                f"    {kind:<10} {count:>10} ({count / traced:.2f} per pixel)")
+        tests = sum(self.tests)
+        lines.append(
+            f"  intersection tests: {tests} ({tests / traced:.2f} per pixel)")
+
+        lines.append("  shapes:        tests       hits    seconds")
+        for name, (count, hits, seconds) in sorted(self.shapes.items(), key=lambda item: -item[1][2]):
+            lines.append(
+                f"    {name:<10} {count:>10} {hits:>10} {seconds:>10.3f}")
+
+        lines.append("  materials:     calls    seconds (local shading)")
+        for name, (count, seconds) in sorted(self.materials.items(), key=lambda item: -item[1][1]):
+            lines.append(f"    {name:<11} {count:>9} {seconds:>10.3f}")
+
+        return '\n'.join(lines)
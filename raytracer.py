@@ -1,27 +1,477 @@
+import argparse
+import hashlib
+import io
 import os
+import time
 import pygame
 from rt import Raytracer
 from figures import *
 from lights import *
 from materials import *
+from scene_cache import MeshCache
+from render_cache import RenderCache
+from profiler import Profiler, METRICS
+from texture import Texture, FILTERS
+from scheduler import ORDERS, PRIORITIES
+from distributed import Coordinator, parse_address, spawn_workers
+from animation import Animation, render_sequence
 import matplotlib
 import datetime
-import math
 
 # Start-Process -FilePath "wmic" -ArgumentList "process where name='python.exe' CALL setpriority 128" -Wait
 # Start-Process -FilePath "python" -ArgumentList "raytracer.py"
 
 
-def app():
-    # Constants
-    file_name = 'triangles.txt'
-    file_path = f'./scenes/{file_name}'
+class SceneState(object):
+    '''
+    SceneState class
+
+    Record of the definitions read by parse_scene, used to diff reloads.
+
+    Attributes:
+        shapes (list[tuple[tuple, str, Shape]]): Geometry tokens (and model file digest), material
+            name and instance of each shape.
+        materials (dict[str, tuple]): Definition tokens of each material.
+        material_types (dict[str, int]): Type of each material.
+        lights (list[tuple]): Tokens of each light.
+        settings (list[tuple]): Tokens of configuration and texture lines, and the image file
+            digest of texture lines.
+        animation (Animation): Frame count and keys of the frames and key lines.
+    '''
+
+    def __init__(self) -> None:
+        self.shapes: list[tuple[tuple, str, Shape]] = []
+        self.materials: dict[str, tuple] = {}
+        self.material_types: dict[str, int] = {}
+        self.lights: list[tuple] = []
+        self.settings: list[tuple] = []
+        self.animation = Animation()
+
+
+class SceneChanges(object):
+    '''
+    SceneChanges class
+
+    Difference between two parses of a scene file.
+
+    Attributes:
+        geometry (bool): Shapes were added, removed or reordered, the BVH must be rebuilt.
+        lights (bool): Lights were modified.
+        settings (bool): Configuration or texture lines were modified.
+        shaded (list[Shape]): Reused shapes whose material changed.
+    '''
+
+    def __init__(self, previous: SceneState, current: SceneState) -> None:
+        previous_shapes = [shape for _, _, shape in previous.shapes]
+        current_shapes = [shape for _, _, shape in current.shapes]
+
+        self.geometry = len(previous_shapes) != len(current_shapes) or any(
+            a is not b for a, b in zip(previous_shapes, current_shapes))
+        self.lights = previous.lights != current.lights
+        self.settings = previous.settings != current.settings
+
+        changed_materials = {name for name in set(previous.materials) | set(current.materials)
+                             if previous.materials.get(name) != current.materials.get(name)}
+        previous_names = {id(shape): name for _, name, shape in previous.shapes}
+        self.shaded = [shape for _, name, shape in current.shapes
+                       if name in changed_materials or previous_names.get(id(shape)) != name]
+
+        # Materials whose color can show up on other shapes through secondary rays
+        self.secondary = any(previous.material_types.get(name, OPAQUE) != OPAQUE
+                             for _, name, _ in previous.shapes) or \
+            any(current.material_types.get(name, OPAQUE) != OPAQUE
+                for _, name, _ in current.shapes)
+
+    def region(self, raytracer: Raytracer) -> tuple[int, int, int, int] | None:
+        '''
+        Screen region to render again, None for the full frame.
+
+        Only material changes in scenes without REFLECTIVE or TRANSPARENT materials can be
+        limited to the projected bounds of the affected shapes, anything else can change
+        shadows or reflections anywhere in the frame.
+        '''
+        if self.geometry or self.lights or self.settings:
+            return None
+        if not self.shaded:
+            return (0, 0, 0, 0)
+        if self.secondary:
+            return None
+
+        region = None
+        for shape in self.shaded:
+            bounds = shape.bounds
+            shape_region = raytracer.screen_bounds(
+                bounds) if bounds else None
+            if shape_region is None:
+                return None
+            if region is None:
+                region = shape_region
+            else:
+                region = (min(region[0], shape_region[0]), max(region[1], shape_region[1]),
+                          min(region[2], shape_region[2]), max(region[3], shape_region[3]))
+        return region
+
+
+def file_digest(path: str) -> str:
+    '''
+    Hash of the contents of a file, so reloads notice edited models and images.
+    '''
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def parse_scene(raytracer: Raytracer, filepath: str = "./default.txt", materials: dict = None, textures: dict = None, cache: MeshCache = None, previous: SceneState = None) -> SceneState:
+    '''
+    Parse a scene file, adding its lights and shapes to the raytracer.
+
+    When the state of a previous parse is given, shapes whose definition did not change
+    are reused (with their acceleration data) instead of being created again.
+
+    Attributes:
+        raytracer (Raytracer): The raytracer to configure.
+        filepath (str): The path to the scene file.
+        materials (dict): Materials by name, filled while parsing.
+        textures (dict): Textures by name, filled while parsing.
+        cache (MeshCache): Cache of compiled OBJ models, None to only share them within the scene.
+        previous (SceneState): State returned by the previous parse of the scene.
+    '''
+    materials = {} if materials is None else materials
+    textures = {'None': None} if textures is None else textures
+    # Models placed several times are still loaded once without a persistent cache
+    cache = MeshCache(None) if cache is None else cache
+    use_hex = False
+    state = SceneState()
+
+    # Shapes of the previous parse by geometry tokens
+    reusable: dict[tuple, list[Shape]] = {}
+    if previous:
+        for key, _, shape in previous.shapes:
+            reusable.setdefault(key, []).append(shape)
+
+    def add_shape(tokens: list[str], material_name: str, create, *files: str) -> None:
+        # The files a shape is loaded from are part of its definition
+        key = tuple(tokens[:-1]) + tuple(file_digest(path) for path in files)
+        material = materials[material_name]
+        shapes = reusable.get(key)
+        if shapes:
+            shape = shapes.pop(0)
+            shape.set_material(material)
+        else:
+            shape = create(material)
+        raytracer.scene.append(shape)
+        state.shapes.append((key, material_name, shape))
+
+    with open(filepath, "r") as f:
+        for line in f:
+            # Parse the line
+            tokens = line.strip().split()
+            if not tokens:
+                continue
+            keyword = tokens[0]
+            params = tokens[1:]
+
+            if keyword in ("ambient", "directional", "point"):
+                state.lights.append(tuple(tokens))
+            elif keyword in ("texture", "clear_color", "render_using", "batch_size", "workers", "tile_size", "tile_order", "tile_priority", "display_interval", "progressive_step", "antialiasing", "antialiasing_threshold", "texture_filtering", "max_depth", "min_ray_weight", "camera_position", "look_at", "camera_up", "fov", "resolution", "use_hex"):
+                settings = tuple(tokens)
+                if keyword == "texture" and params[0] != 'None':
+                    settings += (file_digest(params[1]),)
+                state.settings.append(settings)
+
+            # Create the object
+            if keyword == "ambient":
+                raytracer.lights.append(
+                    AmbientLight(intensity=float(params[0])))
+            elif keyword == "directional":
+                direction = tuple(map(float, params[:3]))
+                intensity = float(params[3])
+                raytracer.lights.append(DirectionalLight(
+                    direction=direction, intensity=intensity))
+            elif keyword == "point":
+                point = tuple(map(float, params[:3]))
+                intensity = float(params[3])
+                color = tuple(map(float, params[4:]))
+                raytracer.lights.append(PointLight(
+                    point=point, intensity=intensity, color=color))
+            elif keyword == "sphere":
+                position = tuple(map(float, params[:3]))
+                radius = float(params[3])
+                material_name = params[4]
+                add_shape(tokens, material_name, lambda material: Sphere(
+                    position=position, radius=radius, material=material))
+            elif keyword == "plane":
+                position = tuple(map(float, params[:3]))
+                normal = tuple(map(float, params[3:6]))
+                material_name = params[6]
+                add_shape(tokens, material_name, lambda material: Plane(
+                    position=position, normal=normal, material=material))
+            elif keyword == "disk":
+                position = tuple(map(float, params[:3]))
+                normal = tuple(map(float, params[3:6]))
+                radius = float(params[6])
+                material_name = params[7]
+                add_shape(tokens, material_name, lambda material: Disk(
+                    position=position, normal=normal, radius=radius, material=material))
+            elif keyword == "AABB":
+                position = tuple(map(float, params[:3]))
+                size = tuple(map(float, params[3:6]))
+                material_name = params[6]
+                add_shape(tokens, material_name, lambda material: AABB(
+                    position=position, size=size, material=material))
+            elif keyword == "triangle":
+                a = tuple(map(float, params[:3]))
+                b = tuple(map(float, params[3:6]))
+                c = tuple(map(float, params[6:9]))
+                vertices = [a, b, c]
+                material_name = params[9]
+                add_shape(tokens, material_name, lambda material: Triangle(
+                    vertices=vertices, material=material))
+            elif keyword == "object":
+                position = tuple(map(float, params[:3]))
+                scale = tuple(map(float, params[3:6]))
+                rotate = tuple(map(float, params[6:9]))
+                object_path = params[9]
+                material_name = params[10]
+                add_shape(tokens, material_name, lambda material: Obj(
+                    position=position, scale=scale, rotate=rotate, material=material, filepath=object_path, cache=cache),
+                    object_path)
+            elif keyword == "texture":
+                if params[0] != 'None':
+                    texture = Texture.load(params[1])
+                    textures[params[0]] = texture
+            elif keyword == "material":
+                name = params[0]
+                offset = 0
+                if use_hex:
+                    diffuse = tuple(
+                        matplotlib.colors.to_rgb(f'#{params[1]}'))
+                else:
+                    diffuse = tuple(map(float, params[1:4]))
+                    offset = 2
+                specular = float(params[2 + offset])
+                ks = float(params[3 + offset])
+                material_type = material_types[params[4 + offset]]
+                texture = textures[params[5 + offset]]
+                ior = float(params[6 + offset])
+                materials[name] = Material(
+                    diffuse=diffuse, specular=specular, ks=ks, material_type=material_type, texture=texture, ior=ior)
+                state.materials[name] = (use_hex,) + tuple(params)
+                state.material_types[name] = material_type
+            elif keyword == "clear_color":
+                color = tuple(map(float, params[:3]))
+                raytracer.set_clear_color(*color)
+            elif keyword == "render_using":
+                raytracer.render_using = params[0]
+            elif keyword == "batch_size":
+                raytracer.batch_size = int(params[0])
+            elif keyword == "workers":
+                raytracer.workers = int(params[0])
+            elif keyword == "tile_size":
+                raytracer.tile_size = int(params[0])
+            elif keyword == "tile_order":
+                if params[0] in ORDERS:
+                    raytracer.tile_order = params[0]
+                else:
+                    print(f"Unknown tile order {params[0]}, ignored")
+            elif keyword == "tile_priority":
+                if params[0] in PRIORITIES:
+                    raytracer.tile_priority = params[0]
+                else:
+                    print(f"Unknown tile priority {params[0]}, ignored")
+            elif keyword == "display_interval":
+                raytracer.display_interval = int(params[0])
+            elif keyword == "progressive_step":
+                raytracer.progressive_step = int(params[0])
+            elif keyword == "antialiasing":
+                raytracer.antialiasing = int(params[0])
+            elif keyword == "antialiasing_threshold":
+                raytracer.antialiasing_threshold = float(params[0])
+            elif keyword == "max_depth":
+                raytracer.max_depth = int(params[0])
+            elif keyword == "min_ray_weight":
+                raytracer.min_ray_weight = float(params[0])
+            elif keyword == "texture_filtering":
+                if params[0] in FILTERS:
+                    raytracer.texture_filtering = params[0]
+                else:
+                    print(f"Unknown texture filtering {params[0]}, ignored")
+            elif keyword == "use_hex":
+                if params[0] == 'true':
+                    use_hex = True
+            elif keyword == "camera_position":
+                raytracer.set_camera(position=tuple(map(float, params[:3])))
+            elif keyword == "look_at":
+                raytracer.set_camera(target=tuple(map(float, params[:3])))
+            elif keyword == "camera_up":
+                raytracer.set_camera(up=tuple(map(float, params[:3])))
+            elif keyword == "fov":
+                raytracer.projection(float(params[0]), raytracer.near_plane)
+            elif keyword == "resolution":
+                # Read by scene_resolution before the raytracer is created
+                pass
+            elif keyword == "frames":
+                state.animation.frames = int(params[0])
+            elif keyword == "key":
+                state.animation.add_key(params)
+
+    return state
+
+
+def scene_resolution(filepath: str) -> tuple[int, int] | None:
+    '''
+    Image size of the resolution line of a scene file, None if it has none.
+    '''
+    resolution = None
+    with open(filepath, "r") as f:
+        for line in f:
+            tokens = line.split()
+            if len(tokens) >= 3 and tokens[0] == "resolution":
+                resolution = int(tokens[1]), int(tokens[2])
+    return resolution
+
+
+def resolve_size(filepath: str, size: tuple[int, int] = None, scale: float = 1) -> tuple[int, int]:
+    '''
+    Image size of a render: the given size, else the resolution of the scene, else
+    1080x720, multiplied by scale (e.g. 0.25 for a quick preview).
+    '''
+    width, height = size or scene_resolution(filepath) or (1080, 720)
+    return max(1, round(width * scale)), max(1, round(height * scale))
 
-    environment_map_path = './assets/textures/environment/brown_photostudio_05_8k.png'
-    screen_shot_path = './screenshots/'
 
-    width = 1080
-    height = 720
+def parse_size(value: str) -> tuple[int, int]:
+    '''
+    Parse a WIDTHxHEIGHT argument.
+    '''
+    try:
+        width, height = (int(i) for i in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"invalid size '{value}', expected WIDTHxHEIGHT")
+    return width, height
+
+
+def load_frame(raytracer: Raytracer, png: bytes) -> None:
+    '''
+    Copy a cached PNG frame into the framebuffer and show it.
+    '''
+    image = pygame.image.load(io.BytesIO(png), 'frame.png')
+    raytracer.framebuffer.pixels[:] = pygame.image.tostring(image, 'RGB')
+    raytracer.present()
+
+
+def render(file_path: str, width: int, height: int, output_path: str, render_using: str = None, workers: int = None, environment_map_path: str = None, cache: MeshCache = None, profile_path: str = None, profile_metric: str = 'time', downsample_environment: bool = False, render_cache: RenderCache = None, listen: tuple[str, int] = None) -> Raytracer:
+    '''
+    Render a scene file without a window and save it as a PNG file.
+
+    With `profile_path` the render is profiled, the report is printed and the heatmap of
+    `profile_metric` is saved to that path. `downsample_environment` only keeps the
+    environment map resolution the image can show. With `render_cache` a frame already
+    rendered for the same scene, assets and settings is saved without rendering. `listen`
+    is the (host, port) the coordinator of distributed renders accepts workers on.
+    '''
+    start_time = time.time()
+    raytracer = Raytracer(None, width, height)
+    state = parse_scene(raytracer, file_path, cache=cache)
+    # The downsampled environment resolution depends on the camera of the scene
+    if environment_map_path:
+        raytracer.load_environment(
+            environment_map_path, downsample_environment)
+    parse_time = time.time()
+
+    if render_using:
+        raytracer.render_using = render_using
+    if workers:
+        raytracer.workers = workers
+    if profile_path:
+        raytracer.profiler = Profiler(width, height)
+    if listen:
+        raytracer.coordinator = Coordinator(*listen)
+
+    # A profiled render has to run even when its frame is cached
+    key = None
+    if render_cache is not None and not profile_path:
+        key = render_cache.key(raytracer, state, environment_map_path)
+        png = render_cache.load(key)
+        if png is not None:
+            load_frame(raytracer, png)
+            with open(output_path, 'wb') as f:
+                f.write(png)
+            print(f"Saved {output_path} (render cache hit)")
+            print(f"  total:  {time.time() - start_time:.3f} s")
+            return raytracer
+
+    raytracer.build()
+    build_time = time.time()
+
+    raytracer.clear()
+    raytracer.render()
+    render_time = time.time()
+    if raytracer.coordinator is not None:
+        raytracer.coordinator.close()
+
+    png = raytracer.framebuffer.to_png()
+    with open(output_path, 'wb') as f:
+        f.write(png)
+    if key is not None:
+        render_cache.store(key, png)
+    end_time = time.time()
+
+    pixels = width * height
+    print(f"Saved {output_path}")
+    print(f"  parse:  {parse_time - start_time:.3f} s" +
+          (f" (mesh cache: {cache.hits} hits, {cache.misses} misses)" if cache else ""))
+    print(f"  build:  {build_time - parse_time:.3f} s")
+    print(f"  render: {render_time - build_time:.3f} s "
+          f"({pixels / max(render_time - build_time, 1e-9):.0f} pixels/s, {raytracer.render_using})")
+    print(f"  save:   {end_time - render_time:.3f} s")
+    print(f"  total:  {end_time - start_time:.3f} s")
+
+    if raytracer.profiler is not None:
+        raytracer.profiler.save_heatmap(profile_path, profile_metric)
+        print(raytracer.profiler.report())
+        print(f"Saved {profile_metric} heatmap {profile_path}")
+
+    return raytracer
+
+
+def sequence(file_path: str, width: int, height: int, output_pattern: str, frames: int = None, render_using: str = None, workers: int = None, environment_map_path: str = None, cache: MeshCache = None, downsample_environment: bool = False) -> Raytracer:
+    '''
+    Render the frames of an animated scene file without a window and save them as numbered
+    PNG files, see the animation module. `frames` overrides the frame count of the scene.
+    '''
+    start_time = time.time()
+    raytracer = Raytracer(None, width, height)
+    state = parse_scene(raytracer, file_path, cache=cache)
+    if environment_map_path:
+        raytracer.load_environment(
+            environment_map_path, downsample_environment)
+    animation = state.animation
+    if frames:
+        animation.frames = frames
+    if render_using:
+        raytracer.render_using = render_using
+    if workers:
+        raytracer.workers = workers
+
+    render_sequence(raytracer, animation, output_pattern)
+    if raytracer.coordinator is not None:
+        raytracer.coordinator.close()
+
+    total = time.time() - start_time
+    print(f"Rendered {animation.frames} frames in {total:.3f} s "
+          f"({total / max(animation.frames, 1):.3f} s per frame, {raytracer.render_using})")
+    return raytracer
+
+
+def app(file_path: str = './scenes/triangles.txt', width: int = None, height: int = None, environment_map_path: str = './assets/textures/environment/brown_photostudio_05_8k.png', downsample_environment: bool = False, render_cache: RenderCache = None):
+    # Constants
+    screen_shot_path = './screenshots/'
+    if width is None or height is None:
+        width, height = resolve_size(file_path)
 
     pygame.init()
 
@@ -32,113 +482,18 @@ def app():
     screen.set_alpha(None)
 
     raytracer = Raytracer(screen)
-    raytracer.environment_map = pygame.image.load(environment_map_path)
     materials = {}
     textures = {
         'None': None,
     }
+    cache = MeshCache()
 
-    def parseScene(filepath: str = "./default.txt"):
-        use_hex = False
-        with open(filepath, "r") as f:
-            for line in f:
-                # Parse the line
-                tokens = line.strip().split()
-                if not tokens:
-                    continue
-                keyword = tokens[0]
-                params = tokens[1:]
-
-                # Create the object
-                if keyword == "ambient":
-                    raytracer.lights.append(
-                        AmbientLight(intensity=float(params[0])))
-                elif keyword == "directional":
-                    direction = tuple(map(float, params[:3]))
-                    intensity = float(params[3])
-                    raytracer.lights.append(DirectionalLight(
-                        direction=direction, intensity=intensity))
-                elif keyword == "point":
-                    point = tuple(map(float, params[:3]))
-                    intensity = float(params[3])
-                    color = tuple(map(float, params[4:]))
-                    raytracer.lights.append(PointLight(
-                        point=point, intensity=intensity, color=color))
-                elif keyword == "sphere":
-                    position = tuple(map(float, params[:3]))
-                    radius = float(params[3])
-                    material_name = params[4]
-                    material = materials[material_name]
-                    raytracer.scene.append(
-                        Sphere(position=position, radius=radius, material=material))
-                elif keyword == "plane":
-                    position = tuple(map(float, params[:3]))
-                    normal = tuple(map(float, params[3:6]))
-                    material_name = params[6]
-                    raytracer.scene.append(Plane(
-                        position=position, normal=normal, material=materials[material_name]))
-                elif keyword == "disk":
-                    position = tuple(map(float, params[:3]))
-                    normal = tuple(map(float, params[3:6]))
-                    radius = float(params[6])
-                    material_name = params[7]
-                    raytracer.scene.append(Disk(
-                        position=position, normal=normal, radius=radius, material=materials[material_name]))
-                elif keyword == "AABB":
-                    position = tuple(map(float, params[:3]))
-                    size = tuple(map(float, params[3:6]))
-                    material_name = params[6]
-                    raytracer.scene.append(AABB(
-                        position=position, size=size, material=materials[material_name]))
-                elif keyword == "triangle":
-                    a = tuple(map(float, params[:3]))
-                    b = tuple(map(float, params[3:6]))
-                    c = tuple(map(float, params[6:9]))
-                    vertices = [a, b, c]
-                    material_name = params[9]
-                    raytracer.scene.append(
-                        Triangle(vertices=vertices, material=materials[material_name]))
-                elif keyword == "object":
-                    position = tuple(map(float, params[:3]))
-                    scale = tuple(map(float, params[3:6]))
-                    rotate = tuple(map(float, params[6:9]))
-                    object_path = params[9]
-                    material_name = params[10]
-                    raytracer.scene.append(Obj(
-                        position=position, scale=scale, rotate=rotate, material=materials[material_name], filepath=object_path))
-                elif keyword == "texture":
-                    if params[0] != 'None':
-                        texture = pygame.image.load(params[1])
-                        textures[params[0]] = texture
-                elif keyword == "material":
-                    name = params[0]
-                    offset = 0
-                    if use_hex:
-                        diffuse = tuple(
-                            matplotlib.colors.to_rgb(f'#{params[1]}'))
-                    else:
-                        diffuse = tuple(map(float, params[1:4]))
-                        offset = 2
-                    specular = float(params[2 + offset])
-                    ks = float(params[3 + offset])
-                    material_type = material_types[params[4 + offset]]
-                    texture = textures[params[5 + offset]]
-                    ior = float(params[6 + offset])
-                    materials[name] = Material(
-                        diffuse=diffuse, specular=specular, ks=ks, material_type=material_type, texture=texture, ior=ior)
-                elif keyword == "clear_color":
-                    color = tuple(map(float, params[:3]))
-                    raytracer.set_clear_color(*color)
-                elif keyword == "render_using":
-                    raytracer.render_using = params[0]
-                    raytracer.batch_size = math.gcd(height, width)
-                elif keyword == "batch_size":
-                    raytracer.batch_size = int(params[0])
-                elif keyword == "use_hex":
-                    if params[0] == 'true':
-                        use_hex = True
-
-    parseScene(file_path)
+    state = parse_scene(raytracer, file_path, materials, textures, cache)
+    if environment_map_path:
+        raytracer.load_environment(
+            environment_map_path, downsample_environment)
+    raytracer.build()
+    region = None
 
     ss = 0
     is_running = True
@@ -153,7 +508,16 @@ def app():
                 raytracer.scene.clear()
                 raytracer.lights.clear()
                 materials.clear()
-                parseScene(file_path)
+                previous = state
+                state = parse_scene(raytracer, file_path,
+                                    materials, textures, cache, previous)
+                changes = SceneChanges(previous, state)
+                if environment_map_path and downsample_environment:
+                    # The kept resolution follows the camera of the reloaded scene
+                    raytracer.load_environment(environment_map_path, True)
+                if changes.geometry:
+                    raytracer.build()
+                region = changes.region(raytracer)
                 once = True
             elif event.type == pygame.KEYDOWN and event.key == pygame.K_s and pygame.key.get_mods() & pygame.KMOD_CTRL:
                 pygame.display.set_caption("Saving...")
@@ -169,8 +533,27 @@ def app():
 
         if once:
             pygame.display.set_caption("Rendering...")
-            raytracer.clear()
-            raytracer.render()
+            png = None
+            if render_cache is not None:
+                key = render_cache.key(raytracer, state, environment_map_path)
+                png = render_cache.load(key)
+
+            if png is not None:
+                print("Render cache hit")
+                load_frame(raytracer, png)
+            elif region is None:
+                raytracer.clear()
+                raytracer.render()
+            elif region[0] < region[1] and region[2] < region[3]:
+                print(f"Rendering changed region {region}")
+                raytracer.render(region)
+            else:
+                print("Nothing changed")
+
+            # The framebuffer holds the full frame of the current scene in every case
+            if render_cache is not None and png is None:
+                render_cache.store(key, raytracer.framebuffer.to_png())
+            region = None
             pygame.display.set_caption("Done!")
             pygame.display.set_caption(f"RT - {file_path}")
             once = False
@@ -178,5 +561,103 @@ def app():
     pygame.quit()
 
 
+def main(argv: list[str] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog='raytracer', description='Ray tracer using python and PyGame.')
+    commands = parser.add_subparsers(dest='command')
+
+    view = commands.add_parser(
+        'view', help='render a scene in an interactive window (default)')
+    view.add_argument('scene', nargs='?', default='./scenes/triangles.txt')
+    view.add_argument('--size', type=parse_size,
+                      help='window size as WIDTHxHEIGHT, defaults to the resolution of the scene or 1080x720')
+    view.add_argument('--scale', type=float, default=1,
+                      help='multiply the size, e.g. 0.25 for a quick preview')
+    view.add_argument('--environment', default='./assets/textures/environment/brown_photostudio_05_8k.png',
+                      help='environment map image')
+    view.add_argument('--downsample-environment', action='store_true',
+                      help='keep only the environment map resolution the window can show')
+    view.add_argument('--no-render-cache', action='store_true',
+                      help='always render instead of showing cached frames')
+
+    batch = commands.add_parser(
+        'render', help='render a scene without a window and save it as PNG')
+    batch.add_argument('scene')
+    batch.add_argument('--size', type=parse_size,
+                       help='image size as WIDTHxHEIGHT, defaults to the resolution of the scene or 1080x720')
+    batch.add_argument('--scale', type=float, default=1,
+                       help='multiply the size, e.g. 0.25 for a quick preview')
+    batch.add_argument('--out', default='frame.png', help='output PNG path')
+    batch.add_argument('--mode', choices=['normal', 'threads', 'processes', 'vectorized', 'progressive', 'distributed'],
+                       help='override the render_using value of the scene')
+    batch.add_argument('--workers', type=int,
+                       help='worker processes, implies --mode processes')
+    batch.add_argument('--listen', type=parse_address, metavar='HOST:PORT',
+                       help='address distributed workers connect to, implies --mode distributed')
+    batch.add_argument('--environment', help='environment map image')
+    batch.add_argument('--downsample-environment', action='store_true',
+                       help='keep only the environment map resolution the image can show')
+    batch.add_argument('--no-cache', action='store_true',
+                       help='always parse OBJ models instead of using the mesh cache')
+    batch.add_argument('--no-render-cache', action='store_true',
+                       help='always render instead of reusing a cached frame')
+    batch.add_argument('--profile', metavar='HEATMAP',
+                       help='profile the render, print a report and save a cost heatmap PNG')
+    batch.add_argument('--profile-metric', choices=METRICS, default='time',
+                       help='metric of the heatmap')
+
+    animated = commands.add_parser(
+        'sequence', help='render the frames of an animated scene as numbered PNG files')
+    animated.add_argument('scene')
+    animated.add_argument('--size', type=parse_size,
+                          help='image size as WIDTHxHEIGHT, defaults to the resolution of the scene or 1080x720')
+    animated.add_argument('--scale', type=float, default=1,
+                          help='multiply the size, e.g. 0.25 for a quick preview')
+    animated.add_argument('--out', default='frames/frame_{:04d}.png',
+                          help='output path pattern, formatted with the frame number')
+    animated.add_argument('--frames', type=int,
+                          help='override the frame count of the scene')
+    animated.add_argument('--mode', choices=['normal', 'threads', 'processes', 'vectorized', 'progressive', 'distributed'],
+                          help='override the render_using value of the scene')
+    animated.add_argument('--workers', type=int,
+                          help='worker processes rendering whole frames, implies --mode processes')
+    animated.add_argument('--environment', help='environment map image')
+    animated.add_argument('--downsample-environment', action='store_true',
+                          help='keep only the environment map resolution the image can show')
+    animated.add_argument('--no-cache', action='store_true',
+                          help='always parse OBJ models instead of using the mesh cache')
+
+    worker = commands.add_parser(
+        'worker', help='render tiles of a distributed render started on another machine')
+    worker.add_argument('address', type=parse_address, metavar='HOST:PORT',
+                        help='address of the coordinator (render --listen)')
+    worker.add_argument('--count', type=int, default=1,
+                        help='workers to run on this machine, usually one per core')
+
+    args = parser.parse_args(argv)
+    if args.command in ('render', 'sequence', 'view'):
+        width, height = resolve_size(args.scene, args.size, args.scale)
+
+    if args.command == 'render':
+        mode = args.mode or ('distributed' if args.listen else None) or (
+            'processes' if args.workers else None)
+        render(args.scene, width, height, args.out, mode,
+               args.workers, args.environment, None if args.no_cache else MeshCache(),
+               args.profile, args.profile_metric, args.downsample_environment,
+               None if args.no_render_cache else RenderCache(), args.listen)
+    elif args.command == 'sequence':
+        mode = args.mode or ('processes' if args.workers else None)
+        sequence(args.scene, width, height, args.out, args.frames, mode, args.workers,
+                 args.environment, None if args.no_cache else MeshCache(),
+                 args.downsample_environment)
+    elif args.command == 'worker':
+        spawn_workers(*args.address, args.count)
+    elif args.command == 'view':
+        app(args.scene, width, height, args.environment,
+            args.downsample_environment, None if args.no_render_cache else RenderCache())
+    else:
+        app()
+
+
 if __name__ == "__main__":
-    app()
+    main()
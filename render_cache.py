@@ -0,0 +1,152 @@
+'''
+Render result cache.
+
+Stores finished frames as PNG files named by the hash of everything that decides their
+pixels: the parsed scene, the referenced model, texture and environment files, the camera,
+the resolution, the render settings and the renderer sources. Rendering the same scene again
+returns the stored frame instead.
+'''
+
+import glob
+import hashlib
+import os
+
+# Bump when the key layout changes
+CACHE_VERSION = 1
+CACHE_DIR = './.cache/renders'
+# Size limit of the cache directory, least recently used frames are removed first
+MAX_BYTES = 256 * 1024 * 1024
+
+# Renderer settings that change the pixels of a frame, the render mode and the worker
+# settings only change how fast it is produced
+PIXEL_SETTINGS = ('width', 'height', 'camera_position', 'camera_right', 'camera_up',
+                  'camera_forward', 'viewport_x', 'viewport_y',
+                  'viewport_width', 'viewport_height', 'near_plane', 'top_edge', 'right_edge',
+                  'clear_color', 'max_depth', 'min_ray_weight', 'antialiasing',
+                  'antialiasing_threshold', 'texture_filtering')
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class RenderCache(object):
+    '''
+    RenderCache class
+
+    Content addressed cache of finished frames on disk, bounded in size with least recently
+    used eviction. Reading a frame marks it as recently used.
+
+    Attributes:
+        directory (str): Directory of the cached frames.
+        max_bytes (int): Size limit of the directory.
+        hits (int): Frames returned from the cache.
+        misses (int): Lookups without a cached frame.
+    '''
+
+    def __init__(self, directory: str = CACHE_DIR, max_bytes: int = MAX_BYTES) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # File digests by (path, size, modification time)
+        self.digests: dict[tuple, str] = {}
+
+    def file_digest(self, path: str) -> str:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return 'missing'
+        file_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        digest = self.digests.get(file_key)
+        if digest is None:
+            sha = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(block)
+            digest = sha.hexdigest()
+            self.digests[file_key] = digest
+        return digest
+
+    def key(self, raytracer, state, environment_map_path: str = None) -> str:
+        '''
+        Cache key of the frame a raytracer would render for a parsed scene (SceneState).
+        '''
+        digest = hashlib.sha1()
+
+        def add(*values) -> None:
+            digest.update(repr(values).encode())
+
+        add(CACHE_VERSION)
+        for source in sorted(glob.glob(os.path.join(SOURCE_DIR, '*.py'))):
+            add(os.path.basename(source), self.file_digest(source))
+
+        for tokens, material_name, _ in state.shapes:
+            add('shape', tokens, material_name)
+            if tokens[0] == 'object':
+                add(self.file_digest(tokens[10]))
+        for name in sorted(state.materials):
+            add('material', name, state.materials[name])
+        for tokens in state.lights:
+            add('light', tokens)
+        for tokens in state.settings:
+            add('setting', tokens)
+            if tokens[0] == 'texture' and len(tokens) > 2:
+                add(self.file_digest(tokens[2]))
+
+        for name in PIXEL_SETTINGS:
+            add(name, getattr(raytracer, name, None))
+
+        environment_map = raytracer.environment_map
+        if environment_map is not None:
+            add('environment', environment_map_path and self.file_digest(environment_map_path),
+                environment_map.get_width(), environment_map.get_height())
+
+        return digest.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.png')
+
+    def load(self, key: str) -> bytes | None:
+        '''
+        PNG file of a cached frame, None on a miss.
+        '''
+        try:
+            with open(self.path(key), 'rb') as f:
+                png = f.read()
+            # The modification time orders the frames for eviction
+            os.utime(self.path(key))
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return png
+
+    def store(self, key: str, png: bytes) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        # Write to a temporary file first so readers never see partial frames
+        temp_path = self.path(key) + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(png)
+        os.replace(temp_path, self.path(key))
+        self.evict()
+
+    def evict(self) -> None:
+        '''
+        Remove the least recently used frames until the directory fits in max_bytes.
+        '''
+        frames = []
+        for path in glob.glob(os.path.join(self.directory, '*.png')):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            frames.append((stat.st_mtime_ns, stat.st_size, path))
+
+        total = sum(size for _, size, _ in frames)
+        for _, size, path in sorted(frames):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
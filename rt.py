@@ -5,11 +5,58 @@ import math
 from lights import *
 from figures import Shape, Intercept
 from materials import *
-
-import threading
+from bvh import BVH, inverse_direction
+from vectorized import PacketEngine
+from parallel import render_processes, worker_count
+from distributed import Coordinator
+from framebuffer import Framebuffer
+from profiler import Profiler
+from scheduler import order_tiles, estimate_costs, prioritize
+from texture import Texture
+
+from concurrent.futures import ThreadPoolExecutor
+import random
 import time
 
 MAX_RECURSION_DEPTH = 3
+# Refit BVH cost, relative to the cost after the last build, that triggers a rebuild
+REBUILD_COST_RATIO = 1.5
+
+
+class RayNode(object):
+    '''
+    RayNode class
+
+    Ray of the ray tree evaluated by Raytracer.ray_color.
+
+    Attributes:
+        origin (tuple[float, float, float]): Origin of the ray, None when the intercept is already known.
+        direction (tuple[float, float, float]): Direction of the ray.
+        exclude (Shape): Shape the ray can not hit.
+        kind (str): Ray kind counted by the profiler.
+        depth (int): Bounces before this ray.
+        weight (float): Largest share of the pixel color the ray can change.
+        travelled (float): Distance from the camera to the origin along the ray tree.
+        intercept (Intercept): Closest hit of the ray.
+        surface_color (list[float]): Surface color at the intercept, None for rays leaving the scene.
+        light_color (list[float]): Ambient, diffuse and specular light at the intercept.
+        children (list[tuple[float, RayNode]]): Secondary rays and the factor of their color.
+        color (list[float]): Color of the ray once evaluated.
+    '''
+
+    def __init__(self, origin: tuple[float, float, float], direction: tuple[float, float, float], exclude: Shape, kind: str, depth: int, weight: float, travelled: float = 0.0) -> None:
+        self.origin = origin
+        self.direction = direction
+        self.exclude = exclude
+        self.kind = kind
+        self.depth = depth
+        self.weight = weight
+        self.travelled = travelled
+        self.intercept: Intercept = None
+        self.surface_color: list[float] = None
+        self.light_color: list[float] = None
+        self.children: list[tuple[float, RayNode]] = []
+        self.color: list[float] = None
 
 
 class Raytracer(object):
@@ -18,18 +65,45 @@ class Raytracer(object):
 
     This class is responsible for the main loop of the raytracer.
 
+    Pixels are written to an in-memory framebuffer, the screen (if any) is only updated
+    every `display_interval` pixels and once per finished tile.
+
     Attributes:
-        screen (pygame.display): The screen to render to.
+        screen (pygame.display): The screen to render to, None to render headless.
+        framebuffer (Framebuffer): The rendered image.
+        profiler (Profiler): Records the cost of every pixel when set, None by default.
     '''
 
-    def __init__(self, screen: Surface) -> None:
+    def __init__(self, screen: Surface = None, width: int = None, height: int = None) -> None:
         self.screen = screen
-        self.width, self.height = screen.get_size()
+        if screen is not None:
+            self.width, self.height = screen.get_size()
+        else:
+            self.width, self.height = width, height
+
+        self.framebuffer = Framebuffer(self.width, self.height)
+        # Pixels drawn between screen updates, 0 only updates per tile
+        self.display_interval = self.height
+        self.pending_pixels = 0
 
         self.scene: list[Shape] = []
         self.lights: list[Light] = []
 
+        # Acceleration structure, see build()
+        self.bvh: BVH = None
+        self.bvh_cost = 0.0
+        self.bounded: list[Shape] = []
+        self.unbounded: list[Shape] = []
+
+        # Primary ray terms of every pixel column and row, see prepare_primary_rays
+        self.ray_columns: list[tuple[float, float, float]] = None
+        self.ray_rows: list[tuple[float, float, float]] = None
+
+        # Looking down -Z until set_camera is given a target
         self.camera_position = (0, 0, 0)
+        self.camera_target: tuple[float, float, float] = None
+        self.camera_up_vector = (0, 1, 0)
+        self.set_camera()
 
         self.viewport(0, 0, self.width, self.height)
         self.projection(60, 0.1)
@@ -41,25 +115,162 @@ class Raytracer(object):
         self.threads = False
         self.render_using = 'normal'
 
-        self.environment_map: Surface = None
+        # Bounces of reflection and refraction rays, and the smallest share of the pixel
+        # color a secondary ray must be able to change to be traced
+        self.max_depth = MAX_RECURSION_DEPTH
+        self.min_ray_weight = 0.0
+
+        # Block size of the first progressive pass, halved on every pass
+        self.progressive_step = 16
+
+        # Adaptive antialiasing: samples of the pixels found on edges (1 disables it) and
+        # the color difference with a neighbor that marks a pixel as an edge
+        self.antialiasing = 1
+        self.antialiasing_threshold = 0.1
+        # Pixels refined by the running antialiasing pass and their first sample, see antialias
+        self.edges: dict[tuple[int, int], tuple[int, int, int]] = None
+
+        # Index + 1 of each scene shape by id(), see shape_id
+        self.shape_ids: dict[int, int] = None
+
+        # Thread and process pool settings, workers None uses every core
+        self.workers: int = None
+        self.tile_size = 32
+        # Curve the tiles are rendered along, and 'cost' to start the expensive tiles
+        # first in parallel renders
+        self.tile_order = 'hilbert'
+        self.tile_priority = 'cost'
+        # Measured seconds of the tiles of previous parallel renders
+        self.tile_costs: dict[tuple[int, int, int, int], float] = {}
+        # Serves the tiles of 'distributed' renders, listens on localhost when not set
+        self.coordinator: Coordinator = None
+
+        self.environment_map: Texture = None
+        # 'nearest' or 'bilinear' lookups of textures and the environment map
+        self.texture_filtering = 'nearest'
+
+        self.profiler: Profiler = None
 
     def viewport(self, x: int, y: int, width: int, height: int) -> None:
         self.viewport_x = x
         self.viewport_y = y
         self.viewport_width = width
         self.viewport_height = height
+        self.ray_columns = None
 
     def projection(self, fov: float = 60, n: float = 0.1) -> None:
         aspect_ratio = self.viewport_width / self.viewport_height
+        self.fov = fov
         self.near_plane = n
         self.top_edge = math.tan((fov*math.pi / 180) / 2) * n
         self.right_edge = self.top_edge * aspect_ratio
+        self.ray_columns = None
+
+    def set_camera(self, position: tuple[float, float, float] = None, target: tuple[float, float, float] = None, up: tuple[float, float, float] = None) -> None:
+        '''
+        Move and aim the camera, the arguments left out keep their value.
+
+        The camera basis is computed here once: camera_right, camera_up and camera_forward
+        are the world directions of the screen x and y axes and of the view direction.
+        '''
+        if position is not None:
+            self.camera_position = position
+        if target is not None:
+            self.camera_target = target
+        if up is not None:
+            self.camera_up_vector = up
+
+        forward = (0.0, 0.0, -1.0)
+        if self.camera_target is not None:
+            view = pm.sub3(self.camera_target, self.camera_position)
+            if pm.length3(view) > 0:
+                forward = pm.norm3(view)
+            else:
+                print("Camera target at the camera position, looking down -z")
+
+        right = pm.cross(forward, self.camera_up_vector)
+        if pm.length3(right) <= 1e-9 * pm.length3(self.camera_up_vector):
+            # Looking along the up vector leaves the screen x axis undefined, use the world
+            # axis least aligned with the view direction as up instead
+            fallback = min(((0.0, 1.0, 0.0), (0.0, 0.0, 1.0), (1.0, 0.0, 0.0)),
+                           key=lambda axis: abs(pm.dot3(axis, forward)))
+            print(f"Camera up {self.camera_up_vector} is zero or parallel to the view direction, "
+                  f"using {fallback}")
+            right = pm.cross(forward, fallback)
+        right = pm.norm3(right)
+        up = pm.cross(right, forward)
+
+        # Adding 0.0 turns negative zeros positive, so the default camera traces exactly
+        # the directions (x, y, -near) of an unrotated one
+        self.camera_forward = tuple(c + 0.0 for c in forward)
+        self.camera_right = tuple(c + 0.0 for c in right)
+        self.camera_up = tuple(c + 0.0 for c in up)
+        self.ray_columns = None
+
+    def prepare_primary_rays(self) -> None:
+        '''
+        Precompute the primary ray terms of the pixel centers: the direction through pixel
+        (x, y) is the normalized ray_columns[x] + ray_rows[y]. Called again after the
+        camera, the viewport or the projection change.
+        '''
+        self.ray_columns = [self.primary_column(x + 0.5) for x in range(self.width)]
+        self.ray_rows = [self.primary_row(y + 0.5) for y in range(self.height)]
+
+    def primary_column(self, x: float) -> tuple[float, float, float]:
+        # from window coordinates to norm device coordinates (NDC)
+        position_x = ((x - self.viewport_x) / self.viewport_width) * 2 - 1
+        return pm.scale3(position_x * self.right_edge, self.camera_right)
+
+    def primary_row(self, y: float) -> tuple[float, float, float]:
+        position_y = ((y - self.viewport_y) / self.viewport_height) * 2 - 1
+        return pm.add3(pm.scale3(position_y * self.top_edge, self.camera_up),
+                       pm.scale3(self.near_plane, self.camera_forward))
 
     def set_clear_color(self, r: float, g: float, b: float) -> None:
         self.clear_color = (int(r * 255), int(g * 255), int(b * 255))
 
     def clear(self) -> None:
-        self.screen.fill(self.clear_color)
+        self.framebuffer.clear(self.clear_color)
+        self.present()
+
+    def present(self) -> None:
+        '''
+        Copy the framebuffer to the screen, does nothing when rendering headless.
+        '''
+        self.pending_pixels = 0
+        if self.screen is None:
+            return
+        image = pygame.image.frombuffer(
+            self.framebuffer.pixels, (self.width, self.height), 'RGB')
+        self.screen.blit(image, (0, 0))
+        pygame.display.flip()
+
+    def save(self, path: str) -> None:
+        self.framebuffer.save(path)
+
+    def load_environment(self, path: str, downsample: bool = False) -> None:
+        '''
+        Load the environment map. When downsampling, the image is halved until its texels
+        covering the horizontal field of view match the render width.
+        '''
+        max_width = None
+        if downsample:
+            fov = 2 * math.atan(self.right_edge / self.near_plane)
+            max_width = math.ceil(self.width * 2 * math.pi / fov)
+        self.environment_map = Texture.load(path, max_width)
+
+    def pixel_spread(self) -> float:
+        '''
+        Angle covered by a pixel at the center of the view. Rays are taken as cones of this
+        angle to pick the mip level of texture lookups.
+        '''
+        return 2 * self.top_edge / self.near_plane / self.viewport_height
+
+    def background_color(self) -> list[float]:
+        '''
+        Color of secondary rays leaving the scene when there is no environment map.
+        '''
+        return [c / 255 for c in self.clear_color]
 
     def set_current_color(self, r: float, g: float, b: float) -> None:
         self.current_color = (int(r * 255), int(g * 255), int(b * 255))
@@ -70,262 +281,703 @@ class Raytracer(object):
         if 0 <= x < self.width and 0 <= y < self.height:
             if color:
                 self.set_current_color(*color)
-            self.screen.set_at((x, y), self.current_color)
+            self.framebuffer.set_at(x, y, self.current_color)
+
+    def build(self) -> None:
+        '''
+        Build the scene BVH. Must be called after the scene is parsed or modified.
 
-    def cast_ray(self, origin: tuple[float, float, float], direction: tuple[float, float, float], scene_obj: Shape = None, recursion: int = 0) -> Intercept | None:
-        if recursion >= MAX_RECURSION_DEPTH:
+        Unbounded shapes (planes) can not be stored in the hierarchy and are tested linearly.
+        '''
+        self.bounded = []
+        self.unbounded = []
+        bounds = []
+
+        for obj in self.scene:
+            obj_bounds = obj.bounds
+            if obj_bounds is None:
+                self.unbounded.append(obj)
+            else:
+                self.bounded.append(obj)
+                bounds.append(obj_bounds)
+
+        self.bvh = BVH(bounds)
+        self.bvh_cost = self.bvh.sah_cost()
+
+    def refit(self) -> None:
+        '''
+        Update the scene BVH after shapes moved (see Shape.move), without adding or removing
+        shapes. The tree is rebuilt instead when refitting made it much slower to traverse.
+        '''
+        if self.bvh is None:
+            self.build()
+            return
+        self.bvh.refit([obj.bounds for obj in self.bounded])
+        if self.bvh.sah_cost() > REBUILD_COST_RATIO * self.bvh_cost:
+            self.build()
+
+    def cast_ray(self, origin: tuple[float, float, float], direction: tuple[float, float, float], scene_obj: Shape = None, recursion: int = 0, kind: str = 'primary') -> Intercept | None:
+        if recursion >= self.max_depth:
             return None
 
+        if self.bvh is None:
+            self.build()
+
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.ray(kind)
+            intersect = self.profiled_intersect
+        else:
+            intersect = None
+
         depth = float('inf')
         intercept = None
         hit = None
 
-        for obj in self.scene:
+        for obj in self.unbounded:
             if obj != scene_obj:
-                intercept = obj.ray_intersect(origin, direction)
+                intercept = intersect(obj, origin, direction) if intersect \
+                    else obj.ray_intersect(origin, direction)
                 if intercept and intercept.distance < depth:
                     hit = intercept
                     depth = intercept.distance
+
+        bounded = self.bounded
+
+        def hit_fn(i, origin, direction):
+            obj = bounded[i]
+            if obj == scene_obj:
+                return None
+            # Shapes sharing a leaf were not tested against their own bounds yet
+            if obj.cull and not obj.may_hit(origin, inverse_direction(direction)):
+                return None
+            if intersect:
+                return intersect(obj, origin, direction)
+            return obj.ray_intersect(origin, direction)
+
+        intercept = self.bvh.intersect(origin, direction, hit_fn, depth)
+        if intercept is not None:
+            hit = intercept
         return hit
 
-    def ray_color(self, intercept: Intercept, ray_direction: tuple[float, float, float], recursion: int = 0):
-        if intercept is None:
-            if self.environment_map:
-                x = (math.atan2(ray_direction[2],
-                                ray_direction[0]) / (2 * math.pi) + 0.5) * self.environment_map.get_width()
-                y = math.acos(ray_direction[1]) / math.pi * \
-                    self.environment_map.get_height()
+    def occluded(self, origin: tuple[float, float, float], direction: tuple[float, float, float], max_distance: float = float('inf'), exclude: Shape = None) -> bool:
+        '''
+        Shadow ray query, True if any shape other than `exclude` is hit before max_distance.
 
-                environment_color = self.environment_map.get_at(
-                    (int(x), int(y)))
+        Unlike cast_ray it returns at the first blocker instead of searching the closest hit.
+        '''
+        if self.bvh is None:
+            self.build()
 
-                return [i/255 for i in environment_color[:3]]
-            else:
-                return None
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.ray('shadow')
+            occludes = self.profiled_occludes
+        else:
+            occludes = None
+
+        for obj in self.unbounded:
+            if obj != exclude:
+                if occludes(obj, origin, direction, max_distance) if occludes \
+                        else obj.occludes(origin, direction, max_distance):
+                    return True
+
+        bounded = self.bounded
+
+        def hit_fn(i, origin, direction):
+            obj = bounded[i]
+            if obj == exclude:
+                return False
+            if obj.cull and not obj.may_hit(origin, inverse_direction(direction), max_distance):
+                return False
+            if occludes:
+                return occludes(obj, origin, direction, max_distance)
+            return obj.occludes(origin, direction, max_distance)
+
+        return self.bvh.occluded(origin, direction, hit_fn, max_distance)
+
+    def profiled_intersect(self, obj: Shape, origin: tuple[float, float, float], direction: tuple[float, float, float]) -> Intercept | None:
+        start = time.perf_counter()
+        intercept = obj.ray_intersect(origin, direction)
+        self.profiler.test(obj, intercept, time.perf_counter() - start)
+        return intercept
+
+    def profiled_occludes(self, obj: Shape, origin: tuple[float, float, float], direction: tuple[float, float, float], max_distance: float) -> bool:
+        start = time.perf_counter()
+        blocked = obj.occludes(origin, direction, max_distance)
+        self.profiler.test(obj, blocked, time.perf_counter() - start)
+        return blocked
+
+    def ray_color(self, intercept: Intercept, ray_direction: tuple[float, float, float], recursion: int = 0):
+        '''
+        Color of a ray given its closest intercept, None when it leaves the scene and there
+        is no environment map.
+
+        The reflection and refraction rays of REFLECTIVE and TRANSPARENT materials are
+        evaluated without recursion: rays are shaded from an explicit stack, then the colors
+        are combined from the leaves up, each ray clamped like a recursive evaluation would.
+        '''
+        root = RayNode(None, ray_direction, None, 'primary', recursion, 1.0)
+        root.intercept = intercept
+
+        stack = [root]
+        rays = []
+        while stack:
+            ray = stack.pop()
+            rays.append(ray)
+            self.shade(ray)
+            # Pushed in reverse so the reflection is traced first
+            for _, child in reversed(ray.children):
+                stack.append(child)
+
+        # Every ray was shaded after its parent, so the reverse order visits children first
+        for ray in reversed(rays):
+            if ray.surface_color is None:
+                continue
+            light_color = ray.light_color
+            for factor, child in ray.children:
+                child_color = child.color or self.background_color()
+                light_color = [
+                    light_color[0] + factor * child_color[0],
+                    light_color[1] + factor * child_color[1],
+                    light_color[2] + factor * child_color[2]
+                ]
+            surface_color = ray.surface_color
+            ray.color = [
+                min(1, surface_color[0] * light_color[0]),
+                min(1, surface_color[1] * light_color[1]),
+                min(1, surface_color[2] * light_color[2])
+            ]
+
+        return root.color
+
+    def shade(self, ray: 'RayNode') -> None:
+        '''
+        Trace a ray of the ray tree and compute its local lighting and secondary rays.
+
+        Secondary rays whose weight falls below `min_ray_weight` are not traced.
+        '''
+        if ray.origin is not None:
+            ray.intercept = self.cast_ray(
+                ray.origin, ray.direction, ray.exclude, ray.depth, ray.kind)
+        intercept = ray.intercept
+        ray_direction = ray.direction
+
+        if intercept is None:
+            environment_map = self.environment_map
+            if environment_map:
+                # The map covers a full turn horizontally
+                level = environment_map.level(self.pixel_spread() / (2 * math.pi))
+                ray.color = environment_map.environment(
+                    ray_direction, self.texture_filtering == 'bilinear', level)
+            return
 
         material = intercept.obj.material
         surface_color = material.diffuse
 
-        if material.texture and intercept.texture_coords:
-            texture_x = intercept.texture_coords[0] * \
-                material.texture.get_width() - 1
-            texture_y = intercept.texture_coords[1] * \
-                material.texture.get_height() - 1
+        profiler = self.profiler
+        if profiler is not None:
+            shade_start = time.perf_counter()
 
-            texture_color = material.texture.get_at(
-                (int(texture_x), int(texture_y)))
-
-            texture_color = [i/255 for i in texture_color[:3]]
+        if material.texture and intercept.texture_coords:
+            # Width of the ray cone where it hits the surface, in texture coordinates
+            footprint = (ray.travelled + intercept.distance) * self.pixel_spread() * \
+                intercept.obj.texture_density() / \
+                max(abs(pm.dot3(ray_direction, intercept.normal)), 0.1)
+            texture_color = material.texture.sample(
+                *intercept.texture_coords, self.texture_filtering == 'bilinear',
+                material.texture.level(footprint))
             surface_color = [i*j for i, j in zip(
                 surface_color, texture_color)]
 
-        reflect_color = [0, 0, 0]
-        refract_color = [0, 0, 0]
-        ambient_color = [0, 0, 0]
         diffuse_color = [0, 0, 0]
         specular_color = [0, 0, 0]
-        final_color = [0, 0, 0]
 
-        if material.material_type == OPAQUE:
+        # Largest share of the pixel color a secondary ray can change
+        weight = ray.weight * max(surface_color)
+
+        def spawn(origin, direction, exclude, kind, factor=1.0):
+            if weight * factor >= self.min_ray_weight:
+                ray.children.append((factor, RayNode(
+                    origin, direction, exclude, kind, ray.depth + 1, weight * factor,
+                    ray.travelled + intercept.distance)))
+
+        opaque = material.material_type == OPAQUE
+        if opaque or material.ks != 0:
+            # REFLECTIVE and TRANSPARENT materials only take the specular term
+            point = intercept.point
+            view_direction = pm.norm3(
+                pm.sub3(self.camera_position, point))
             for light in self.lights:
-                if light.light_type == "ambient":
-                    r, g, b = light.get_light_color()
-                    ambient_color = [
-                        ambient_color[0] + r,
-                        ambient_color[1] + g,
-                        ambient_color[2] + b
-                    ]
-                else:
-                    shadow_intersect = None
-                    direction = None
-
-                    if light.light_type == "directional":
-                        direction = [i*-1 for i in light.direction]
-                    elif light.light_type == "point":
-                        direction = pm.subtract(
-                            light.point, intercept.point)
-                        direction = pm.norm(direction)
-
-                    shadow_intersect = self.cast_ray(
-                        intercept.point,  direction, intercept.obj)
-
-                    if shadow_intersect is None:
-                        r, g, b = light.get_diffuse_color(
-                            intercept)
-
-                        diffuse_color = [
-                            diffuse_color[0] + r,
-                            diffuse_color[1] + g,
-                            diffuse_color[2] + b
-                        ]
-
-                        r, g, b = light.get_specular_color(
-                            intercept, self.camera_position)
-
-                        specular_color = [
-                            specular_color[0] + r,
-                            specular_color[1] + g,
-                            specular_color[2] + b
-                        ]
-
-        elif material.material_type == REFLECTIVE:
-            reflect = pm.reflect_vector([i*-1 for i in ray_direction],
-                                        intercept.normal)
-
-            reflect_intercept = self.cast_ray(
-                intercept.point, reflect, intercept.obj, recursion + 1)
+                shadow_ray = None
+                if light.casts_shadows:
+                    shadow_ray = light.shadow_ray(point)
+                    if self.occluded(point, *shadow_ray, intercept.obj):
+                        continue
+
+                diffuse, specular = light.shade(
+                    intercept, view_direction, shadow_ray)
+                if opaque:
+                    diffuse_color[0] += diffuse[0]
+                    diffuse_color[1] += diffuse[1]
+                    diffuse_color[2] += diffuse[2]
+                specular_color[0] += specular[0]
+                specular_color[1] += specular[1]
+                specular_color[2] += specular[2]
+
+        if not opaque:
+            reflect = pm.reflect(ray_direction, intercept.normal)
+
+            if material.material_type == REFLECTIVE:
+                spawn(intercept.point, reflect, intercept.obj, 'reflect')
+            else:
+                outside = pm.dot3(ray_direction, intercept.normal) < 0
+                bias = [i*0.001 for i in intercept.normal]
 
-            reflect_color = self.ray_color(
-                reflect_intercept, reflect, recursion + 1)
+                reflect_origin = pm.add3(intercept.point, bias) if outside else pm.sub3(
+                    intercept.point, bias)
 
-            for light in self.lights:
-                if light.light_type != "ambient":
-                    shadow_intersect = None
-                    direction = None
-
-                    if light.light_type == "directional":
-                        direction = [i*-1 for i in light.direction]
-                    elif light.light_type == "point":
-                        direction = pm.subtract(
-                            light.point, intercept.point)
-                        direction = pm.norm(direction)
-
-                    shadow_intersect = self.cast_ray(
-                        intercept.point,  direction, intercept.obj)
-
-                    if shadow_intersect is None:
-                        r, g, b = light.get_specular_color(
-                            intercept, self.camera_position)
-
-                        specular_color = [
-                            specular_color[0] + r,
-                            specular_color[1] + g,
-                            specular_color[2] + b
-                        ]
-
-        elif material.material_type == TRANSPARENT:
-            outside = pm.dot(ray_direction, intercept.normal) < 0
-            bias = [i*0.001 for i in intercept.normal]
-
-            reflect = pm.reflect_vector(
-                [i*-1 for i in ray_direction], intercept.normal)
-            reflect_origin = pm.add(intercept.point, bias) if outside else pm.subtract(
-                intercept.point, bias)
-            reflect_intercept = self.cast_ray(
-                reflect_origin, reflect, None, recursion + 1)
-            reflect_color = self.ray_color(
-                reflect_intercept, reflect, recursion + 1)
-
-            for light in self.lights:
-                if light.light_type != "ambient":
-                    shadow_intersect = None
-                    direction = None
-
-                    if light.light_type == "directional":
-                        direction = [i*-1 for i in light.direction]
-                    elif light.light_type == "point":
-                        direction = pm.subtract(
-                            light.point, intercept.point)
-                        direction = pm.norm(direction)
-
-                    shadow_intersect = self.cast_ray(
-                        intercept.point,  direction, intercept.obj)
-
-                    if shadow_intersect is None:
-                        r, g, b = light.get_specular_color(
-                            intercept, self.camera_position)
-
-                        specular_color = [
-                            specular_color[0] + r,
-                            specular_color[1] + g,
-                            specular_color[2] + b
-                        ]
-
-            if not pm.total_internal_reflection(ray_direction, intercept.normal, 1.0, material.ior):
-                refract = pm.refract_vector(
-                    ray_direction, intercept.normal, 1.0, material.ior)
-                refract_origin = pm.subtract(
-                    intercept.point, bias) if outside else pm.add(intercept.point, bias)
-                refract_intercept = self.cast_ray(
-                    refract_origin, refract, None, recursion + 1)
-                refract_color = self.ray_color(
-                    refract_intercept, refract, recursion + 1)
-
-                fresnel = pm.fresnel(
-                    ray_direction, intercept.normal, 1.0, material.ior)
-                Kr = fresnel[0]
-                Kt = fresnel[1]
-
-                reflect_color = pm.multiply(Kr, reflect_color)
-                refract_color = pm.multiply(Kt, refract_color)
-
-        light_color = [
-            ambient_color[0] +
-            diffuse_color[0] + specular_color[0] +
-            reflect_color[0] + refract_color[0],
-            ambient_color[1] +
-            diffuse_color[1] + specular_color[1] +
-            reflect_color[1] + refract_color[1],
-            ambient_color[2] +
-            diffuse_color[2] + specular_color[2] +
-            reflect_color[2] + refract_color[2]
+                if pm.total_internal_reflection(ray_direction, intercept.normal, 1.0, material.ior):
+                    spawn(reflect_origin, reflect, None, 'reflect')
+                else:
+                    refract = pm.refract_vector(
+                        ray_direction, intercept.normal, 1.0, material.ior)
+                    refract_origin = pm.sub3(
+                        intercept.point, bias) if outside else pm.add3(intercept.point, bias)
+
+                    Kr, Kt = pm.fresnel(
+                        ray_direction, intercept.normal, 1.0, material.ior)
+
+                    spawn(reflect_origin, reflect, None, 'reflect', Kr)
+                    spawn(refract_origin, refract, None, 'refract', Kt)
+
+        ray.surface_color = surface_color
+        ray.light_color = [
+            diffuse_color[0] + specular_color[0],
+            diffuse_color[1] + specular_color[1],
+            diffuse_color[2] + specular_color[2]
         ]
 
-        final_color = [
-            min(1, surface_color[0] * light_color[0]),
-            min(1, surface_color[1] * light_color[1]),
-            min(1, surface_color[2] * light_color[2])
-        ]
+        if profiler is not None:
+            profiler.shade(material, time.perf_counter() - shade_start)
+
+    def __getstate__(self) -> dict:
+        # The display surface can not be shared with worker processes
+        state = self.__dict__.copy()
+        state['screen'] = None
+        state['framebuffer'] = None
+        state['coordinator'] = None
+        # Shape ids are keyed by id(), which changes in other processes
+        state['shape_ids'] = None
+        return state
+
+    def primary_direction(self, x: int, y: int, jitter: tuple[float, float] = (0.5, 0.5)) -> tuple[float, float, float]:
+        '''
+        Direction of the primary ray through the point `jitter` of pixel (x, y), the pixel
+        center by default.
+        '''
+        if self.ray_columns is None:
+            self.prepare_primary_rays()
+        if jitter == (0.5, 0.5) and 0 <= x < self.width and 0 <= y < self.height:
+            column = self.ray_columns[x]
+            row = self.ray_rows[y]
+        else:
+            column = self.primary_column(x + jitter[0])
+            row = self.primary_row(y + jitter[1])
 
-        return final_color
+        # create ray
+        return pm.norm3(pm.add3(column, row))
 
-    def pixel_render(self, x: int, y: int) -> None:
-        # from window coordinates to norm device coordinates (NDC)
-        position_x = ((x + 0.5 - self.viewport_x) /
-                      self.viewport_width) * 2 - 1
-        position_y = ((y + 0.5 - self.viewport_y) /
-                      self.viewport_height) * 2 - 1
+    def pixel_color(self, x: int, y: int, jitter: tuple[float, float] = (0.5, 0.5)) -> list[float] | None:
+        return self.pixel_sample(x, y, jitter)[0]
 
-        position_x *= self.right_edge
-        position_y *= self.top_edge
+    def pixel_sample(self, x: int, y: int, jitter: tuple[float, float] = (0.5, 0.5)) -> tuple[list[float] | None, int]:
+        '''
+        Color of the primary ray through the point `jitter` of pixel (x, y) and the id of
+        the shape it hits, see shape_id.
+        '''
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.begin(x, y)
 
-        # create ray
-        direction = pm.norm(
-            (position_x, position_y, -self.near_plane))
+        direction = self.primary_direction(x, y, jitter)
 
         intercept = self.cast_ray(self.camera_position, direction)
-        ray_color = self.ray_color(intercept, direction)
+        color = self.ray_color(intercept, direction)
+
+        if profiler is not None:
+            profiler.end()
+        return color, self.shape_id(intercept.obj) if intercept else 0
+
+    def shape_id(self, obj: Shape) -> int:
+        '''
+        Index + 1 of a shape in the scene, 0 for no shape. Pixels record the id of the shape
+        their primary ray hits in framebuffer.shapes.
+        '''
+        if obj is None:
+            return 0
+        shape_ids = self.shape_ids
+        if shape_ids is None:
+            shape_ids = self.shape_ids = {
+                id(shape): i + 1 for i, shape in enumerate(self.scene)}
+        return shape_ids.get(id(obj), 0)
+
+    def record_shape(self, x: int, y: int, shape: int) -> None:
+        # # invert y, same as point
+        y = self.height - y
+        if 0 <= x < self.width and 0 <= y < self.height:
+            self.framebuffer.set_shape(x, y, shape)
+
+    def block(self, x: int, y: int, width: int, height: int, color: tuple[float, float, float] = None) -> None:
+        '''
+        Fill a block whose bottom left pixel is (x, y), used by progressive passes.
+        '''
+        # # invert y, the block grows up from y
+        y = self.height - (y + height - 1)
+        if color:
+            self.set_current_color(*color)
+        self.framebuffer.fill_rect(
+            x, y, width, height, self.current_color if color else self.clear_color)
+
+    def pixel_render(self, x: int, y: int) -> None:
+        if self.edges is not None:
+            # Antialiasing pass, only the edges are rendered again
+            first = self.edges.get((x, y))
+            if first is None:
+                return
+            ray_color = self.antialiased_color(x, y, first)
+        else:
+            ray_color, shape = self.pixel_sample(x, y)
+            self.record_shape(x, y, shape)
 
         if ray_color:
             self.point(x, y, ray_color)
-            pygame.display.flip()
 
-    def render(self) -> None:
+        self.pending_pixels += 1
+        if self.display_interval and self.pending_pixels >= self.display_interval:
+            self.present()
+
+    def tiles(self, size: int, region: tuple[int, int, int, int] = None) -> list[tuple[int, int, int, int]]:
+        '''
+        Split the region (x_start, x_end, y_start, y_end), by default the viewport, in tiles.
+        '''
+        x_start, x_end, y_start, y_end = region or (
+            self.viewport_x, self.viewport_x + self.viewport_width,
+            self.viewport_y, self.viewport_y + self.viewport_height)
+
+        tiles = []
+        for x in range(x_start, x_end, size):
+            for y in range(y_start, y_end, size):
+                tiles.append((x, min(x + size, x_end, self.width),
+                              y, min(y + size, y_end, self.height)))
+        return tiles
+
+    def schedule(self, size: int, region: tuple[int, int, int, int] = None, parallel: bool = False) -> list[tuple[int, int, int, int]]:
+        '''
+        Tiles of the region in rendering order, see the scheduler module.
+        '''
+        tiles = order_tiles(self.tiles(size, region), self.tile_order)
+        if parallel and self.tile_priority == 'cost':
+            tiles = prioritize(tiles, estimate_costs(self, tiles))
+        return tiles
+
+    def timed_batch_render(self, tile: tuple[int, int, int, int]) -> None:
+        start = time.perf_counter()
+        self.batch_render(*tile)
+        self.tile_costs[tile] = time.perf_counter() - start
+
+    def render(self, region: tuple[int, int, int, int] = None) -> None:
+        '''
+        Render the viewport, or only the pixels inside region (x_start, x_end, y_start, y_end).
+        '''
         start_time = time.time()
+        # The scene may have changed since the last render
+        self.shape_ids = None
         if self.render_using == 'threads':
-            print("Rendering with threads...")
-            tasks = []
-            for x in range(self.viewport_x, self.viewport_x + self.viewport_width, self.batch_size):
-                for y in range(self.viewport_y, self.viewport_y + self.viewport_height, self.batch_size):
-                    x_end = min(x + self.batch_size, self.width)
-                    y_end = min(y + self.batch_size, self.height)
-                    tasks.append(threading.Thread(
-                        target=self.batch_render, args=(x, x_end, y, y_end)))
-            for task in tasks:
-                task.start()
-            for task in tasks:
-                task.join()
+            print("Rendering with {} threads...".format(
+                worker_count(self.workers)))
+            if self.bvh is None:
+                self.build()
+            tiles = self.schedule(self.tile_size, region, parallel=True)
+            with ThreadPoolExecutor(max_workers=worker_count(self.workers)) as executor:
+                # Idle threads take the next tile in schedule order
+                list(executor.map(self.timed_batch_render, tiles))
+        elif self.render_using == 'processes':
+            print("Rendering with {} processes...".format(
+                worker_count(self.workers)))
+            if self.bvh is None:
+                self.build()
+            tiles = self.schedule(self.tile_size, region, parallel=True)
+            for tile, colors, shapes, profile, seconds in render_processes(self, tiles, self.workers):
+                self.tile_costs[tile] = seconds
+                self.tile_composite(tile, colors, shapes)
+                if profile is not None:
+                    self.profiler.merge(tile, profile)
+                self.present()
+        elif self.render_using == 'distributed':
+            if self.bvh is None:
+                self.build()
+            if self.coordinator is None:
+                self.coordinator = Coordinator()
+            print("Rendering with {} remote workers...".format(
+                self.coordinator.workers))
+            tiles = self.schedule(self.tile_size, region, parallel=True)
+            for tile, seconds, hits, pixels, shapes in self.coordinator.render(self, tiles):
+                self.tile_costs[tile] = seconds
+                self.tile_blit(tile, hits, pixels, shapes)
+                self.present()
+        elif self.render_using == 'vectorized':
+            print("Rendering with vectorized ray packets...")
+            if self.bvh is None:
+                self.build()
+            engine = PacketEngine(self)
+            for tile in self.schedule(self.batch_size, region):
+                tile_start = time.perf_counter()
+                engine.render_tile(*tile)
+                if self.profiler is not None:
+                    self.profiler.spread(
+                        tile, time.perf_counter() - tile_start)
+                self.present()
+        elif self.render_using == 'progressive':
+            print("Rendering progressively...")
+            self.progressive_render(region)
         else:
             print("Rendering without threads...")
-            for x in range(self.viewport_x, self.viewport_x + self.viewport_width):
-                for y in range(self.viewport_y, self.viewport_y + self.viewport_height):
-                    self.pixel_render(x, y)
+            for x_start, x_end, y_start, y_end in self.tiles(max(self.width, self.height), region):
+                for x in range(x_start, x_end):
+                    for y in range(y_start, y_end):
+                        self.pixel_render(x, y)
 
+        if self.antialiasing > 1:
+            refined = self.antialias(region)
+            print("Antialiased {} pixels with {} samples".format(
+                refined, self.antialiasing))
+
+        self.present()
         end_time = time.time()
         print("Rendering took {} seconds".format(end_time - start_time))
 
+    def progressive_render(self, region: tuple[int, int, int, int] = None) -> None:
+        '''
+        Coarse to fine rendering.
+
+        The first pass renders one pixel every `progressive_step` pixels and draws it as a
+        block, each following pass halves the step and only renders the pixels not sampled
+        by the previous passes, until every pixel has its own sample.
+        '''
+        x_start, x_end, y_start, y_end = region or (
+            self.viewport_x, self.viewport_x + self.viewport_width,
+            self.viewport_y, self.viewport_y + self.viewport_height)
+
+        step = max(1, self.progressive_step)
+        previous = None
+        while True:
+            for x in range(x_start, x_end, step):
+                for y in range(y_start, y_end, step):
+                    # Already sampled by a coarser pass, its block covers this one
+                    if previous and (x - x_start) % previous == 0 and (y - y_start) % previous == 0:
+                        continue
+
+                    color, shape = self.pixel_sample(x, y)
+                    self.record_shape(x, y, shape)
+                    # Misses are drawn too, with the clear color, so no coarser block is
+                    # left behind on the last pass
+                    self.block(x, y, min(step, x_end - x),
+                               min(step, y_end - y), color)
+
+            self.present()
+            if step == 1:
+                break
+            previous = step
+            step //= 2
+
+    def antialias(self, region: tuple[int, int, int, int] = None) -> int:
+        '''
+        Adaptive antialiasing pass over pixels already rendered with one sample.
+
+        A pixel is refined when its color differs from a neighbor by more than
+        `antialiasing_threshold` or its primary ray hit another shape than the neighbor's,
+        as recorded in framebuffer.shapes. Refined pixels get `antialiasing - 1` extra
+        samples at random points of the pixel, averaged with the first sample. The extra
+        samples are dispatched like the tiles of the render mode. Returns the number of
+        refined pixels.
+        '''
+        x_start, x_end, y_start, y_end = region or (
+            self.viewport_x, self.viewport_x + self.viewport_width,
+            self.viewport_y, self.viewport_y + self.viewport_height)
+        threshold = self.antialiasing_threshold * 255
+        framebuffer = self.framebuffer
+
+        edges = {}
+        for x in range(max(x_start, 0), min(x_end, self.width)):
+            for y in range(y_start, y_end):
+                # First samples as drawn by point()
+                row = self.height - y
+                if not 0 <= row < self.height:
+                    continue
+                color = framebuffer.get_at(x, row)
+                shape = framebuffer.get_shape(x, row)
+                for nx, nrow in ((x - 1, row), (x + 1, row), (x, row - 1), (x, row + 1)):
+                    if not (0 <= nx < self.width and 0 <= nrow < self.height):
+                        continue
+                    if framebuffer.get_shape(nx, nrow) != shape or \
+                            max(abs(a - b) for a, b in zip(color, framebuffer.get_at(nx, nrow))) > threshold:
+                        edges[x, y] = color
+                        break
+
+        if not edges:
+            return 0
+
+        self.edges = edges
+        try:
+            if self.render_using == 'threads':
+                tiles = self.edge_tiles(self.tile_size, region)
+                with ThreadPoolExecutor(max_workers=worker_count(self.workers)) as executor:
+                    list(executor.map(lambda tile: self.batch_render(*tile), tiles))
+            elif self.render_using == 'processes':
+                tiles = self.edge_tiles(self.tile_size, region)
+                for tile, colors, _, profile, _ in render_processes(self, tiles, self.workers):
+                    self.tile_composite(tile, colors)
+                    if profile is not None:
+                        self.profiler.merge(tile, profile)
+                    self.present()
+            elif self.render_using == 'distributed':
+                tiles = self.edge_tiles(self.tile_size, region)
+                for tile, _, hits, pixels, _ in self.coordinator.render(self, tiles):
+                    self.tile_blit(tile, hits, pixels)
+                    self.present()
+            elif self.render_using == 'vectorized':
+                engine = PacketEngine(self)
+                for tile in self.edge_tiles(self.batch_size, region):
+                    engine.render_tile(*tile)
+                    self.present()
+            else:
+                for x, y in edges:
+                    self.pixel_render(x, y)
+        finally:
+            self.edges = None
+
+        return len(edges)
+
+    def edge_tiles(self, size: int, region: tuple[int, int, int, int] = None) -> list[tuple[int, int, int, int]]:
+        '''
+        Tiles of the region holding pixels refined by the running antialiasing pass, in
+        rendering order.
+        '''
+        x_start, _, y_start, _ = region or (
+            self.viewport_x, self.viewport_x + self.viewport_width,
+            self.viewport_y, self.viewport_y + self.viewport_height)
+        corners = {(x - (x - x_start) % size, y - (y - y_start) % size) for x, y in self.edges}
+        tiles = [tile for tile in self.tiles(size, region) if (tile[0], tile[2]) in corners]
+        return order_tiles(tiles, self.tile_order)
+
+    def sample_jitters(self, x: int, y: int) -> list[tuple[float, float]]:
+        '''
+        Points of pixel (x, y) sampled by antialiasing, besides its center.
+        '''
+        # Seeded per pixel so every render mode produces the same image
+        jitter = random.Random(y * self.width + x)
+        return [(jitter.random(), jitter.random()) for _ in range(self.antialiasing - 1)]
+
+    def antialiased_color(self, x: int, y: int, first: tuple[int, int, int]) -> list[float]:
+        '''
+        Average of the first 8 bit sample of pixel (x, y) and its extra samples.
+        '''
+        total = [c / 255 for c in first]
+        for jitter in self.sample_jitters(x, y):
+            color = self.pixel_color(x, y, jitter) or self.background_color()
+            total = [a + b for a, b in zip(total, color)]
+        return [c / self.antialiasing for c in total]
+
+    def tile_samples(self, tile: tuple[int, int, int, int]) -> tuple[list, list[int] | None]:
+        '''
+        Colors and shape ids of the pixels of a tile in column order, for tiles rendered
+        elsewhere. During an antialiasing pass only the refined pixels get a color and no
+        shape ids are returned.
+        '''
+        x_start, x_end, y_start, y_end = tile
+        edges = self.edges
+        if edges is not None:
+            colors = [self.antialiased_color(x, y, edges[x, y]) if (x, y) in edges else None
+                      for x in range(x_start, x_end)
+                      for y in range(y_start, y_end)]
+            return colors, None
+
+        samples = [self.pixel_sample(x, y)
+                   for x in range(x_start, x_end)
+                   for y in range(y_start, y_end)]
+        return [color for color, _ in samples], [shape for _, shape in samples]
+
+    def screen_bounds(self, bounds: tuple[tuple[float, float, float], tuple[float, float, float]]) -> tuple[int, int, int, int] | None:
+        '''
+        Region (x_start, x_end, y_start, y_end) covering the projection of world bounds.
+
+        Returns None when the bounds cross the near plane and can not be projected.
+        '''
+        min_bounds, max_bounds = bounds
+        xs = []
+        ys = []
+
+        for corner in ((x, y, z) for x in (min_bounds[0], max_bounds[0])
+                       for y in (min_bounds[1], max_bounds[1])
+                       for z in (min_bounds[2], max_bounds[2])):
+            relative = pm.sub3(corner, self.camera_position)
+            depth = pm.dot3(relative, self.camera_forward)
+            if depth < self.near_plane:
+                return None
+
+            # Inverse of the pixel to ray mapping of pixel_color
+            scale = self.near_plane / depth
+            position_x = pm.dot3(relative, self.camera_right) * scale / self.right_edge
+            position_y = pm.dot3(relative, self.camera_up) * scale / self.top_edge
+            xs.append((position_x + 1) / 2 *
+                      self.viewport_width + self.viewport_x - 0.5)
+            ys.append((position_y + 1) / 2 *
+                      self.viewport_height + self.viewport_y - 0.5)
+
+        # One pixel margin for rounding
+        x_start = max(self.viewport_x, math.floor(min(xs)) - 1)
+        x_end = min(self.viewport_x + self.viewport_width, math.ceil(max(xs)) + 2)
+        y_start = max(self.viewport_y, math.floor(min(ys)) - 1)
+        y_end = min(self.viewport_y + self.viewport_height, math.ceil(max(ys)) + 2)
+        return x_start, max(x_start, x_end), y_start, max(y_start, y_end)
+
+    def tile_composite(self, tile: tuple[int, int, int, int], colors: list, shapes: list[int] = None) -> None:
+        '''
+        Draw the colors of a tile rendered elsewhere, given in column order, and record the
+        shape ids when given.
+        '''
+        x_start, x_end, y_start, y_end = tile
+        colors = iter(colors)
+        shapes = iter(shapes) if shapes is not None else None
+        for x in range(x_start, x_end):
+            for y in range(y_start, y_end):
+                color = next(colors)
+                if color:
+                    self.point(x, y, color)
+                if shapes is not None:
+                    self.record_shape(x, y, next(shapes))
+
+    def tile_blit(self, tile: tuple[int, int, int, int], hits: bytes, pixels: bytes, shapes: tuple[int, ...] = None) -> None:
+        '''
+        Draw the 8 bit colors of a tile rendered elsewhere, given in column order with a hit
+        flag per pixel (see distributed.encode_block), and record the shape ids when given.
+        '''
+        x_start, x_end, y_start, y_end = tile
+        i = 0
+        for x in range(x_start, x_end):
+            for y in range(y_start, y_end):
+                row = self.height - y
+                if 0 <= x < self.width and 0 <= row < self.height:
+                    if hits[i]:
+                        self.framebuffer.set_at(x, row, pixels[3 * i:3 * i + 3])
+                    if shapes is not None:
+                        self.framebuffer.set_shape(x, row, shapes[i])
+                i += 1
+
     def batch_render(self, x_start, x_end, y_start, y_end) -> None:
         for x in range(x_start, x_end):
             for y in range(y_start, y_end):
                 if 0 <= x < self.width and 0 <= y < self.height:
                     self.pixel_render(x, y)
+        self.present()
@@ -0,0 +1,76 @@
+'''
+Compiled scene cache.
+
+Stores the object space mesh and the BVH of every OBJ model so warm starts and reloads
+skip OBJ parsing and BVH building.
+'''
+
+import hashlib
+import os
+import pickle
+
+# Bump when the cached data layout changes
+CACHE_VERSION = 5
+CACHE_DIR = './.cache/meshes'
+
+
+class MeshCache(object):
+    '''
+    MeshCache class
+
+    Two-level cache of compiled OBJ meshes: an in-memory dictionary for reloads within the
+    same process and pickle files on disk for warm starts. Entries are keyed by the hash of
+    the OBJ file contents, every placement of a model shares the same entry.
+
+    Attributes:
+        directory (str): Directory of the cache files, None to only cache in memory.
+    '''
+
+    def __init__(self, directory: str | None = CACHE_DIR) -> None:
+        self.directory = directory
+        self.memory: dict[str, object] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(filepath: str, *params) -> str:
+        '''
+        Cache key of a model file and the parameters used to compile it.
+        '''
+        digest = hashlib.sha1()
+        with open(filepath, 'rb') as f:
+            digest.update(f.read())
+        digest.update(repr((CACHE_VERSION,) + params).encode())
+        return digest.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.pickle')
+
+    def load(self, key: str) -> object | None:
+        data = self.memory.get(key)
+
+        if data is None and self.directory:
+            try:
+                with open(self.path(key), 'rb') as f:
+                    data = pickle.load(f)
+                self.memory[key] = data
+            except (OSError, pickle.UnpicklingError, EOFError):
+                data = None
+
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def store(self, key: str, data: object) -> None:
+        self.memory[key] = data
+        if not self.directory:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        # Write to a temporary file first so readers never see partial entries
+        temp_path = self.path(key) + '.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self.path(key))
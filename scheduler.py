@@ -0,0 +1,83 @@
+'''
+Tile scheduling.
+
+Orders the tiles of a frame along a space filling curve, so consecutive tiles are neighbors
+and share the geometry and textures they touch, and moves the most expensive tiles to the
+front of parallel renders so no worker is left with a slow tile while the others idle. Tile
+costs are the times measured by the previous render.
+'''
+
+import math
+
+ORDERS = ('rows', 'morton', 'hilbert')
+PRIORITIES = ('cost', 'none')
+
+
+def morton_index(x: int, y: int) -> int:
+    '''
+    Position of the cell (x, y) along the Z-order curve, interleaving the bits of x and y.
+    '''
+    index = 0
+    bit = 0
+    while x or y:
+        index |= (x & 1) << (2 * bit) | (y & 1) << (2 * bit + 1)
+        x >>= 1
+        y >>= 1
+        bit += 1
+    return index
+
+
+def hilbert_index(n: int, x: int, y: int) -> int:
+    '''
+    Position of the cell (x, y) along the Hilbert curve filling an n x n grid (n a power of two).
+    '''
+    index = 0
+    s = n // 2
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        index += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant so the curve stays continuous
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - (x & (s - 1))
+                y = s - 1 - (y & (s - 1))
+            x, y = y, x
+        s //= 2
+    return index
+
+
+def order_tiles(tiles: list[tuple[int, int, int, int]], order: str = 'hilbert') -> list[tuple[int, int, int, int]]:
+    '''
+    Sort the tiles (x_start, x_end, y_start, y_end) of a grid along a curve of ORDERS.
+    '''
+    if order == 'rows' or len(tiles) < 2:
+        return sorted(tiles, key=lambda tile: (tile[2], tile[0]))
+
+    columns = {x: i for i, x in enumerate(sorted({tile[0] for tile in tiles}))}
+    rows = {y: j for j, y in enumerate(sorted({tile[2] for tile in tiles}))}
+    if order == 'morton':
+        return sorted(tiles, key=lambda tile: morton_index(columns[tile[0]], rows[tile[2]]))
+
+    n = 1
+    while n < max(len(columns), len(rows)):
+        n *= 2
+    return sorted(tiles, key=lambda tile: hilbert_index(n, columns[tile[0]], rows[tile[2]]))
+
+
+def estimate_costs(raytracer, tiles: list[tuple[int, int, int, int]]) -> dict[tuple[int, int, int, int], float]:
+    '''
+    Seconds each tile is expected to take.
+
+    Tiles rendered before (by the previous frame or an earlier render of the same scene) keep
+    their measured time. Tiles without one are taken as the most expensive, so a first render
+    keeps the curve order and new tiles are never left for the end.
+    '''
+    return {tile: raytracer.tile_costs.get(tile, math.inf) for tile in tiles}
+
+
+def prioritize(tiles: list[tuple[int, int, int, int]], costs: dict[tuple[int, int, int, int], float]) -> list[tuple[int, int, int, int]]:
+    '''
+    Most expensive tiles first, tiles of equal cost keep their order.
+    '''
+    return sorted(tiles, key=lambda tile: -costs[tile])
@@ -0,0 +1,135 @@
+'''
+Texture sampling.
+
+Images are converted once to packed RGB rows with a chain of mip levels, each half the size
+of the previous one, so lookups read raw bytes instead of calling Surface.get_at and minified
+lookups read a level whose texels match their footprint.
+'''
+
+import math
+
+import pygame
+
+FILTERS = ('nearest', 'bilinear')
+
+
+class Texture(object):
+    '''
+    Texture class
+
+    Image data of a material texture or an environment map.
+
+    Attributes:
+        width (int): The width of the image.
+        height (int): The height of the image.
+        data (bytes): The RGB bytes of the image, rows from the top.
+        levels (list[tuple[int, int, bytes]]): Width, height and RGB bytes of every mip
+            level, the image first.
+    '''
+
+    def __init__(self, surface: pygame.Surface, max_width: int = None) -> None:
+        if surface.get_bitsize() not in (24, 32):
+            # smoothscale only handles 24 and 32 bit surfaces
+            converted = pygame.Surface(surface.get_size(), 0, 24)
+            converted.blit(surface, (0, 0))
+            surface = converted
+
+        # Halve the image until it fits, one step at a time so every texel averages the
+        # texels it covers
+        width, height = surface.get_size()
+        while max_width is not None and width > max(max_width, 1):
+            width, height = max(width // 2, 1), max(height // 2, 1)
+            surface = pygame.transform.smoothscale(surface, (width, height))
+
+        self.width = width
+        self.height = height
+        self.data = pygame.image.tostring(surface, 'RGB')
+
+        self.levels = [(width, height, self.data)]
+        while width > 1 or height > 1:
+            width, height = max(width // 2, 1), max(height // 2, 1)
+            surface = pygame.transform.smoothscale(surface, (width, height))
+            self.levels.append(
+                (width, height, pygame.image.tostring(surface, 'RGB')))
+
+    @classmethod
+    def load(cls, path: str, max_width: int = None) -> 'Texture':
+        '''
+        Load an image file, halved until it is at most max_width wide, so a large environment
+        map only keeps the resolution the render can show.
+        '''
+        return cls(pygame.image.load(path), max_width)
+
+    def get_width(self) -> int:
+        return self.width
+
+    def get_height(self) -> int:
+        return self.height
+
+    def level(self, footprint: float) -> int:
+        '''
+        Mip level of a lookup covering `footprint` texture coordinate units, the image
+        itself until a texel of it is smaller than the footprint.
+        '''
+        texels = footprint * self.width
+        if not texels > 1:
+            return 0
+        return min(int(math.log2(texels)), len(self.levels) - 1)
+
+    def texel(self, x: int, y: int, level: int = 0) -> tuple[int, int, int]:
+        '''
+        Color (0 to 255) of a texel, coordinates outside of the texture repeat it.
+        '''
+        width, height, data = self.levels[level]
+        offset = ((y % height) * width + x % width) * 3
+        return data[offset], data[offset + 1], data[offset + 2]
+
+    def sample(self, u: float, v: float, bilinear: bool = False, level: int = 0) -> list[float]:
+        '''
+        Color (0 to 1) at the texture coordinates (u, v), repeating the texture.
+        '''
+        width, height, _ = self.levels[level]
+        if not bilinear:
+            color = self.texel(int(u * width - 1), int(v * height - 1), level)
+            return [c / 255 for c in color]
+        # Texel k is centered where the nearest lookup switches from k - 1 to k + 1
+        return self.interpolate(u * width - 1.5, v * height - 1.5, level, True)
+
+    def environment(self, direction: tuple[float, float, float], bilinear: bool = False, level: int = 0) -> list[float]:
+        '''
+        Color (0 to 1) of an equirectangular environment map in the given direction.
+        '''
+        width, height, data = self.levels[level]
+        x = (math.atan2(direction[2], direction[0]) /
+             (2 * math.pi) + 0.5) * width
+        y = math.acos(max(-1, min(1, direction[1]))) / math.pi * height
+        if not bilinear:
+            x = min(int(x), width - 1)
+            y = min(int(y), height - 1)
+            offset = (y * width + x) * 3
+            return [data[offset] / 255, data[offset + 1] / 255, data[offset + 2] / 255]
+        # The map wraps around horizontally but not at the poles
+        return self.interpolate(x - 0.5, y - 0.5, level, False)
+
+    def interpolate(self, x: float, y: float, level: int, repeat_y: bool) -> list[float]:
+        width, height, data = self.levels[level]
+        x0 = math.floor(x)
+        y0 = math.floor(y)
+        fx = x - x0
+        fy = y - y0
+
+        if repeat_y:
+            rows = (y0 % height, (y0 + 1) % height)
+        else:
+            rows = (max(0, min(y0, height - 1)), max(0, min(y0 + 1, height - 1)))
+        columns = (x0 % width, (x0 + 1) % width)
+
+        color = [0, 0, 0]
+        for row, wy in zip(rows, (1 - fy, fy)):
+            for column, wx in zip(columns, (1 - fx, fx)):
+                weight = wx * wy
+                offset = (row * width + column) * 3
+                color[0] += data[offset] * weight
+                color[1] += data[offset + 1] * weight
+                color[2] += data[offset + 2] * weight
+        return [c / 255 for c in color]
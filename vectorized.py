@@ -0,0 +1,861 @@
+'''
+NumPy ray packet engine.
+
+Generates the primary rays of a tile as arrays and traverses the scene BVH with whole
+packets, each node only testing the rays that reach its bounds. Shadow, reflection and
+refraction rays are traced as packets too, one packet per bounce, and the lights shade
+every packet with their batched methods.
+'''
+
+import math
+
+import numpy as np
+
+from figures import Shape, Sphere, Plane, Disk, AABB, Triangle, Obj, Mesh
+from materials import OPAQUE, REFLECTIVE
+from pmath_batch import dot, length, normalize, add_scaled, reflect, refract_vector, \
+    total_internal_reflection, fresnel
+from texture import Texture
+
+# Maximum number of (ray, triangle) pairs evaluated at once
+PAIR_BUDGET = 1 << 19
+# Triangles per cluster tested together against the rays hitting the cluster bounds
+CLUSTER_SIZE = 64
+
+
+def slab_entry(min_bounds: np.ndarray, max_bounds: np.ndarray, origins: np.ndarray, inv_directions: np.ndarray) -> np.ndarray:
+    '''
+    Batched slab test, returns the entry distance of each ray into the box (0 for rays
+    starting inside) and inf for the rays missing it.
+    '''
+    with np.errstate(invalid='ignore'):
+        t1 = (min_bounds - origins) * inv_directions
+        t2 = (max_bounds - origins) * inv_directions
+    t_near = np.nanmax(np.minimum(t1, t2), axis=1)
+    t_far = np.nanmin(np.maximum(t1, t2), axis=1)
+    return np.where((t_far >= t_near) & (t_far >= 0), np.maximum(t_near, 0), np.inf)
+
+
+def bilinear(texture: np.ndarray, x: np.ndarray, y: np.ndarray, repeat_y: bool) -> np.ndarray:
+    '''
+    Batched version of Texture.interpolate on a (width, height, 3) array, x always repeats.
+    '''
+    width, height = texture.shape[:2]
+    x0 = np.floor(x)
+    y0 = np.floor(y)
+    fx = (x - x0)[:, None]
+    fy = (y - y0)[:, None]
+    x0 = x0.astype(np.int64)
+    y0 = y0.astype(np.int64)
+
+    columns = np.mod(x0, width), np.mod(x0 + 1, width)
+    if repeat_y:
+        rows = np.mod(y0, height), np.mod(y0 + 1, height)
+    else:
+        rows = np.clip(y0, 0, height - 1), np.clip(y0 + 1, 0, height - 1)
+
+    return (texture[columns[0], rows[0]] * (1 - fx) * (1 - fy) +
+            texture[columns[1], rows[0]] * fx * (1 - fy) +
+            texture[columns[0], rows[1]] * (1 - fx) * fy +
+            texture[columns[1], rows[1]] * fx * fy)
+
+
+class Hits(object):
+    '''
+    Hits class
+
+    Result of a batched intersection.
+
+    Attributes:
+        distance (np.ndarray): (N,) hit distances, inf for misses.
+        normal (np.ndarray): (N, 3) hit normals.
+        uv (np.ndarray): (N, 2) texture coordinates, nan where the shape has none.
+        shape (np.ndarray): (N,) index of the shape hit, -1 for misses.
+    '''
+
+    def __init__(self, count: int) -> None:
+        self.distance = np.full(count, np.inf)
+        self.normal = np.zeros((count, 3))
+        self.uv = np.full((count, 2), np.nan)
+        self.shape = np.full(count, -1, dtype=np.int64)
+
+    def merge(self, index: int, distance: np.ndarray, normal: np.ndarray, uv: np.ndarray | None, rays: np.ndarray = None) -> None:
+        '''
+        Keep the hits on shape `index` closer than the current ones, the arrays hold the
+        given rays only when `rays` is set.
+        '''
+        if rays is None:
+            rays = np.arange(len(self.distance))
+        closer = distance < self.distance[rays]
+        target = rays[closer]
+        self.distance[target] = distance[closer]
+        self.shape[target] = index
+        if normal is not None:
+            self.normal[target] = normal[closer]
+        self.uv[target] = np.nan if uv is None else uv[closer]
+
+
+class RayPacket(object):
+    '''
+    RayPacket class
+
+    Rays of one bounce of the ray trees of a packet, the batched counterpart of RayNode.
+
+    Attributes:
+        origins (np.ndarray): (N, 3) ray origins.
+        directions (np.ndarray): (N, 3) normalized ray directions.
+        exclude (np.ndarray): (N,) index of the shape each ray can not hit, -1 for none.
+        depth (int): Bounces before these rays.
+        weight (np.ndarray): (N,) largest share of the pixel color each ray can change.
+        parent (np.ndarray): (N,) ray of the previous bounce each ray was spawned by.
+        factor (np.ndarray): (N,) factor of each ray color in the color of its parent.
+        travelled (np.ndarray): (N,) distance from the camera to each origin along the ray tree.
+        hit (np.ndarray): (N,) mask of the rays hitting a shape.
+        surface_color (np.ndarray): (N, 3) surface color of the hits.
+        light_color (np.ndarray): (N, 3) light at the hits, secondary rays included once evaluated.
+        color (np.ndarray): (N, 3) color of each ray once evaluated.
+        valid (np.ndarray): (N,) mask of the rays that produced a color.
+    '''
+
+    def __init__(self, origins: np.ndarray, directions: np.ndarray, exclude: np.ndarray, depth: int, weight: np.ndarray, parent: np.ndarray = None, factor: np.ndarray = None, travelled: np.ndarray = None) -> None:
+        count = len(directions)
+        self.origins = origins
+        self.directions = directions
+        self.exclude = exclude
+        self.depth = depth
+        self.weight = weight
+        self.parent = parent
+        self.factor = factor
+        self.travelled = np.zeros(count) if travelled is None else travelled
+        self.hit = np.zeros(count, dtype=bool)
+        self.surface_color = np.zeros((count, 3))
+        self.light_color = np.zeros((count, 3))
+        self.color = np.zeros((count, 3))
+        self.valid = np.zeros(count, dtype=bool)
+
+
+class TriangleMesh(object):
+    '''
+    TriangleMesh class
+
+    Triangle arrays of a Triangle or of the object space Mesh of Obj shapes, grouped in
+    clusters of contiguous BVH subtrees so rays only test the clusters whose bounds they hit.
+    '''
+
+    def __init__(self, face_data: np.ndarray, bvh=None, vertex_normals: np.ndarray = None, vertex_uvs: np.ndarray = None) -> None:
+        '''
+        `face_data` holds vertex 0, edge 1, edge 2 and unit normal of each triangle, as (N, 4, 3).
+        The optional `vertex_normals` (N, 3, 3) and `vertex_uvs` (N, 3, 2) are interpolated
+        at the hit points.
+        '''
+        if bvh is not None:
+            face_data = face_data[bvh.indices]
+            if vertex_normals is not None:
+                vertex_normals = vertex_normals[bvh.indices]
+            if vertex_uvs is not None:
+                vertex_uvs = vertex_uvs[bvh.indices]
+
+        self.v0 = face_data[:, 0]
+        self.edge1 = face_data[:, 1]
+        self.edge2 = face_data[:, 2]
+        self.normals = face_data[:, 3]
+        self.vertex_normals = vertex_normals
+        self.vertex_uvs = vertex_uvs
+
+        self.clusters = []
+        if bvh is not None and bvh.node_count:
+            self._collect(bvh, 0)
+        else:
+            corners = np.concatenate(
+                (self.v0, self.v0 + self.edge1, self.v0 + self.edge2))
+            self.clusters.append(
+                (corners.min(axis=0), corners.max(axis=0), 0, len(self.v0)))
+
+    @classmethod
+    def from_mesh(cls, mesh: Mesh) -> 'TriangleMesh':
+        face_data = np.frombuffer(mesh.face_data, dtype=float).reshape(-1, 4, 3)
+        indices = np.array(mesh.indices, dtype=np.int64).reshape(-1, 3)
+        vertex_normals = np.frombuffer(mesh.normals, dtype=float).reshape(-1, 3)[indices] \
+            if mesh.normals else None
+        vertex_uvs = np.frombuffer(mesh.uvs, dtype=float).reshape(-1, 2)[indices] \
+            if mesh.uvs else None
+        return cls(face_data, mesh.bvh, vertex_normals, vertex_uvs)
+
+    @classmethod
+    def from_triangle(cls, triangle: Triangle) -> 'TriangleMesh':
+        face_data = np.array([[triangle.vertices[0], triangle.edge1,
+                               triangle.edge2, triangle.normal]], dtype=float)
+        return cls(face_data)
+
+    def _collect(self, bvh, node: int) -> tuple[int, int]:
+        '''
+        Append the clusters below `node` and return its (start, end) primitive range.
+        '''
+        if bvh.node_count[node]:
+            start = bvh.node_left[node]
+            end = start + bvh.node_count[node]
+        else:
+            clusters = len(self.clusters)
+            start, _ = self._collect(bvh, bvh.node_left[node])
+            _, end = self._collect(bvh, bvh.node_right[node])
+            if end - start > CLUSTER_SIZE:
+                return start, end
+            # The whole subtree fits in one cluster, replace its children
+            del self.clusters[clusters:]
+
+        self.clusters.append(
+            (bvh.node_min[node], bvh.node_max[node], start, end))
+        return start, end
+
+    def intersect(self, origins: np.ndarray, directions: np.ndarray, surface: bool = True, t_max: np.ndarray = None):
+        '''
+        Batched Möller-Trumbore intersection, returns (distance, normal, uv).
+
+        Clusters are only tested against the rays entering them before their closest hit
+        so far and before `t_max`, when given.
+        '''
+        epsilon = 0.0001
+        count = len(directions)
+        # Directions are unnormalized in object space, see Mesh.intersect
+        parallel = epsilon * length(directions)
+        distance = np.full(count, np.inf)
+        normal = np.zeros((count, 3)) if surface else None
+        uv = np.full((count, 2), np.nan) if surface else None
+        with np.errstate(divide='ignore'):
+            inv_directions = 1 / directions
+
+        for min_bounds, max_bounds, start, end in self.clusters:
+            entry = slab_entry(min_bounds, max_bounds, origins, inv_directions)
+            limit = distance if t_max is None else np.minimum(distance, t_max)
+            rays = np.nonzero(entry < limit)[0]
+            if len(rays) == 0:
+                continue
+
+            step = max(1, PAIR_BUDGET // (end - start))
+            for chunk in range(0, len(rays), step):
+                r = rays[chunk:chunk + step]
+                O = origins[r][:, None, :]
+                D = directions[r][:, None, :]
+                v0 = self.v0[None, start:end]
+                edge1 = self.edge1[None, start:end]
+                edge2 = self.edge2[None, start:end]
+                normals = self.normals[None, start:end]
+
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    h = np.cross(D, edge2)
+                    a = np.sum(edge1 * h, axis=2)
+                    valid = np.abs(np.sum(D * normals, axis=2)) >= parallel[r][:, None]
+                    f = np.where(valid, 1.0 / a, 0.0)
+                    s = O - v0
+                    u = f * np.sum(s * h, axis=2)
+                    valid &= (u >= 0.0) & (u <= 1.0)
+                    q = np.cross(s, edge1)
+                    v = f * np.sum(D * q, axis=2)
+                    valid &= (v >= 0.0) & (u + v <= 1.0)
+                    t = f * np.sum(edge2 * q, axis=2)
+                    valid &= t > epsilon
+
+                t = np.where(valid, t, np.inf)
+                closest = np.argmin(t, axis=1)
+                rows = np.arange(len(r))
+                t = t[rows, closest]
+
+                closer = t < distance[r]
+                r = r[closer]
+                distance[r] = t[closer]
+                if surface:
+                    closest = closest[closer]
+                    rows = rows[closer]
+                    self.surface(start + closest, u[rows, closest],
+                                 v[rows, closest], r, normal, uv)
+
+        return distance, normal, uv
+
+    def surface(self, triangles: np.ndarray, u: np.ndarray, v: np.ndarray, rays: np.ndarray, normal: np.ndarray, uv: np.ndarray) -> None:
+        '''
+        Write the normals and texture coordinates of the given triangle hits, same as
+        Obj.surface before the normals are transformed to world space.
+        '''
+        w = 1 - u - v
+        if self.vertex_normals is not None:
+            n = self.vertex_normals[triangles]
+            normal[rays] = normalize(
+                w[:, None] * n[:, 0] + u[:, None] * n[:, 1] + v[:, None] * n[:, 2])
+        else:
+            normal[rays] = self.normals[triangles]
+
+        if self.vertex_uvs is not None:
+            t = self.vertex_uvs[triangles]
+            uv[rays] = np.mod(w[:, None] * t[:, 0] + u[:, None]
+                              * t[:, 1] + v[:, None] * t[:, 2], 1.0)
+            uv[rays, 1] = np.mod(1 - uv[rays, 1], 1.0)
+        else:
+            uv[rays, 0] = 1 - u
+            uv[rays, 1] = 1 - v
+
+
+def intersect_sphere(engine, shape: Sphere, origins: np.ndarray, directions: np.ndarray, surface: bool = True, t_max: np.ndarray = None):
+    center = np.asarray(shape.position, dtype=float)
+    L = center - origins
+    tca = dot(L, directions)
+    d = np.sqrt(np.maximum(dot(L, L) - tca * tca, 0))
+
+    thc = np.sqrt(np.maximum(shape.radius ** 2 - d ** 2, 0))
+    t0 = tca - thc
+    t1 = tca + thc
+    t0 = np.where(t0 < 0, t1, t0)
+    distance = np.where((d > shape.radius) | (t0 < 0), np.inf, t0)
+
+    if not surface:
+        return distance, None, None
+
+    hit = np.isfinite(distance)
+    point = add_scaled(origins, np.where(hit, distance, 0), directions)
+    normal = normalize(point - center)
+    uv = np.empty((len(directions), 2))
+    uv[:, 0] = np.arctan2(normal[:, 2], normal[:, 0]) / (2 * math.pi) + 0.5
+    uv[:, 1] = np.arccos(np.clip(normal[:, 1], -1, 1)) / math.pi
+    return distance, normal, uv
+
+
+def intersect_plane(engine, shape: Plane, origins: np.ndarray, directions: np.ndarray, surface: bool = True, t_max: np.ndarray = None):
+    normal = np.asarray(shape.normal, dtype=float)
+    denom = directions @ normal
+    num = (np.asarray(shape.position, dtype=float) - origins) @ normal
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = num / denom
+    distance = np.where((np.abs(denom) <= 0.0001) | (t < 0), np.inf, t)
+
+    if not surface:
+        return distance, None, None
+    return distance, np.broadcast_to(normal, directions.shape), None
+
+
+def intersect_disk(engine, shape: Disk, origins: np.ndarray, directions: np.ndarray, surface: bool = True, t_max: np.ndarray = None):
+    distance, normal, uv = intersect_plane(
+        engine, shape, origins, directions, surface)
+
+    hit = np.isfinite(distance)
+    point = add_scaled(origins, np.where(hit, distance, 0), directions)
+    contact = point - np.asarray(shape.position, dtype=float)
+    distance = np.where(length(contact) > shape.radius, np.inf, distance)
+    return distance, normal, uv
+
+
+def intersect_aabb(engine, shape: AABB, origins: np.ndarray, directions: np.ndarray, surface: bool = True, t_max: np.ndarray = None):
+    '''
+    Batched version of AABB.ray_intersect.
+    '''
+    count = len(directions)
+    face_min = np.asarray(shape.face_min, dtype=float)
+    face_max = np.asarray(shape.face_max, dtype=float)
+    min_bounds = np.asarray(shape.min_bounds, dtype=float)
+    max_bounds = np.asarray(shape.max_bounds, dtype=float)
+
+    parallel = np.abs(directions) <= 0.0001
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t1 = (face_min - origins) / directions
+        t2 = (face_max - origins) / directions
+    # Rays parallel to the faces of an axis never cross them, and miss when outside
+    outside = parallel & ((origins < min_bounds) | (origins > max_bounds))
+    near = np.where(parallel, -np.inf, np.minimum(t1, t2))
+    far = np.where(parallel, np.inf, np.maximum(t1, t2))
+
+    near_axis = np.argmax(near, axis=1)
+    far_axis = np.argmin(far, axis=1)
+    rows = np.arange(count)
+    t_near = near[rows, near_axis]
+    t_far = far[rows, far_axis]
+
+    miss = outside.any(axis=1) | (t_far < t_near) | (t_far < 0)
+    entering = t_near >= 0
+    distance = np.where(miss, np.inf, np.where(entering, t_near, t_far))
+
+    if not surface:
+        return distance, None, None
+
+    axis = np.where(entering, near_axis, far_axis)
+    sign = np.sign(directions[rows, axis])
+    sign = np.where(sign == 0, 1, sign)
+    normal = np.zeros((count, 3))
+    normal[rows, axis] = np.where(entering, -sign, sign)
+
+    point = add_scaled(origins, np.where(miss, 0, distance), directions)
+    # Texture coordinates use the two axes spanning the face
+    first = np.array([1, 0, 0])[axis]
+    second = np.array([2, 2, 1])[axis]
+    size = np.asarray(shape.size, dtype=float) + 0.002
+    uv = np.empty((count, 2))
+    uv[:, 0] = (point[rows, first] - min_bounds[first]) / size[first]
+    uv[:, 1] = (point[rows, second] - min_bounds[second]) / size[second]
+    return distance, normal, uv
+
+
+def intersect_triangles(engine, shape: Triangle, origins: np.ndarray, directions: np.ndarray, surface: bool = True, t_max: np.ndarray = None):
+    return engine.mesh(shape).intersect(origins, directions, surface, t_max)
+
+
+def intersect_obj(engine, shape: Obj, origins: np.ndarray, directions: np.ndarray, surface: bool = True, t_max: np.ndarray = None):
+    '''
+    Intersect the rays in the object space of the instance, see Obj.object_ray.
+    '''
+    inverse = np.asarray(shape.inverse_matrix, dtype=float)
+    local_origins = origins @ inverse[:3, :3].T + inverse[:3, 3]
+    local_directions = directions @ inverse[:3, :3].T
+
+    # Distances along the transformed rays are the same as in world space
+    distance, normal, uv = engine.mesh(shape).intersect(
+        local_origins, local_directions, surface, t_max)
+    if surface:
+        normal = normalize(
+            normal @ np.asarray(shape.normal_matrix, dtype=float).T)
+    return distance, normal, uv
+
+
+def intersect_scalar(engine, shape: Shape, origins: np.ndarray, directions: np.ndarray, surface: bool = True, t_max: np.ndarray = None):
+    '''
+    Fallback for shapes without a batched implementation.
+    '''
+    count = len(directions)
+    distance = np.full(count, np.inf)
+    normal = np.zeros((count, 3))
+    uv = np.full((count, 2), np.nan)
+
+    for i in range(count):
+        intercept = shape.ray_intersect(
+            tuple(origins[i]), tuple(directions[i]))
+        if intercept:
+            distance[i] = intercept.distance
+            normal[i] = intercept.normal
+            if intercept.texture_coords:
+                uv[i] = intercept.texture_coords
+
+    return distance, normal, uv
+
+
+# Batched intersection of each shape type, returning (distance, normal, uv). Shapes may skip
+# the work of hits beyond t_max but still report them
+intersectors = {
+    Sphere: intersect_sphere,
+    Plane: intersect_plane,
+    Disk: intersect_disk,
+    AABB: intersect_aabb,
+    Triangle: intersect_triangles,
+    Obj: intersect_obj,
+}
+
+
+class PacketEngine(object):
+    '''
+    PacketEngine class
+
+    Renders tiles of a Raytracer using NumPy ray packets.
+
+    Attributes:
+        raytracer (Raytracer): The raytracer holding the scene, lights and camera.
+        shapes (list[Shape]): Snapshot of the scene shapes, indexed by Hits.shape.
+        bounded (list[int]): Shape index of each primitive of the scene BVH.
+        unbounded (list[int]): Shape indices of the shapes outside of the BVH.
+    '''
+
+    def __init__(self, raytracer) -> None:
+        self.raytracer = raytracer
+        self.shapes = list(raytracer.scene)
+        self.meshes: dict[int, TriangleMesh] = {}
+        self.textures: dict[int, np.ndarray] = {}
+
+        if raytracer.bvh is None:
+            raytracer.build()
+        index = {id(shape): i for i, shape in enumerate(self.shapes)}
+        self.bounded = [index[id(shape)] for shape in raytracer.bounded]
+        self.unbounded = [index[id(shape)] for shape in raytracer.unbounded]
+        # Flattened scene BVH, node bounds as arrays for the batched slab test
+        bvh = raytracer.bvh
+        self.node_min = np.asarray(bvh.node_min, dtype=float)
+        self.node_max = np.asarray(bvh.node_max, dtype=float)
+        self.node_left = bvh.node_left
+        self.node_right = bvh.node_right
+        self.node_count = bvh.node_count
+        self.indices = bvh.indices
+
+    def mesh(self, shape: Triangle | Obj) -> TriangleMesh:
+        # Instances of the same model share their triangle arrays
+        source = shape.mesh if isinstance(shape, Obj) else shape
+        mesh = self.meshes.get(id(source))
+        if mesh is None:
+            if isinstance(shape, Obj):
+                mesh = TriangleMesh.from_mesh(source)
+            else:
+                mesh = TriangleMesh.from_triangle(source)
+            self.meshes[id(source)] = mesh
+        return mesh
+
+    def texture(self, texture: Texture, level: int = 0) -> np.ndarray:
+        '''
+        (width, height, 3) array of a mip level of a texture, converted once.
+        '''
+        key = (id(texture), level)
+        array = self.textures.get(key)
+        if array is None:
+            width, height, data = texture.levels[level]
+            array = np.frombuffer(data, dtype=np.uint8).reshape(
+                height, width, 3).transpose(1, 0, 2) / 255
+            self.textures[key] = array
+        return array
+
+    def primary_rays(self, x_start: int, x_end: int, y_start: int, y_end: int):
+        '''
+        Pixel coordinates and normalized directions of the primary rays of a tile.
+        '''
+        rt = self.raytracer
+        xs, ys = np.meshgrid(np.arange(x_start, x_end),
+                             np.arange(y_start, y_end), indexing='ij')
+        xs = xs.ravel()
+        ys = ys.ravel()
+
+        # Column and row terms precomputed by the raytracer, see prepare_primary_rays
+        if rt.ray_columns is None:
+            rt.prepare_primary_rays()
+        columns = np.asarray(rt.ray_columns[x_start:x_end], dtype=float)
+        rows = np.asarray(rt.ray_rows[y_start:y_end], dtype=float)
+        directions = columns[xs - x_start] + rows[ys - y_start]
+
+        return xs, ys, normalize(directions)
+
+    def traverse(self, origins: np.ndarray, directions: np.ndarray, limit: np.ndarray, test) -> None:
+        '''
+        Packet traversal of the scene BVH. Every node keeps the rays entering its bounds
+        before their `limit` (read again at every node, so closer hits prune the rest of the
+        traversal) and `test(index, rays)` is called for the shapes of the leaves reached.
+        '''
+        if not self.node_count:
+            return
+        with np.errstate(divide='ignore'):
+            inv_directions = 1 / directions
+
+        stack = [(0, np.arange(len(directions)))]
+        while stack:
+            node, rays = stack.pop()
+            entry = slab_entry(self.node_min[node], self.node_max[node],
+                               origins[rays], inv_directions[rays])
+            rays = rays[np.isfinite(entry) & (entry <= limit[rays])]
+            if len(rays) == 0:
+                continue
+
+            count = self.node_count[node]
+            if count:
+                start = self.node_left[node]
+                for i in self.indices[start:start + count]:
+                    test(self.bounded[i], rays)
+                continue
+
+            stack.append((self.node_right[node], rays))
+            stack.append((self.node_left[node], rays))
+
+    def intersect(self, origins: np.ndarray, directions: np.ndarray, exclude: np.ndarray = None) -> Hits:
+        '''
+        Closest hit of every ray, skipping the shape given by `exclude` for each ray.
+        '''
+        hits = Hits(len(directions))
+
+        def test(index: int, rays: np.ndarray) -> None:
+            if exclude is not None:
+                rays = rays[exclude[rays] != index]
+            if len(rays) == 0:
+                return
+            shape = self.shapes[index]
+            intersector = intersectors.get(type(shape), intersect_scalar)
+            distance, normal, uv = intersector(
+                self, shape, origins[rays], directions[rays], True, hits.distance[rays])
+            hits.merge(index, distance, normal, uv, rays)
+
+        everything = np.arange(len(directions))
+        for index in self.unbounded:
+            test(index, everything)
+        self.traverse(origins, directions, hits.distance, test)
+        return hits
+
+    def occluded(self, origins: np.ndarray, directions: np.ndarray, exclude: np.ndarray, max_distance: np.ndarray) -> np.ndarray:
+        '''
+        Mask of the rays hitting any shape other than `exclude` before max_distance.
+        '''
+        blocked = np.zeros(len(directions), dtype=bool)
+        # Blocked rays stop the traversal, like rays hitting nothing
+        limit = max_distance.copy()
+
+        def test(index: int, rays: np.ndarray) -> None:
+            rays = rays[~blocked[rays] & (exclude[rays] != index)]
+            if len(rays) == 0:
+                return
+            shape = self.shapes[index]
+            intersector = intersectors.get(type(shape), intersect_scalar)
+            distance, _, _ = intersector(
+                self, shape, origins[rays], directions[rays], False, max_distance[rays])
+            rays = rays[distance < max_distance[rays]]
+            blocked[rays] = True
+            limit[rays] = -np.inf
+
+        everything = np.arange(len(directions))
+        for index in self.unbounded:
+            test(index, everything)
+        self.traverse(origins, directions, limit, test)
+        return blocked
+
+    def environment(self, directions: np.ndarray) -> np.ndarray:
+        rt = self.raytracer
+        level = rt.environment_map.level(rt.pixel_spread() / (2 * math.pi))
+        env = self.texture(rt.environment_map, level)
+        width, height = env.shape[:2]
+
+        x = (np.arctan2(directions[:, 2], directions[:, 0]) /
+             (2 * math.pi) + 0.5) * width
+        y = np.arccos(np.clip(directions[:, 1], -1, 1)) / math.pi * height
+        if rt.texture_filtering == 'bilinear':
+            # The map wraps around horizontally but not at the poles
+            return bilinear(env, x - 0.5, y - 0.5, False)
+        x = np.clip(x.astype(np.int64), 0, width - 1)
+        y = np.clip(y.astype(np.int64), 0, height - 1)
+        return env[x, y]
+
+    def trace(self, origins: np.ndarray, directions: np.ndarray, hits: Hits = None):
+        '''
+        Colors of the rays and the mask of rays that produced a color, the batched version
+        of Raytracer.ray_color. `hits` are the closest hits of the rays when already known.
+
+        The ray trees are traced one bounce at a time, each bounce as one packet, then the
+        colors are combined from the last bounce up.
+        '''
+        rt = self.raytracer
+        count = len(directions)
+        packet = RayPacket(origins, directions, np.full(count, -1), 0, np.ones(count))
+        packets = []
+        while packet is not None:
+            packets.append(packet)
+            packet = self.shade(packet, hits)
+            hits = None
+
+        background = np.asarray(rt.background_color(), dtype=float)
+        for i in range(len(packets) - 1, -1, -1):
+            packet = packets[i]
+            hit = packet.hit
+            packet.color[hit] = np.minimum(
+                1, packet.surface_color[hit] * packet.light_color[hit])
+            packet.valid |= hit
+            if i > 0:
+                colors = np.where(packet.valid[:, None], packet.color, background)
+                np.add.at(packets[i - 1].light_color, packet.parent,
+                          packet.factor[:, None] * colors)
+
+        return packets[0].color, packets[0].valid
+
+    def shade(self, packet: RayPacket, hits: Hits = None) -> RayPacket | None:
+        '''
+        Trace a packet and compute the surface color and local lighting of its hits, same
+        as Raytracer.shade. Returns the packet of the secondary rays, None when there are
+        none.
+        '''
+        rt = self.raytracer
+        count = len(packet.directions)
+        if packet.depth >= rt.max_depth:
+            # Too deep, like cast_ray every ray leaves the scene
+            hits = Hits(count)
+        elif hits is None:
+            hits = self.intersect(packet.origins, packet.directions, packet.exclude)
+
+        packet.hit = hits.shape >= 0
+        miss = ~packet.hit
+        if rt.environment_map and miss.any():
+            packet.color[miss] = self.environment(packet.directions[miss])
+            packet.valid[miss] = True
+        if not packet.hit.any():
+            return None
+
+        directions = packet.directions
+        normals = hits.normal
+        points = packet.origins + np.where(packet.hit, hits.distance, 0)[:, None] * directions
+        view = normalize(np.asarray(rt.camera_position, dtype=float) - points)
+
+        # Rays of each material type, and of each shape hit
+        groups = [(index, np.nonzero(hits.shape == index)[0])
+                  for index in np.unique(hits.shape[packet.hit])]
+        opaque = np.zeros(count, dtype=bool)
+        lit = np.zeros(count, dtype=bool)
+        spread = rt.pixel_spread()
+        for index, rays in groups:
+            shape = self.shapes[index]
+            material = shape.material
+            footprint = None
+            if material.texture:
+                # Width of the ray cones where they hit the surface, see Raytracer.shade
+                footprint = (packet.travelled[rays] + hits.distance[rays]) * spread * \
+                    shape.texture_density() / \
+                    np.maximum(np.abs(dot(directions[rays], normals[rays])), 0.1)
+            packet.surface_color[rays] = self.surface_color(
+                material, hits.uv[rays], footprint)
+            opaque[rays] = material.material_type == OPAQUE
+            # REFLECTIVE and TRANSPARENT materials only take the specular term
+            lit[rays] = opaque[rays] | (material.ks != 0)
+
+        rays = np.nonzero(lit)[0]
+        for light in rt.lights:
+            shadow_rays = light.shadow_rays(points[rays]) if light.casts_shadows else None
+            shaded = rays
+            if shadow_rays is not None:
+                blocked = self.occluded(points[rays], shadow_rays[0],
+                                        hits.shape[rays], shadow_rays[1])
+                shaded = rays[~blocked]
+                shadow_rays = (shadow_rays[0][~blocked], shadow_rays[1][~blocked])
+
+            for index in np.unique(hits.shape[shaded]):
+                selected = hits.shape[shaded] == index
+                group = shaded[selected]
+                diffuse, specular = light.shade_batch(
+                    normals[group], view[group], self.shapes[index].material,
+                    None if shadow_rays is None else (shadow_rays[0][selected], shadow_rays[1][selected]))
+                packet.light_color[group] += np.where(
+                    opaque[group, None], diffuse, 0) + specular
+
+        return self.spawn(packet, hits, points, groups)
+
+    def spawn(self, packet: RayPacket, hits: Hits, points: np.ndarray, groups: list) -> RayPacket | None:
+        '''
+        Packet of the reflection and refraction rays of the REFLECTIVE and TRANSPARENT hits
+        of a packet. Rays whose weight falls below `min_ray_weight` are not traced.
+        '''
+        rt = self.raytracer
+        weight = packet.weight * packet.surface_color.max(axis=1)
+        parts = []
+
+        def add(parents, origins, directions, exclude, factor):
+            parts.append((parents, origins, directions, exclude,
+                          np.broadcast_to(factor, parents.shape)))
+
+        for index, rays in groups:
+            material = self.shapes[index].material
+            if material.material_type == OPAQUE:
+                continue
+            d = packet.directions[rays]
+            n = hits.normal[rays]
+            p = points[rays]
+            reflected = reflect(d, n)
+
+            if material.material_type == REFLECTIVE:
+                add(rays, p, reflected, np.full(len(rays), index), 1.0)
+                continue
+
+            outside = dot(d, n) < 0
+            bias = n * 0.001
+            reflect_origins = np.where(outside[:, None], p + bias, p - bias)
+            refract_origins = np.where(outside[:, None], p - bias, p + bias)
+            internal = total_internal_reflection(d, n, 1.0, material.ior)
+            Kr, Kt = fresnel(d, n, 1.0, material.ior)
+            none = np.full(len(rays), -1)
+
+            add(rays, reflect_origins, reflected, none, np.where(internal, 1.0, Kr))
+            refracted = ~internal
+            add(rays[refracted], refract_origins[refracted],
+                refract_vector(d[refracted], n[refracted], 1.0, material.ior),
+                none[refracted], Kt[refracted])
+
+        if not parts:
+            return None
+        parents, origins, directions, exclude, factor = (
+            np.concatenate(arrays) for arrays in zip(*parts))
+        weights = weight[parents] * factor
+        kept = weights >= rt.min_ray_weight
+        if not kept.any():
+            return None
+        travelled = packet.travelled[parents] + hits.distance[parents]
+        return RayPacket(origins[kept], directions[kept], exclude[kept], packet.depth + 1,
+                         weights[kept], parents[kept], factor[kept], travelled[kept])
+
+    def surface_color(self, material, uvs: np.ndarray, footprint: np.ndarray = None) -> np.ndarray:
+        '''
+        Diffuse color of a material at the given texture coordinates, nan where the shape
+        has none. Textures are read at the mip level of each footprint, see Texture.level.
+        '''
+        rt = self.raytracer
+        count = len(uvs)
+        surface_color = np.broadcast_to(
+            np.asarray(material.diffuse, dtype=float), (count, 3)).copy()
+
+        if material.texture:
+            textured = np.nonzero(~np.isnan(uvs[:, 0]))[0]
+            levels = np.zeros(len(textured), dtype=np.int64)
+            if footprint is not None:
+                texels = footprint[textured] * material.texture.width
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    levels = np.where(texels > 1, np.minimum(
+                        np.floor(np.log2(texels)), len(material.texture.levels) - 1), 0).astype(np.int64)
+            for level in np.unique(levels):
+                rays = textured[levels == level]
+                texture = self.texture(material.texture, level)
+                width, height = texture.shape[:2]
+                if rt.texture_filtering == 'bilinear':
+                    surface_color[rays] *= bilinear(
+                        texture, uvs[rays, 0] * width - 1.5, uvs[rays, 1] * height - 1.5, True)
+                else:
+                    tx = np.trunc(uvs[rays, 0] * width - 1).astype(np.int64)
+                    ty = np.trunc(uvs[rays, 1] * height - 1).astype(np.int64)
+                    # Coordinates outside of the texture repeat it
+                    surface_color[rays] *= texture[np.mod(tx, width),
+                                                   np.mod(ty, height)]
+        return surface_color
+
+    def render_tile(self, x_start: int, x_end: int, y_start: int, y_end: int) -> None:
+        rt = self.raytracer
+        if rt.edges is not None:
+            self.antialias_tile(x_start, x_end, y_start, y_end)
+            return
+
+        xs, ys, directions = self.primary_rays(x_start, x_end, y_start, y_end)
+        origin = np.asarray(rt.camera_position, dtype=float)
+        origins = np.broadcast_to(origin, directions.shape)
+
+        hits = self.intersect(origins, directions)
+        colors, valid = self.trace(origins, directions, hits)
+
+        # invert y, same as Raytracer.point
+        ys = rt.height - ys
+        inside = (0 <= xs) & (xs < rt.width) & (0 <= ys) & (ys < rt.height)
+        valid &= inside
+
+        pixels = np.frombuffer(rt.framebuffer.pixels, dtype=np.uint8).reshape(
+            rt.height, rt.width, 3)
+        pixels[ys[valid], xs[valid]] = np.clip(
+            colors[valid] * 255, 0, 255).astype(np.uint8)
+        # Shapes are indexed like the scene, so the ids match Raytracer.shape_id
+        shapes = np.frombuffer(rt.framebuffer.shapes, dtype=np.uint32).reshape(
+            rt.height, rt.width)
+        shapes[ys[inside], xs[inside]] = hits.shape[inside] + 1
+
+    def antialias_tile(self, x_start: int, x_end: int, y_start: int, y_end: int) -> None:
+        '''
+        Extra samples of the pixels of a tile refined by the running antialiasing pass, see
+        Raytracer.antialias. All the samples of the tile are traced as one packet.
+        '''
+        rt = self.raytracer
+        edges = [(x, y) for x in range(x_start, x_end)
+                 for y in range(y_start, y_end) if (x, y) in rt.edges]
+        if not edges:
+            return
+        samples = rt.antialiasing - 1
+
+        directions = np.asarray([rt.primary_direction(x, y, jitter)
+                                 for x, y in edges
+                                 for jitter in rt.sample_jitters(x, y)], dtype=float)
+        origin = np.asarray(rt.camera_position, dtype=float)
+        origins = np.broadcast_to(origin, directions.shape)
+
+        colors, valid = self.trace(origins, directions)
+        colors[~valid] = rt.background_color()
+
+        first = np.asarray([rt.edges[pixel] for pixel in edges], dtype=float) / 255
+        colors = (first + colors.reshape(len(edges), samples, 3).sum(axis=1)) / rt.antialiasing
+
+        xs, ys = np.asarray(edges).T
+        # invert y, same as Raytracer.point
+        ys = rt.height - ys
+        pixels = np.frombuffer(rt.framebuffer.pixels, dtype=np.uint8).reshape(
+            rt.height, rt.width, 3)
+        pixels[ys, xs] = np.clip(colors * 255, 0, 255).astype(np.uint8)